@@ -0,0 +1,121 @@
+"""
+Benchmark of the storage format of the results in the KV.
+
+Realistic stream responses are assembled from the search responses in fixtures/:
+the contexts of a search engine, an answer of a few hundred words citing them,
+and related questions. For each codec, the script reports the stored size
+relative to the plain text format, the encode and decode throughput, and the time
+until the sources can be streamed on a replay:
+
+    python benchmark/kv_format_benchmark.py --answers 200
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rag.search  # noqa: E402
+import rag.store  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def fixture_contexts() -> list:
+    """
+    Returns the contexts of each of the search engine fixtures.
+    """
+    contexts = []
+    for name, backend_class in rag.search.SEARCH_BACKENDS.items():
+        path = os.path.join(FIXTURES_DIR, f"{name.lower()}.json")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                contexts.append(backend_class.__new__(backend_class).contexts(f.read()))
+    return contexts
+
+
+def make_answer(contexts: list, rng: random.Random, words: int) -> str:
+    """
+    Makes a markdown answer out of sentences of the snippets, with citations.
+    """
+    sentences = [
+        (i + 1, sentence.strip())
+        for i, c in enumerate(contexts)
+        for sentence in c["snippet"].replace("...", ".").split(".")
+        if len(sentence.split()) > 3
+    ]
+    paragraphs, count = [], 0
+    while count < words:
+        paragraph = []
+        for _ in range(rng.randint(2, 4)):
+            citation, sentence = rng.choice(sentences)
+            paragraph.append(f"{sentence} [citation:{citation}].")
+            count += len(sentence.split())
+        paragraphs.append(" ".join(paragraph))
+    return "\n\n".join(paragraphs)
+
+
+def make_results(count: int, words: int) -> list:
+    rng = random.Random(0)
+    all_contexts = fixture_contexts()
+    results = []
+    for _ in range(count):
+        contexts = rng.choice(all_contexts)
+        related = [f"{rng.choice(contexts)['name']}?" for _ in range(3)]
+        results.append(
+            "".join(
+                [
+                    json.dumps(contexts),
+                    rag.store.LLM_RESPONSE_MARKER,
+                    make_answer(contexts, rng, words),
+                    rag.store.RELATED_QUESTIONS_MARKER,
+                    json.dumps(related),
+                ]
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--answers", type=int, default=200)
+    parser.add_argument("--words", type=int, default=400)
+    args = parser.parse_args()
+
+    results = make_results(args.answers, args.words)
+    raw_bytes = sum(len(r.encode("utf-8")) for r in results)
+    metadata = {"model": "mixtral-8x7b", "backend": "BING", "query": "a typical query"}
+    print(f"{len(results)} answers, {raw_bytes / len(results) / 1024:.1f}KiB each.")
+    print(
+        f"{'codec':>6} {'size':>8} {'ratio':>6} {'encode MB/s':>12}"
+        f" {'decode MB/s':>12} {'sources us':>11}"
+    )
+    codecs = ["none", "zlib"] + (["zstd"] if rag.store.zstandard else [])
+    for codec in codecs:
+        start = time.perf_counter()
+        encoded = [rag.store.encode_result(r, metadata, codec) for r in results]
+        encode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for value, result in zip(encoded, results):
+            assert rag.store.decode_result(value) == result
+        decode_seconds = time.perf_counter() - start
+        # The time to the first chunk of a replay, the sources.
+        start = time.perf_counter()
+        for value in encoded:
+            next(rag.store.iter_result(value))
+        sources_seconds = time.perf_counter() - start
+        size = sum(len(v) for v in encoded)
+        print(
+            f"{codec:>6} {size / len(results) / 1024:>6.1f}Ki {raw_bytes / size:>6.2f}"
+            f" {raw_bytes / encode_seconds / 1e6:>12.1f}"
+            f" {raw_bytes / decode_seconds / 1e6:>12.1f}"
+            f" {sources_seconds / len(results) * 1e6:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
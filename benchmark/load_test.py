@@ -0,0 +1,166 @@
+"""
+Load test of POST /query in the threaded mode and in the async mode.
+
+For each mode, the script starts the mock upstreams and the photon as local
+subprocesses, fires requests with a fixed number of concurrent clients, and
+reports the peak number of in-flight streams, the throughput and the latency
+percentiles:
+
+    python benchmark/load_test.py --concurrency 16 64 256 --requests 512
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of values with nearest-rank interpolation.
+    """
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def start_process(script, *args, env=None) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARK_DIR, script), *args],
+        env={**os.environ, **(env or {})},
+    )
+
+
+def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} is not up after {timeout} seconds.")
+
+
+async def run_load(url: str, concurrency: int, num_requests: int) -> dict:
+    """
+    Sends num_requests queries with `concurrency` concurrent clients.
+    """
+    latencies, ttfbs = [], []
+    errors = 0
+    in_flight = 0
+    peak_in_flight = 0
+    pending = iter(range(num_requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=600) as client:
+
+        async def worker():
+            nonlocal errors, in_flight, peak_in_flight
+            for i in pending:
+                start = time.perf_counter()
+                ttfb = None
+                in_flight += 1
+                peak_in_flight = max(peak_in_flight, in_flight)
+                try:
+                    async with client.stream(
+                        "POST",
+                        f"{url}/query",
+                        json={"query": f"question {i}", "search_uuid": uuid.uuid4().hex},
+                    ) as response:
+                        async for _ in response.aiter_bytes():
+                            if ttfb is None:
+                                ttfb = time.perf_counter() - start
+                        if response.status_code != 200:
+                            errors += 1
+                            continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                finally:
+                    in_flight -= 1
+                latencies.append(time.perf_counter() - start)
+                ttfbs.append(ttfb)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "peak_in_flight": peak_in_flight,
+        "throughput": len(latencies) / elapsed,
+        "ttfb_p50": percentile(ttfbs, 50),
+        "ttfb_p99": percentile(ttfbs, 99),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--upstream-port", type=int, default=8900)
+    parser.add_argument("--photon-port", type=int, default=8080)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--num-tokens", type=int, default=60)
+    parser.add_argument("--token-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    photon = f"http://127.0.0.1:{args.photon_port}"
+    upstream_process = start_process(
+        "mock_upstreams.py",
+        "--port", str(args.upstream_port),
+        "--num-tokens", str(args.num_tokens),
+        "--token-interval", str(args.token_interval),
+    )
+    results = []
+    try:
+        wait_until_up(f"{upstream}/docs")
+        for mode in args.modes:
+            photon_process = start_process(
+                "run_photon.py",
+                "--upstream", upstream,
+                "--port", str(args.photon_port),
+                env={"ASYNC_MODE": "true" if mode == "async" else "false"},
+            )
+            try:
+                wait_until_up(f"{photon}/readyz")
+                for concurrency in args.concurrency:
+                    result = asyncio.run(
+                        run_load(photon, concurrency, args.requests)
+                    )
+                    result["mode"] = mode
+                    results.append(result)
+            finally:
+                photon_process.terminate()
+                photon_process.wait()
+    finally:
+        upstream_process.terminate()
+        upstream_process.wait()
+
+    print(
+        f"{'mode':>9} {'clients':>8} {'peak':>6} {'req/s':>8} {'ttfb p50':>9}"
+        f" {'ttfb p99':>9} {'p50':>8} {'p99':>8} {'errors':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['mode']:>9} {r['concurrency']:>8} {r['peak_in_flight']:>6}"
+            f" {r['throughput']:>8.1f} {r['ttfb_p50']:>9.3f} {r['ttfb_p99']:>9.3f}"
+            f" {r['p50']:>8.3f} {r['p99']:>8.3f} {r['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
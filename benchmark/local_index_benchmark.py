@@ -0,0 +1,153 @@
+"""
+Benchmark of the local search index of BACKEND=LOCAL.
+
+A synthetic corpus of passages, whose words follow a Zipf distribution like the
+words of real text, is indexed, and the script reports the build throughput, the
+size of the index, and the latency percentiles of random queries. It then adds
+1% more documents, half of which replace existing ones, as an incremental update,
+and compacts the index, reporting the query latency after each step:
+
+    python benchmark/local_index_benchmark.py --passages 1000000
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rag.index  # noqa: E402
+from load_test import percentile  # noqa: E402
+
+_SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "qua", "ber", "dun"]
+
+
+def vocabulary(size: int, rng: random.Random) -> list:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(_SYLLABLES, k=rng.randint(2, 5))))
+    return sorted(words)
+
+
+class Corpus(object):
+    """
+    Generates passages whose words follow a Zipf distribution.
+    """
+
+    def __init__(self, vocabulary_size: int, passage_words: int, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.words = vocabulary(vocabulary_size, self.rng)
+        self.cum_weights = list(
+            itertools.accumulate(1 / (rank + 1) for rank in range(len(self.words)))
+        )
+        self.passage_words = passage_words
+
+    def sample(self, k: int) -> list:
+        return self.rng.choices(self.words, cum_weights=self.cum_weights, k=k)
+
+    def write(self, path: str, ids: range):
+        with open(path, "w") as f:
+            for i in ids:
+                text = " ".join(self.sample(self.passage_words))
+                document = {"url": f"https://example.com/doc/{i}", "title": f"Doc {i}"}
+                f.write(json.dumps({**document, "text": text}) + "\n")
+
+    def queries(self, count: int) -> list:
+        return [" ".join(self.sample(self.rng.randint(2, 4))) for _ in range(count)]
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def measure_queries(index_dir: str, queries: list, max_postings: int) -> str:
+    index = rag.index.LocalIndex(index_dir, max_postings=max_postings)
+    index.search(queries[0])
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return (
+        f"{len(index.segments)} segments, query p50 {percentile(latencies, 50):.2f}ms"
+        f" p95 {percentile(latencies, 95):.2f}ms p99 {percentile(latencies, 99):.2f}ms"
+        f" max {max(latencies):.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--passages", type=int, default=100000)
+    parser.add_argument("--passage-words", type=int, default=120)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--segment-passages", type=int, default=100000)
+    parser.add_argument("--max-postings", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--directory", help="Where to build the index.")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp()
+    index_dir = os.path.join(directory, "index")
+    shutil.rmtree(index_dir, ignore_errors=True)
+    corpus = Corpus(args.vocabulary, args.passage_words)
+    queries = corpus.queries(args.queries)
+
+    corpus_path = os.path.join(directory, "corpus.jsonl")
+    start = time.time()
+    corpus.write(corpus_path, range(args.passages))
+    print(f"Generated {args.passages} passages in {time.time() - start:.1f}s.")
+
+    def add(path: str):
+        writer = rag.index.LocalIndexWriter(
+            index_dir,
+            # Each document is one passage.
+            passage_words=args.passage_words,
+            segment_passages=args.segment_passages,
+        )
+        try:
+            start = time.time()
+            count = writer.add(rag.index.read_documents(path))
+            elapsed = time.time() - start
+        finally:
+            writer.close()
+        print(
+            f"Indexed {count} passages in {elapsed:.1f}s"
+            f" ({count / elapsed:.0f} passages/s),"
+            f" index size {directory_size(index_dir) / 2**20:.1f}MiB."
+        )
+
+    add(corpus_path)
+    print("Full build:", measure_queries(index_dir, queries, args.max_postings))
+
+    update = max(1, args.passages // 100)
+    update_path = os.path.join(directory, "update.jsonl")
+    corpus.write(update_path, range(args.passages - update // 2, args.passages + update // 2))
+    add(update_path)
+    print("Incremental update:", measure_queries(index_dir, queries, args.max_postings))
+
+    writer = rag.index.LocalIndexWriter(
+        index_dir, segment_passages=args.segment_passages
+    )
+    try:
+        start = time.time()
+        writer.compact()
+        print(f"Compacted in {time.time() - start:.1f}s.")
+    finally:
+        writer.close()
+    print("Compacted:", measure_queries(index_dir, queries, args.max_postings))
+    if not args.directory:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
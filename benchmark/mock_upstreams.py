@@ -0,0 +1,276 @@
+"""
+Local stand-ins for the upstream services of the RAG photon: a Serper compatible
+search endpoint, an OpenAI compatible chat completion endpoint, and the web pages
+that the search results link to. They answer with canned content after a
+configurable latency, so that the photon can be load tested without paying for
+search queries or LLM tokens.
+
+Run it standalone with
+
+    python benchmark/mock_upstreams.py --port 8900
+
+and point the photon to it with run_photon.py. Models can be given their own
+latencies and failure rates, to exercise the routing of LLM_MODELS:
+
+    python benchmark/mock_upstreams.py --model fast:first_token_latency=0.1 \
+        --model flaky:error_rate=0.3,stream_error_rate=0.2
+
+They can also replay a trace recorded with record_trace.py: the search responses
+of any of the search engines, and the LLM answers token by token with their
+recorded timing, for the queries of the trace:
+
+    python benchmark/mock_upstreams.py --trace trace.jsonl
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from typing import List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+import uvicorn
+
+
+# Words to make up the snippets from, so that they look distinct to the photon.
+_WORDS = (
+    "search engine answer model token stream cache latency query result page "
+    "network server client request response budget context citation source "
+    "question language system memory index score rank document"
+).split()
+
+
+def _snippet(i: int, query: str) -> str:
+    words = random.Random(i).choices(_WORDS, k=20)
+    return f"Snippet {i} about {query}: {' '.join(words)}."
+
+
+def _page(i: int) -> str:
+    rng = random.Random(i)
+    paragraphs = "".join(
+        f"<p>{' '.join(rng.choices(_WORDS, k=60))}.</p>\n" for _ in range(20)
+    )
+    return (
+        f"<html><head><title>Page {i}</title><style>p {{ margin: 0 }}</style>"
+        "<script>var tracking = true;</script></head><body>"
+        "<nav><a href='/'>Home</a></nav>"
+        f"<article><h1>Page {i}</h1>\n{paragraphs}</article>"
+        "<footer>Copyright</footer></body></html>"
+    )
+
+
+def create_app(
+    search_latency: float = 0.2,
+    num_tokens: int = 60,
+    token_interval: float = 0.05,
+    first_token_latency: float = 0.2,
+    related_latency: float = 0.5,
+    page_latency: float = 0.3,
+    models: Optional[dict] = None,
+    trace: Optional[List[dict]] = None,
+) -> FastAPI:
+    """
+    Creates the mock upstream app. models overrides the LLM settings by model:
+    first_token_latency, token_interval, num_tokens and related_latency, and
+    error_rate and stream_error_rate, the fractions of the calls that fail with a
+    503, or whose stream is cut before its first token. If a trace is given, its
+    recorded responses and timing replace the canned ones.
+    """
+    app = FastAPI()
+    traces = TraceIndex(trace) if trace else None
+    defaults = {
+        "num_tokens": num_tokens,
+        "token_interval": token_interval,
+        "first_token_latency": first_token_latency,
+        "related_latency": related_latency,
+        "error_rate": 0.0,
+        "stream_error_rate": 0.0,
+    }
+
+    @app.api_route("/search", methods=["GET", "POST"])
+    async def search(request: Request):
+        # Serper sends the query in a json body, the others in the url.
+        if request.method == "POST":
+            query = (await request.json()).get("q", "")
+        else:
+            query = request.query_params.get("q", "")
+        if traces is not None:
+            record = traces.get(query)
+            await asyncio.sleep(record["search_latency"])
+            return JSONResponse(record["search"])
+        await asyncio.sleep(search_latency)
+        base_url = str(request.base_url).rstrip("/")
+        return JSONResponse({
+            "organic": [
+                {
+                    "title": f"Result {i} for {query}",
+                    "link": f"{base_url}/page/{i}",
+                    "snippet": _snippet(i, query),
+                }
+                for i in range(10)
+            ]
+        })
+
+    @app.get("/page/{i}")
+    async def page(i: int, request: Request):
+        await asyncio.sleep(page_latency)
+        etag = f'"page-{i}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return HTMLResponse(_page(i), headers={"ETag": etag})
+
+    @app.post("/llm/{model}/v1/chat/completions")
+    async def chat_completions(model: str, request: Request):
+        body = await request.json()
+        settings = {**defaults, **(models or {}).get(model, {})}
+        created = int(time.time())
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if random.random() < settings["error_rate"]:
+            return JSONResponse(
+                {"error": {"message": f"{model} is overloaded."}}, status_code=503
+            )
+        record = traces.get(body["messages"][-1]["content"]) if traces else None
+        if body.get("tools"):
+            if record is not None:
+                await asyncio.sleep(record["related_latency"])
+                questions = record["related"]
+            else:
+                await asyncio.sleep(settings["related_latency"])
+                questions = [f"Related question {i}?" for i in range(3)]
+            arguments = json.dumps({"questions": questions})
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": [{
+                            "id": "call_0",
+                            "type": "function",
+                            "function": {
+                                "name": "ask_related_questions",
+                                "arguments": arguments,
+                            },
+                        }],
+                    },
+                    "finish_reason": "tool_calls",
+                }],
+            })
+
+        cut = random.random() < settings["stream_error_rate"]
+
+        if record is not None:
+            # The recorded tokens, each after its delay since the previous one.
+            tokens = record["tokens"]
+        else:
+            tokens = [
+                (
+                    settings["token_interval"] if i else settings["first_token_latency"],
+                    f"token{i} ",
+                )
+                for i in range(int(settings["num_tokens"]))
+            ]
+
+        async def stream():
+            for i, (delay, text) in enumerate(tokens):
+                await asyncio.sleep(delay)
+                if cut:
+                    raise RuntimeError(f"{model} cut the stream.")
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": text},
+                        "finish_reason": None,
+                    }],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+class TraceIndex(object):
+    """
+    The records of a trace by query. The queries that are not in the trace get
+    the record of a query chosen by their hash, so that a query log can be
+    replayed with a smaller trace, and each query always gets the same one.
+    """
+
+    def __init__(self, records: List[dict]):
+        self.records = records
+        self.by_query = {r["query"]: r for r in records}
+
+    def get(self, query: str) -> dict:
+        record = self.by_query.get(query)
+        if record is None:
+            digest = hashlib.sha1(query.encode("utf-8")).digest()
+            record = self.records[int.from_bytes(digest[:4], "little") % len(self.records)]
+        return record
+
+
+def read_trace(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_models(specs: List[str]) -> dict:
+    """
+    Parses the --model settings.
+    """
+    models = {}
+    for spec in specs:
+        name, _, settings = spec.partition(":")
+        models[name] = {
+            key: float(value)
+            for key, value in (s.split("=") for s in settings.split(",") if s)
+        }
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--num-tokens", type=int, default=60)
+    parser.add_argument("--token-interval", type=float, default=0.05)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--related-latency", type=float, default=0.5)
+    parser.add_argument("--page-latency", type=float, default=0.3)
+    parser.add_argument(
+        "--model",
+        action="append",
+        default=[],
+        help="Settings of a model, as name:setting=value,setting=value.",
+    )
+    parser.add_argument("--trace", help="A trace recorded with record_trace.py.")
+    args = parser.parse_args()
+    app = create_app(
+        search_latency=args.search_latency,
+        num_tokens=args.num_tokens,
+        token_interval=args.token_interval,
+        first_token_latency=args.first_token_latency,
+        related_latency=args.related_latency,
+        page_latency=args.page_latency,
+        models=parse_models(args.model),
+        trace=read_trace(args.trace) if args.trace else None,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark of the parsing of the search engine responses.
+
+For each registered search backend, the response in fixtures/<backend>.json is
+decoded and converted to contexts many times, and the CPU time per response is
+reported, split between the json decoding (with the standard json module, and
+with orjson if it is installed) and the conversion to contexts:
+
+    python benchmark/parse_benchmark.py --iterations 2000
+
+The results can be saved, and later runs compared to them, so that a change that
+makes the parsing slower is caught:
+
+    python benchmark/parse_benchmark.py --save /tmp/parse.json
+    python benchmark/parse_benchmark.py --compare /tmp/parse.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rag.search  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def cpu_time_per_call(function, iterations: int) -> float:
+    """
+    Returns the CPU time of one call of function in microseconds, as the best of
+    three runs of the given number of iterations.
+    """
+    best = float("inf")
+    for _ in range(3):
+        start = time.process_time()
+        for _ in range(iterations):
+            function()
+        best = min(best, time.process_time() - start)
+    return best / iterations * 1e6
+
+
+def benchmark(name: str, iterations: int) -> dict:
+    """
+    Benchmarks the parsing of the fixture of the given backend.
+    """
+    with open(os.path.join(FIXTURES_DIR, f"{name.lower()}.json"), "rb") as f:
+        content = f.read()
+    # The credentials are not needed to parse the responses.
+    backend_class = rag.search.SEARCH_BACKENDS[name]
+    backend = backend_class.__new__(backend_class)
+    json_content = json.loads(content)
+    results = {
+        "bytes": len(content),
+        "contexts": len(backend.contexts(content)),
+        "json_us": cpu_time_per_call(lambda: json.loads(content), iterations),
+        "parse_us": cpu_time_per_call(
+            lambda: [r.to_dict() for r in backend.parse(json_content)], iterations
+        ),
+        "total_us": cpu_time_per_call(lambda: backend.contexts(content), iterations),
+    }
+    if orjson is not None:
+        results["orjson_us"] = cpu_time_per_call(
+            lambda: orjson.loads(content), iterations
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--save", help="Saves the results to this json file.")
+    parser.add_argument("--compare", help="Compares the results to this json file.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="The relative slowdown of the total time tolerated by --compare.",
+    )
+    args = parser.parse_args()
+
+    decoder = "orjson" if orjson is not None else "json"
+    print(f"decoder in use: {decoder}")
+    print(
+        f"{'backend':>10} {'bytes':>7} {'contexts':>8} {'json us':>9}"
+        f" {'orjson us':>9} {'parse us':>9} {'total us':>9}"
+    )
+    all_results = {}
+    for name in rag.search.SEARCH_BACKENDS:
+        results = all_results[name] = benchmark(name, args.iterations)
+        orjson_us = results.get("orjson_us")
+        print(
+            f"{name:>10} {results['bytes']:>7} {results['contexts']:>8}"
+            f" {results['json_us']:>9.1f}"
+            f" {'-' if orjson_us is None else f'{orjson_us:.1f}':>9}"
+            f" {results['parse_us']:>9.1f} {results['total_us']:>9.1f}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(all_results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = [
+            f"{name}: {results['total_us']:.1f}us vs {baseline[name]['total_us']:.1f}us"
+            for name, results in all_results.items()
+            if name in baseline
+            and results["total_us"] > baseline[name]["total_us"] * (1 + args.tolerance)
+        ]
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
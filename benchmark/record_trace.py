@@ -0,0 +1,144 @@
+"""
+Records a trace of the upstream responses for a list of queries, for
+mock_upstreams.py --trace to replay them.
+
+For each query, the search engine of --backend is called with the credentials in
+the env variables, and the LLM is asked for the answer and the related questions
+with the prompts of the photon. Each line of the trace is a json object with the
+query, the raw search response and its latency, the tokens of the answer, each
+with its delay since the previous one, and the related questions and their
+latency:
+
+    BACKEND=SERPER python benchmark/record_trace.py --queries queries.txt \
+        --output trace.jsonl
+
+A trace can also be made up offline, for CI, from the search response of the
+backend in fixtures/, with answers made of its snippets and log-normal token
+delays:
+
+    python benchmark/record_trace.py --synthetic 64 --output trace.jsonl
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+import search_with_lepton  # noqa: E402
+from kv_format_benchmark import FIXTURES_DIR, make_answer  # noqa: E402
+
+
+def record(backend_name: str, query: str, model: str) -> dict:
+    """
+    Records the upstream responses of one query.
+    """
+    import openai
+
+    backend = search_with_lepton.SEARCH_BACKENDS[backend_name].from_env()
+    start = time.perf_counter()
+    response = requests.request(**backend.request(query), timeout=backend.timeout)
+    search_latency = time.perf_counter() - start
+    response.raise_for_status()
+    contexts = search_with_lepton.select_contexts(query, backend.contexts(response.content))
+    _, context_text = search_with_lepton.build_context_text(contexts, 2048)
+
+    # The prompts of the photon, without the photon.
+    rag = search_with_lepton.RAG.__new__(search_with_lepton.RAG)
+    rag.model = model
+    client = openai.OpenAI(
+        base_url=search_with_lepton.LLM_BASE_URL_TEMPLATE.format(model=model),
+        api_key=os.environ["LEPTON_WORKSPACE_TOKEN"],
+    )
+    tokens = []
+    last = time.perf_counter()
+    for chunk in client.chat.completions.create(**rag._rag_request(query, context_text)):
+        if chunk.choices and chunk.choices[0].delta.content:
+            now = time.perf_counter()
+            tokens.append([round(now - last, 4), chunk.choices[0].delta.content])
+            last = now
+    start = time.perf_counter()
+    related = rag._parse_related_questions(
+        client.chat.completions.create(
+            **rag._related_questions_request(query, context_text)
+        )
+    )
+    return {
+        "query": query,
+        "backend": backend_name,
+        "search_latency": round(search_latency, 4),
+        "search": response.json(),
+        "tokens": tokens,
+        "related_latency": round(time.perf_counter() - start, 4),
+        "related": related,
+    }
+
+
+def synthetic(backend_name: str, count: int, seed: int = 0) -> list:
+    """
+    Makes up a trace of count queries from the search response of the backend
+    in fixtures/. The delays are log-normal around 0.3s to the first token and
+    30ms between tokens, and the answers are a hundred to a few hundred words
+    long.
+    """
+    rng = random.Random(seed)
+    with open(os.path.join(FIXTURES_DIR, f"{backend_name.lower()}.json"), "rb") as f:
+        content = f.read()
+    backend_class = search_with_lepton.SEARCH_BACKENDS[backend_name]
+    search = json.loads(content)
+    contexts = backend_class.__new__(backend_class).contexts(content)
+    records = []
+    for i in range(count):
+        words = make_answer(contexts, rng, rng.randint(100, 400)).split(" ")
+        delays = [rng.lognormvariate(-1.2, 0.5)] + [
+            rng.lognormvariate(-3.5, 0.5) for _ in words[1:]
+        ]
+        records.append({
+            "query": f"{contexts[0]['name']} {i}",
+            "backend": backend_name,
+            "search_latency": round(rng.lognormvariate(-1.6, 0.4), 4),
+            "search": search,
+            "tokens": [[round(d, 4), w + " "] for d, w in zip(delays, words)],
+            "related_latency": round(rng.lognormvariate(-0.7, 0.3), 4),
+            "related": [f"{c['name']}?" for c in rng.sample(contexts, 3)],
+        })
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--queries", help="A file with one query per line.")
+    parser.add_argument("--backend", default=os.environ.get("BACKEND", "SERPER"))
+    parser.add_argument("--model", default=os.environ.get("LLM_MODEL", "mixtral-8x7b"))
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        help="Makes up this many queries from the fixture of the backend.",
+    )
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        records = synthetic(args.backend.upper(), args.synthetic)
+    else:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+        records = []
+        for query in queries:
+            try:
+                records.append(record(args.backend.upper(), query, args.model))
+            except Exception as e:
+                print(f"Skipped {query!r}: {e}")
+    with open(args.output, "w") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+    print(f"Wrote {len(records)} queries to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Load test of the routing of the LLM calls across models.
+
+The mock upstreams serve models with different latencies and failure rates, and
+for each scenario, the photon is started with a list of models in LLM_MODELS and
+RELATED_QUESTIONS_MODELS and load tested. The script reports the errors and the
+latency percentiles of the queries, and how the calls were spread over the
+models, from the metrics of the photon:
+
+    python benchmark/routing_load_test.py --concurrency 32 --requests 256
+"""
+
+import argparse
+import asyncio
+import collections
+import re
+
+import httpx
+
+from load_test import run_load, start_process, wait_until_up
+
+# The models of the mock upstreams, and their settings.
+MODELS = [
+    "flaky:error_rate=0.2,stream_error_rate=0.1",
+    "backup:first_token_latency=0.4",
+    "slow:first_token_latency=2",
+    "fast:first_token_latency=0.1",
+    "small:related_latency=0.1",
+]
+
+# name -> (LLM_MODELS, RELATED_QUESTIONS_MODELS)
+SCENARIOS = {
+    "flaky": ("flaky", ""),
+    "flaky,backup": ("flaky,backup", ""),
+    "slow": ("slow", ""),
+    "slow,fast": ("slow,fast", "small"),
+}
+
+_ROUTE_CALLS = re.compile(
+    r'^rag_llm_route_calls_total\{model="([^"]+)",outcome="([^"]+)",router="([^"]+)"\} (\S+)$',
+    re.M,
+)
+
+
+def route_calls(photon: str) -> dict:
+    """
+    Returns the number of LLM calls by router, model and outcome.
+    """
+    calls = collections.Counter()
+    for model, outcome, router, count in _ROUTE_CALLS.findall(
+        httpx.get(f"{photon}/metrics").text
+    ):
+        calls[f"{router}/{model}/{outcome}"] += int(float(count))
+    return calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--upstream-port", type=int, default=8900)
+    parser.add_argument("--photon-port", type=int, default=8080)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    args = parser.parse_args()
+
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    photon = f"http://127.0.0.1:{args.photon_port}"
+    upstream_process = start_process(
+        "mock_upstreams.py",
+        "--port", str(args.upstream_port),
+        *(argument for model in MODELS for argument in ("--model", model)),
+    )
+    results = []
+    try:
+        wait_until_up(f"{upstream}/docs")
+        for scenario in args.scenarios:
+            models, related_questions_models = SCENARIOS[scenario]
+            photon_process = start_process(
+                "run_photon.py",
+                "--upstream", upstream,
+                "--port", str(args.photon_port),
+                env={
+                    "ASYNC_MODE": "true" if args.mode == "async" else "false",
+                    "LLM_MODELS": models,
+                    "RELATED_QUESTIONS_MODELS": related_questions_models,
+                    # Every query is a new one, so the caches are of no use.
+                    "SEARCH_CACHE_TTL": "0",
+                },
+            )
+            try:
+                wait_until_up(f"{photon}/readyz")
+                result = asyncio.run(run_load(photon, args.concurrency, args.requests))
+                result["scenario"] = scenario
+                result["calls"] = route_calls(photon)
+                results.append(result)
+            finally:
+                photon_process.terminate()
+                photon_process.wait()
+    finally:
+        upstream_process.terminate()
+        upstream_process.wait()
+
+    print(
+        f"{'models':>14} {'req/s':>8} {'ttfb p50':>9} {'ttfb p99':>9}"
+        f" {'p50':>8} {'p99':>8} {'errors':>7}  calls"
+    )
+    for r in results:
+        calls = " ".join(f"{k}={v}" for k, v in sorted(r["calls"].items()))
+        print(
+            f"{r['scenario']:>14} {r['throughput']:>8.1f} {r['ttfb_p50']:>9.3f}"
+            f" {r['ttfb_p99']:>9.3f} {r['p50']:>8.3f} {r['p99']:>8.3f}"
+            f" {r['errors']:>7}  {calls}"
+        )
+
+
+if __name__ == "__main__":
+    main()
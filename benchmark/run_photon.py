@@ -0,0 +1,85 @@
+"""
+Runs the RAG photon locally against the mock upstreams in mock_upstreams.py.
+
+The search endpoints and the LLM endpoint are redirected to the mock upstreams,
+the workspace login is skipped, and the Lepton KV is replaced by an in-memory
+dict, so that no Lepton account is needed. If the UI has not been built, an empty
+ui directory is served instead.
+
+    python benchmark/run_photon.py --upstream http://127.0.0.1:8900 --port 8080
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import leptonai.api.v0.workspace  # noqa: E402
+
+import rag.search  # noqa: E402
+import search_with_lepton  # noqa: E402
+
+
+class MemoryKV(object):
+    """
+    An in-memory replacement of leptonai.kv.KV.
+    """
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self._store = {}
+
+    def get(self, key):
+        return self._store[key]
+
+    def put(self, key, value):
+        self._store[key] = value.encode() if isinstance(value, str) else value
+
+    def delete(self, key):
+        self._store.pop(key, None)
+
+
+def patch_upstreams(upstream: str):
+    """
+    Points the photon to the mock upstreams.
+    """
+    for endpoint in (
+        "BING_SEARCH_V7_ENDPOINT",
+        "GOOGLE_SEARCH_ENDPOINT",
+        "SERPER_SEARCH_ENDPOINT",
+        "SEARCHAPI_SEARCH_ENDPOINT",
+    ):
+        setattr(rag.search, endpoint, f"{upstream}/search")
+    search_with_lepton.LLM_BASE_URL_TEMPLATE = f"{upstream}/llm/{{model}}/v1/"
+    search_with_lepton.KV = MemoryKV
+    leptonai.api.v0.workspace.login = lambda *args, **kwargs: None
+    os.environ.setdefault("BACKEND", "SERPER")
+    for key in (
+        "BING_SEARCH_V7_SUBSCRIPTION_KEY",
+        "GOOGLE_SEARCH_API_KEY",
+        "GOOGLE_SEARCH_CX",
+        "SERPER_SEARCH_API_KEY",
+        "SEARCHAPI_API_KEY",
+    ):
+        os.environ.setdefault(key, "mock")
+    os.environ.setdefault("LEPTON_WORKSPACE_TOKEN", "mock")
+    os.environ.setdefault("LLM_MODEL", "mock")
+    if not os.path.isdir("ui"):
+        os.chdir(tempfile.mkdtemp())
+        os.mkdir("ui")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--upstream", default="http://127.0.0.1:8900")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    patch_upstreams(args.upstream)
+    rag = search_with_lepton.RAG()
+    rag.launch(host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark of the cold start of a replica of the photon.
+
+Each run starts the photon against the mock upstreams as a fresh subprocess, and
+reports the time to import search_with_lepton (in a separate process), the time
+until the photon is listening (/livez, which includes the import and init), the
+time until it reports ready (/readyz, after the warm-up), and the time to first
+byte and total time of the first query and of the second one:
+
+    python benchmark/startup_benchmark.py --runs 5
+
+The runs are repeated with the warm-up turned off (WARM_UP=false), so that the
+first query pays for the lazy imports and the new connections again.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+from load_test import BENCHMARK_DIR, percentile, start_process, wait_until_up
+
+
+def import_seconds() -> float:
+    code = (
+        "import time; start = time.perf_counter(); import search_with_lepton;"
+        " print(time.perf_counter() - start)"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], cwd=os.path.dirname(BENCHMARK_DIR)
+    )
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def wait_for(url: str, start: float, timeout: float = 60) -> float:
+    """
+    Returns the seconds from start until url returns 200.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.01)
+    raise RuntimeError(f"{url} is not up after {timeout} seconds.")
+
+
+def query(photon: str, text: str) -> tuple:
+    """
+    Returns the time to first byte and the total time of a query.
+    """
+    start = time.perf_counter()
+    ttfb = None
+    with httpx.stream(
+        "POST",
+        f"{photon}/query",
+        json={"query": text, "search_uuid": str(uuid.uuid4())},
+        timeout=60,
+    ) as response:
+        for _ in response.iter_bytes():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    return ttfb, time.perf_counter() - start
+
+
+def run(args, warm_up: bool) -> dict:
+    photon = f"http://127.0.0.1:{args.port}"
+    start = time.perf_counter()
+    process = start_process(
+        "run_photon.py",
+        "--upstream",
+        args.upstream,
+        "--port",
+        str(args.port),
+        env={"WARM_UP": str(warm_up).lower(), "ASYNC_MODE": str(args.async_mode).lower()},
+    )
+    try:
+        results = {
+            "listening": wait_for(f"{photon}/livez", start),
+            "ready": wait_for(f"{photon}/readyz", start),
+        }
+        # Different queries, so that the second one is not served from a cache.
+        results["first_ttfb"], results["first"] = query(photon, f"first {uuid.uuid4()}")
+        results["second_ttfb"], results["second"] = query(photon, f"second {uuid.uuid4()}")
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--upstream-port", type=int, default=8901)
+    parser.add_argument("--async-mode", action="store_true")
+    args = parser.parse_args()
+    args.upstream = f"http://127.0.0.1:{args.upstream_port}"
+
+    imports = [import_seconds() for _ in range(args.runs)]
+    print(f"import search_with_lepton: {percentile(imports, 50):.3f}s (median)")
+
+    upstreams = start_process("mock_upstreams.py", "--port", str(args.upstream_port))
+    try:
+        wait_until_up(f"{args.upstream}/docs")
+        columns = ["listening", "ready", "first_ttfb", "first", "second_ttfb", "second"]
+        print(f"{'warm-up':>8}" + "".join(f" {c:>12}" for c in columns))
+        for warm_up in (False, True):
+            runs = [run(args, warm_up) for _ in range(args.runs)]
+            print(
+                f"{'on' if warm_up else 'off':>8}"
+                + "".join(
+                    f" {percentile([r[c] for r in runs], 50):>11.3f}s" for c in columns
+                )
+            )
+    finally:
+        upstreams.terminate()
+        upstreams.wait()
+
+
+if __name__ == "__main__":
+    main()
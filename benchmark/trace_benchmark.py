@@ -0,0 +1,307 @@
+"""
+Trace-driven end-to-end benchmark of POST /query.
+
+The mock upstreams replay a trace recorded with record_trace.py (by default, a
+synthetic one made up from fixtures/), and the photon is sent queries with an
+open-loop arrival pattern: a Poisson process, where a fraction of the requests
+replay the search uuid of an earlier one like shared links do, or a replay of a
+query log. For each mode of the photon, the script reports the throughput, the
+time to first byte and latency percentiles, and the memory, threads and sockets
+of the photon process per in-flight stream:
+
+    python benchmark/trace_benchmark.py --rate 20 --duration 30 --shared-ratio 0.2
+    python benchmark/trace_benchmark.py --trace trace.jsonl --log queries.jsonl
+
+A query log has one json object per line, with the time of the query in seconds,
+the query, and its search_uuid. The results can be saved, and later runs
+compared to them, for example in CI, so that a change that makes the queries
+slower is caught:
+
+    python benchmark/trace_benchmark.py --save /tmp/trace.json
+    python benchmark/trace_benchmark.py --compare /tmp/trace.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+from load_test import percentile, start_process, wait_until_up
+from record_trace import synthetic
+
+# The results that are compared by --compare, and whether higher is better.
+_COMPARED = {
+    "throughput": True,
+    "ttfb_p99": False,
+    "p99": False,
+    "memory_per_stream_kb": False,
+}
+
+
+def poisson_arrivals(
+    queries: list, rate: float, duration: float, shared_ratio: float, seed: int = 0
+) -> list:
+    """
+    Returns the (time, query, search_uuid) of the requests of a Poisson process of
+    the given rate. A shared_ratio of the requests replay an earlier request.
+    """
+    rng = random.Random(seed)
+    arrivals, now = [], 0.0
+    while True:
+        now += rng.expovariate(rate)
+        if now >= duration:
+            return arrivals
+        if arrivals and rng.random() < shared_ratio:
+            _, query, search_uuid = rng.choice(arrivals)
+        else:
+            query, search_uuid = rng.choice(queries), uuid.uuid4().hex
+        arrivals.append((now, query, search_uuid))
+
+
+def log_arrivals(path: str, speed: float) -> list:
+    """
+    Returns the (time, query, search_uuid) of the requests of a query log, from
+    the time of its first query, and sped up by the given factor.
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    start = min(r["time"] for r in records)
+    return sorted(
+        ((r["time"] - start) / speed, r["query"], r.get("search_uuid") or uuid.uuid4().hex)
+        for r in records
+    )
+
+
+class ProcessSampler(object):
+    """
+    Samples the resident memory, the threads and the open sockets of a process
+    from /proc in the background, and keeps their peaks.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = self.sample()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self) -> dict:
+        values = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name == "VmRSS":
+                    values["rss_kb"] = int(value.split()[0])
+                elif name == "Threads":
+                    values["threads"] = int(value)
+        values["sockets"] = 0
+        for fd in os.listdir(f"/proc/{self.pid}/fd"):
+            try:
+                if os.readlink(f"/proc/{self.pid}/fd/{fd}").startswith("socket:"):
+                    values["sockets"] += 1
+            except OSError:
+                # Closed in the meantime.
+                pass
+        return values
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                sample = self.sample()
+            except OSError:
+                return
+            self.peak = {k: max(v, self.peak[k]) for k, v in sample.items()}
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+async def run_arrivals(url: str, arrivals: list) -> dict:
+    """
+    Sends the requests at their arrival times, whether or not the earlier ones
+    are done.
+    """
+    latencies, ttfbs = [], []
+    errors = 0
+    in_flight = 0
+    peak_in_flight = 0
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=600) as client:
+
+        async def send(arrival: float, query: str, search_uuid: str):
+            nonlocal errors, in_flight, peak_in_flight
+            await asyncio.sleep(max(0.0, arrival - (time.perf_counter() - start)))
+            request_start = time.perf_counter()
+            ttfb = None
+            in_flight += 1
+            peak_in_flight = max(peak_in_flight, in_flight)
+            try:
+                async with client.stream(
+                    "POST",
+                    f"{url}/query",
+                    json={"query": query, "search_uuid": search_uuid},
+                ) as response:
+                    async for _ in response.aiter_bytes():
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - request_start
+                    if response.status_code != 200:
+                        errors += 1
+                        return
+            except httpx.HTTPError:
+                errors += 1
+                return
+            finally:
+                in_flight -= 1
+            latencies.append(time.perf_counter() - request_start)
+            ttfbs.append(ttfb)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(*arrival) for arrival in arrivals))
+        elapsed = time.perf_counter() - start
+    return {
+        "requests": len(arrivals),
+        "peak_in_flight": peak_in_flight,
+        "throughput": len(latencies) / elapsed,
+        "ttfb_p50": percentile(ttfbs, 50),
+        "ttfb_p99": percentile(ttfbs, 99),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trace", help="A trace recorded with record_trace.py.")
+    parser.add_argument("--log", help="A query log to replay, instead of Poisson.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Of the log replay.")
+    parser.add_argument("--rate", type=float, default=10, help="Queries per second.")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--shared-ratio", type=float, default=0.1)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--upstream-port", type=int, default=8900)
+    parser.add_argument("--photon-port", type=int, default=8080)
+    parser.add_argument("--save", help="Saves the results to this json file.")
+    parser.add_argument("--compare", help="Compares the results to this json file.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="The relative regression of the results tolerated by --compare.",
+    )
+    args = parser.parse_args()
+
+    trace = args.trace
+    if trace is None:
+        trace = os.path.join(tempfile.mkdtemp(), "trace.jsonl")
+        with open(trace, "w") as f:
+            for record in synthetic("SERPER", 64):
+                f.write(json.dumps(record) + "\n")
+    with open(trace) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if args.log:
+        arrivals = log_arrivals(args.log, args.speed)
+    else:
+        arrivals = poisson_arrivals(
+            [r["query"] for r in records], args.rate, args.duration, args.shared_ratio
+        )
+    shared = len(arrivals) - len({search_uuid for _, _, search_uuid in arrivals})
+    print(
+        f"{len(arrivals)} requests over {arrivals[-1][0]:.1f}s,"
+        f" {shared} of them for a search uuid requested before."
+    )
+
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    photon = f"http://127.0.0.1:{args.photon_port}"
+    upstream_process = start_process(
+        "mock_upstreams.py", "--port", str(args.upstream_port), "--trace", trace
+    )
+    results = {}
+    try:
+        wait_until_up(f"{upstream}/docs")
+        for mode in args.modes:
+            photon_process = start_process(
+                "run_photon.py",
+                "--upstream", upstream,
+                "--port", str(args.photon_port),
+                env={
+                    "ASYNC_MODE": "true" if mode == "async" else "false",
+                    "BACKEND": records[0]["backend"],
+                },
+            )
+            try:
+                wait_until_up(f"{photon}/readyz")
+                with ProcessSampler(photon_process.pid) as sampler:
+                    idle = sampler.peak
+                    result = asyncio.run(run_arrivals(photon, arrivals))
+                peak = sampler.peak
+                result["memory_per_stream_kb"] = (peak["rss_kb"] - idle["rss_kb"]) / max(
+                    1, result["peak_in_flight"]
+                )
+                result["peak_threads"] = peak["threads"]
+                result["peak_sockets"] = peak["sockets"]
+                results[mode] = result
+            finally:
+                photon_process.terminate()
+                photon_process.wait()
+    finally:
+        upstream_process.terminate()
+        upstream_process.wait()
+
+    print(
+        f"{'mode':>9} {'peak':>5} {'req/s':>7} {'ttfb p50':>9} {'ttfb p99':>9}"
+        f" {'p50':>7} {'p99':>7} {'errors':>6} {'KiB/stream':>10}"
+        f" {'threads':>7} {'sockets':>7}"
+    )
+    for mode, r in results.items():
+        print(
+            f"{mode:>9} {r['peak_in_flight']:>5} {r['throughput']:>7.1f}"
+            f" {r['ttfb_p50']:>9.3f} {r['ttfb_p99']:>9.3f} {r['p50']:>7.3f}"
+            f" {r['p99']:>7.3f} {r['errors']:>6} {r['memory_per_stream_kb']:>10.1f}"
+            f" {r['peak_threads']:>7} {r['peak_sockets']:>7}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for mode, r in results.items():
+            if mode not in baseline:
+                continue
+            for name, higher_is_better in _COMPARED.items():
+                value, base = r[name], baseline[mode][name]
+                worse = (
+                    value < base * (1 - args.tolerance)
+                    if higher_is_better
+                    else value > base * (1 + args.tolerance)
+                )
+                if worse:
+                    regressions.append(f"{mode} {name}: {value:.3f} vs {base:.3f}")
+            if r["errors"] > baseline[mode]["errors"]:
+                regressions.append(
+                    f"{mode} errors: {r['errors']} vs {baseline[mode]['errors']}"
+                )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""
+The subsystems of the RAG photon in search_with_lepton.py: the search backends,
+the caches and the storage of the results, the scheduling and the routing of
+the upstream calls, and the streaming of the responses.
+"""
@@ -0,0 +1,239 @@
+"""
+The admission control of the queries, which adapts the number of concurrent
+generations to the latency of the upstreams.
+"""
+
+import asyncio
+import concurrent.futures
+import math
+import threading
+import time
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+
+from .flight import resolve_future
+
+_admission_limit = Gauge(
+    "rag_admission_limit", "Current limit of concurrent generations."
+)
+_admission_in_flight = Gauge(
+    "rag_admission_in_flight", "Number of generations in progress."
+)
+_admission_queue_depth = Gauge(
+    "rag_admission_queue_depth", "Number of queries waiting to be admitted."
+)
+rejections = Counter(
+    "rag_rejections_total",
+    "Number of queries, or parts of queries, rejected because of overload.",
+    ["reason"],
+)
+executor_queue_depth = Gauge(
+    "rag_executor_queue_depth",
+    "Number of tasks waiting for a thread in each executor.",
+    ["pool"],
+)
+
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    A thread pool that counts the tasks waiting for a thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self._waiting_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._waiting_lock:
+            self.waiting += 1
+
+        def run():
+            with self._waiting_lock:
+                self.waiting -= 1
+            return fn(*args, **kwargs)
+
+        return super().submit(run)
+
+
+class Overloaded(Exception):
+    """
+    Raised when a query is not admitted. It carries the status code to return,
+    429 if the admission queue is full or 503 if the query waited too long, and
+    the number of seconds after which the client should retry.
+    """
+
+    def __init__(self, status_code: int, retry_after: int):
+        super().__init__(f"Overloaded, retry after {retry_after} seconds.")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionPermit(object):
+    """
+    The right to run one generation, which must be released when it ends. It is
+    also released when garbage collected, in case the stream response is never
+    started because its client went away before.
+    """
+
+    def __init__(self, limiter: "AdaptiveLimiter"):
+        self._limiter = limiter
+        self._start = time.perf_counter()
+        self._observed = False
+        self._released = False
+
+    def observe(self):
+        """
+        Reports the latency of the upstreams, from admission to the first token.
+        """
+        if not self._observed:
+            self._observed = True
+            self._limiter.observe(time.perf_counter() - self._start)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter.release(time.perf_counter() - self._start)
+
+    def __del__(self):
+        self.release()
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of concurrent generations, and adapts the limit AIMD-style
+    to the latency of the upstreams: the limit grows by one every limit fast
+    generations, and shrinks by a quarter when a generation takes more than
+    target_latency to get its first token, at most once per target_latency
+    seconds so that a burst of slow generations counts once. Until the first
+    slow generation, the limit grows by one for every fast one instead, so that
+    it quickly reaches the capacity of the upstreams.
+
+    Queries over the limit wait up to max_wait seconds for a slot, and at most
+    max_queue of them wait at once. The others are rejected right away, instead of
+    piling up until they time out.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        target_latency: float,
+        max_queue: int,
+        max_wait: float,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.target_latency = target_latency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        # Moving average of how long a generation holds its permit, to estimate
+        # when rejected clients should retry.
+        self._hold_seconds = 1.0
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._condition = threading.Condition()
+        # (event loop, future) of the async queries waiting for a slot.
+        self._async_waiters = []
+        _admission_limit.set_function(lambda: int(self.limit))
+        _admission_in_flight.set_function(lambda: self.in_flight)
+        _admission_queue_depth.set_function(lambda: self.waiting)
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _try_acquire(self) -> Optional[AdmissionPermit]:
+        # Must be called with the condition held.
+        if not self._has_room():
+            return None
+        self.in_flight += 1
+        return AdmissionPermit(self)
+
+    def _wake(self):
+        # Must be called with the condition held.
+        self._condition.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(resolve_future, future)
+        self._async_waiters = []
+
+    def _reject(self, reason: str, status_code: int) -> Overloaded:
+        rejections.labels(reason).inc()
+        retry_after = self._hold_seconds * (self.waiting + 1) / max(int(self.limit), 1)
+        return Overloaded(status_code, max(1, int(math.ceil(retry_after))))
+
+    def acquire(self) -> AdmissionPermit:
+        """
+        Waits for a slot, and returns its permit. Raises Overloaded if there is no
+        slot in time.
+        """
+        with self._condition:
+            permit = self._try_acquire()
+            if permit is not None:
+                return permit
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full", 429)
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(self._has_room, self.max_wait):
+                    raise self._reject("timeout", 503)
+                return self._try_acquire()
+            finally:
+                self.waiting -= 1
+
+    async def async_acquire(self) -> AdmissionPermit:
+        """
+        The async version of acquire.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        with self._condition:
+            permit = self._try_acquire()
+            if permit is not None:
+                return permit
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full", 429)
+            self.waiting += 1
+        try:
+            while True:
+                with self._condition:
+                    permit = self._try_acquire()
+                    if permit is not None:
+                        return permit
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise self._reject("timeout", 503)
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+                try:
+                    await asyncio.wait_for(future, remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self.waiting -= 1
+
+    def observe(self, latency: float):
+        with self._condition:
+            if latency > self.target_latency:
+                now = time.monotonic()
+                if now - self._last_decrease > self.target_latency:
+                    self._last_decrease = now
+                    self._slow_start = False
+                    self.limit = max(self.min_limit, self.limit * 0.75)
+            else:
+                before = int(self.limit)
+                increase = 1 if self._slow_start else 1 / self.limit
+                self.limit = min(self.max_limit, self.limit + increase)
+                if int(self.limit) > before:
+                    self._wake()
+
+    def release(self, hold_seconds: float):
+        with self._condition:
+            self.in_flight -= 1
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * hold_seconds
+            self._wake()
@@ -0,0 +1,330 @@
+"""
+The caches of the search results and of the answers to near-duplicate queries.
+"""
+
+import collections
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+from prometheus_client import Counter
+
+from leptonai.kv import KV
+
+################################################################################
+# Caching of the search results.
+################################################################################
+
+_search_cache_hits = Counter(
+    "rag_search_cache_hits_total",
+    "Number of search queries served from the search cache.",
+    ["tier"],
+)
+_search_cache_misses = Counter(
+    "rag_search_cache_misses_total",
+    "Number of search queries not found in a tier of the search cache. Corrupt"
+    " entries of the KV tier count as misses.",
+    ["tier"],
+)
+_search_cache_evictions = Counter(
+    "rag_search_cache_evictions_total",
+    "Number of entries evicted from the in-process search cache.",
+    ["reason"],
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes the query so that queries that differ only in case, whitespace or
+    punctuation share the same search results.
+    """
+    query = re.sub(r"\[/?INST\]", "", query)
+    query = re.sub(r"[^\w\s]", " ", query.casefold())
+    return " ".join(query.split())
+
+
+class SearchCache(object):
+    """
+    An in-process LRU cache of search results, with a TTL and a cap on the total
+    size of the cached results. Optionally, a KV can be used as a second tier that
+    is shared by all the replicas.
+
+    The KV tier is accessed with get_remote and put_remote, which block on network
+    calls, so that callers can decide where to run them.
+    """
+
+    def __init__(
+        self, ttl: float, max_bytes: int, kv: Optional[KV] = None, prefix: str = ""
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.kv = kv
+        self.prefix = prefix
+        # key -> (expiration time, size in bytes, contexts)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, backend: str, query: str) -> str:
+        """
+        Returns the cache key of the query. The key is hashed so that it always fits
+        in a KV key.
+        """
+        digest = hashlib.sha1(normalize_query(query).encode()).hexdigest()
+        return f"{self.prefix}{backend}/{digest}"
+
+    def get(self, key: str) -> Optional[list]:
+        """
+        Gets the search results from the in-process tier. Returns None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    _search_cache_hits.labels("memory").inc()
+                    return entry[2]
+                self._pop(key, "ttl")
+        _search_cache_misses.labels("memory").inc()
+        return None
+
+    def put(self, key: str, contexts: list, size: Optional[int] = None):
+        """
+        Puts the search results in the in-process tier.
+        """
+        if size is None:
+            size = len(json.dumps(contexts))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key, "replaced")
+            self._entries[key] = (time.time() + self.ttl, size, contexts)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)), "size")
+
+    def _pop(self, key: str, reason: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        if reason != "replaced":
+            _search_cache_evictions.labels(reason).inc()
+
+    def get_remote(self, key: str) -> Optional[list]:
+        """
+        Gets the search results from the KV tier, and populates the in-process tier
+        on a hit. Returns None on a miss. Entries that cannot be decoded, such as
+        ones written by another version, are deleted from the KV.
+        """
+        if self.kv is None:
+            return None
+        try:
+            value = self.kv.get(key)
+        except KeyError:
+            _search_cache_misses.labels("kv").inc()
+            return None
+        except Exception as e:
+            logger.error(f"Search cache KV error: {e}")
+            return None
+        try:
+            entry = json.loads(value)
+            expires, contexts = entry["expires"], entry["contexts"]
+        except (ValueError, UnicodeDecodeError, KeyError, TypeError) as e:
+            logger.debug(f"Deleting the corrupt search cache entry {key}: {e}")
+            _search_cache_misses.labels("kv").inc()
+            try:
+                self.kv.delete(key)
+            except Exception as e:
+                logger.error(f"Search cache KV error: {e}")
+            return None
+        if expires <= time.time():
+            _search_cache_misses.labels("kv").inc()
+            return None
+        _search_cache_hits.labels("kv").inc()
+        self.put(key, contexts, size=len(value))
+        return contexts
+
+    def put_remote(self, key: str, contexts: list):
+        """
+        Puts the search results in the KV tier. Errors are logged and ignored.
+        """
+        if self.kv is None:
+            return
+        try:
+            self.kv.put(
+                key,
+                json.dumps({"expires": time.time() + self.ttl, "contexts": contexts}),
+            )
+        except Exception as e:
+            logger.error(f"Search cache KV error: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Whether the in-process tier has fresh search results for the key. Unlike
+        get, it does not count as a lookup.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    def stats(self) -> dict:
+        """
+        Returns the number and total size of the entries in the in-process tier.
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+################################################################################
+# Caching of the generated answers for near-duplicate queries.
+################################################################################
+
+_answer_cache_hits = Counter(
+    "rag_answer_cache_hits_total",
+    "Number of queries answered from the answer cache.",
+)
+_answer_cache_misses = Counter(
+    "rag_answer_cache_misses_total",
+    "Number of queries not found in the answer cache.",
+)
+_answer_cache_evictions = Counter(
+    "rag_answer_cache_evictions_total",
+    "Number of entries evicted from the answer cache.",
+    ["reason"],
+)
+
+# Parameters of the MinHash signatures: the number of hash functions, and the
+# number of LSH bands they are split into. With 16 bands of 4 rows, two queries
+# with a Jaccard similarity of 0.8 collide in at least one band with a
+# probability of more than 99%.
+_MINHASH_NUM_PERM = 64
+_MINHASH_NUM_BANDS = 16
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(42)
+_MINHASH_PERMUTATIONS = [
+    (_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(_MINHASH_PRIME))
+    for _ in range(_MINHASH_NUM_PERM)
+]
+
+
+def query_shingles(query: str, size: int = 3) -> set:
+    """
+    Returns the character shingles of the normalized query.
+    """
+    text = normalize_query(query)
+    if len(text) <= size:
+        return {text}
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+def minhash_signature(shingles: set) -> tuple:
+    """
+    Returns the MinHash signature of a set of shingles.
+    """
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+        for s in shingles
+    ]
+    return tuple(
+        min((a * h + b) % _MINHASH_PRIME for h in hashes)
+        for a, b in _MINHASH_PERMUTATIONS
+    )
+
+
+class AnswerCache(object):
+    """
+    A cache of the complete stream responses of recent queries. A query is served
+    from the cache if it is near-identical to a cached query, measured by the
+    Jaccard similarity of their character shingles, estimated with MinHash.
+    Candidates are looked up with locality sensitive hashing over the signature
+    bands, so a lookup does not scan the whole cache.
+
+    Entries expire after the TTL, and the least recently used entries are evicted
+    when the total size of the cached responses exceeds max_bytes.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_bytes: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # normalized query -> (expiration time, signature, response)
+        self._entries = collections.OrderedDict()
+        # (band index, band) -> set of normalized queries
+        self._bands = collections.defaultdict(set)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _band_keys(signature: tuple):
+        rows = _MINHASH_NUM_PERM // _MINHASH_NUM_BANDS
+        return [
+            (i, signature[i * rows : (i + 1) * rows]) for i in range(_MINHASH_NUM_BANDS)
+        ]
+
+    def get(self, query: str) -> Optional[str]:
+        """
+        Returns the cached response of the most similar query above the threshold,
+        or None if there is no such query.
+        """
+        normalized = normalize_query(query)
+        signature = minhash_signature(query_shingles(query))
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates.update(self._bands.get(band_key, ()))
+            best, best_similarity = None, self.threshold
+            for candidate in candidates:
+                expires, candidate_signature, _ = self._entries[candidate]
+                if expires <= now:
+                    self._pop(candidate, "ttl")
+                    continue
+                if candidate == normalized:
+                    best = candidate
+                    break
+                similarity = sum(
+                    x == y for x, y in zip(signature, candidate_signature)
+                ) / _MINHASH_NUM_PERM
+                if similarity >= best_similarity:
+                    best, best_similarity = candidate, similarity
+            if best is not None:
+                self._entries.move_to_end(best)
+                _answer_cache_hits.inc()
+                return self._entries[best][2]
+        _answer_cache_misses.inc()
+        return None
+
+    def put(self, query: str, response: str):
+        """
+        Caches the complete stream response of the query.
+        """
+        size = len(response)
+        if size > self.max_bytes:
+            return
+        normalized = normalize_query(query)
+        signature = minhash_signature(query_shingles(query))
+        with self._lock:
+            if normalized in self._entries:
+                self._pop(normalized, "replaced")
+            self._entries[normalized] = (time.time() + self.ttl, signature, response)
+            for band_key in self._band_keys(signature):
+                self._bands[band_key].add(normalized)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)), "size")
+
+    def _pop(self, normalized: str, reason: str):
+        _, signature, response = self._entries.pop(normalized)
+        for band_key in self._band_keys(signature):
+            band = self._bands[band_key]
+            band.discard(normalized)
+            if not band:
+                del self._bands[band_key]
+        self._bytes -= len(response)
+        if reason != "replaced":
+            _answer_cache_evictions.labels(reason).inc()
@@ -0,0 +1,159 @@
+"""
+The packing of the search results into the prompt, within a token budget.
+"""
+
+import collections
+import math
+import re
+from typing import List, Optional
+
+from prometheus_client import Counter
+
+WORD_RE = re.compile(r"\w+")
+
+# Snippets whose words overlap by at least this much are near-duplicates.
+_NEAR_DUPLICATE_JACCARD = 0.8
+
+# Parameters of the BM25 scorer, and of the reciprocal rank fusion of the search
+# rank with the BM25 rank. The usual k of 60 is for long lists: with a handful of
+# snippets, a small k lets the BM25 rank actually matter.
+BM25_K1 = 1.2
+BM25_B = 0.75
+_RRF_K = 5
+
+# Snippets are only truncated to fit the budget if at least this many tokens of
+# them would remain. Otherwise they are dropped.
+_MIN_SNIPPET_TOKENS = 32
+
+_packed_snippets = Counter(
+    "rag_packed_snippets_total",
+    "Number of search result snippets by what context packing did with them.",
+    ["outcome"],
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A fast estimate of the number of tokens of a text, without a tokenizer:
+    about four characters per token for ascii text, and one token per character
+    otherwise, which is what most tokenizers do for CJK.
+    """
+    # Non-ascii characters take 2 to 4 bytes in utf-8, mostly 3 for CJK.
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncates the text at a word boundary so that it fits in max_tokens.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Starts from the ascii estimate, and shortens until it fits.
+    end = min(len(text), max_tokens * 4)
+    while end > 0 and estimate_tokens(text[:end]) > max_tokens:
+        end = int(end * 0.9)
+    cut = text.rfind(" ", 0, end)
+    return text[: cut if cut > end // 2 else end].rstrip() + "..."
+
+
+def bm25_scores(query: str, documents: List[str]) -> List[float]:
+    """
+    Scores the documents against the query with BM25, where the document
+    frequencies are computed over the documents themselves.
+    """
+    terms = set(WORD_RE.findall(query.casefold()))
+    tokenized = [WORD_RE.findall(d.casefold()) for d in documents]
+    if not terms or not tokenized:
+        return [0.0] * len(documents)
+    average_length = sum(len(t) for t in tokenized) / len(tokenized) or 1
+    frequencies = [collections.Counter(t) for t in tokenized]
+    idf = {}
+    for term in terms:
+        df = sum(1 for f in frequencies if term in f)
+        idf[term] = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+    scores = []
+    for tokens, frequency in zip(tokenized, frequencies):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / average_length)
+        scores.append(
+            sum(
+                idf[t] * frequency[t] * (BM25_K1 + 1) / (frequency[t] + norm)
+                for t in terms
+                if t in frequency
+            )
+        )
+    return scores
+
+
+def select_contexts(query: str, contexts: list, rerank: bool = True) -> list:
+    """
+    Drops the search results with duplicated urls or near-identical snippets, and
+    reranks the rest by fusing the rank of the search engine with their BM25
+    rank.
+    """
+    unique, seen_urls, seen_words = [], set(), []
+    for c in contexts:
+        snippet = c.get("snippet") or ""
+        url = (c.get("url") or "").rstrip("/")
+        words = set(WORD_RE.findall(snippet.casefold()))
+        if not words or (url and url in seen_urls):
+            _packed_snippets.labels("duplicate").inc()
+            continue
+        if any(
+            len(words & w) >= _NEAR_DUPLICATE_JACCARD * len(words | w)
+            for w in seen_words
+        ):
+            _packed_snippets.labels("duplicate").inc()
+            continue
+        seen_urls.add(url)
+        seen_words.append(words)
+        unique.append(c)
+    if rerank and len(unique) > 1:
+        # Reciprocal rank fusion of the search rank and the BM25 rank.
+        scores = bm25_scores(query, [c["snippet"] for c in unique])
+        bm25_rank = {
+            i: r
+            for r, i in enumerate(
+                sorted(range(len(unique)), key=lambda i: -scores[i])
+            )
+        }
+        fused = sorted(
+            range(len(unique)),
+            key=lambda i: -(1 / (_RRF_K + i) + 1 / (_RRF_K + bm25_rank[i])),
+        )
+        unique = [unique[i] for i in fused]
+    return unique
+
+
+def build_context_text(
+    contexts: list, token_budget: int, passages: Optional[dict] = None
+):
+    """
+    Builds the context text of the prompts from the contexts, in order, until the
+    token budget is exhausted, the last one possibly truncated. A token_budget of
+    0 means no budget. If passages, a dict from url to text, is given, the
+    passage of each context is appended to its snippet.
+
+    Returns the contexts that made it, which are always a prefix of the given
+    ones so that the citation numbers match them, and the context text.
+    """
+    packed, parts, used = [], [], 0
+    for c in contexts:
+        citation = f"[[citation:{len(packed) + 1}]] "
+        text = c["snippet"]
+        if passages and passages.get(c.get("url")):
+            text = f"{text}\n{passages[c['url']]}"
+        if token_budget > 0:
+            remaining = token_budget - used - estimate_tokens(citation)
+            if estimate_tokens(text) > remaining:
+                if remaining < _MIN_SNIPPET_TOKENS:
+                    break
+                text = truncate_to_tokens(text, remaining)
+                _packed_snippets.labels("truncated").inc()
+        part = citation + text
+        used += estimate_tokens(part)
+        parts.append(part)
+        packed.append(c)
+    _packed_snippets.labels("dropped").inc(len(contexts) - len(packed))
+    _packed_snippets.labels("packed").inc(len(packed))
+    return packed, "\n\n".join(parts)
@@ -0,0 +1,113 @@
+"""
+The delegation of the queries to the hosted search api, for BACKEND=LEPTON.
+"""
+
+import codecs
+from typing import AsyncGenerator, Optional
+
+from fastapi import HTTPException
+import httpx
+from loguru import logger
+from prometheus_client import Counter
+
+from .search import (
+    ASYNC_MAX_CONNECTIONS,
+    ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+    SearchBackend,
+)
+from .upstream import Upstream, UpstreamUnavailable
+
+_delegated_queries = Counter(
+    "rag_delegated_queries_total",
+    "Number of queries delegated to the hosted search api, by outcome: streamed,"
+    " or the status of the error returned by the api.",
+    ["outcome"],
+)
+
+
+class DelegateProxy(object):
+    """
+    Proxies the queries to the hosted search api, which runs the same code as this
+    photon, over a pooled async client. The api is an upstream like the search
+    engines, with its rate limit, retries and circuit breaker, and the responses
+    are streamed back as they come, so that no thread is held while the answer is
+    generated.
+    """
+
+    def __init__(self, url: str, token: Optional[str], timeout: float, upstream: Upstream):
+        self.url = url.rstrip("/")
+        self.upstream = upstream
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {token}"} if token else {},
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(timeout, connect=10, pool=10),
+        )
+
+    async def warm_up(self):
+        """
+        Opens a connection to the api.
+        """
+        await self.client.get(f"{self.url}/healthz")
+
+    async def _send(self, body: dict) -> httpx.Response:
+        request = self.client.build_request("POST", f"{self.url}/query", json=body)
+        response = await self.client.send(request, stream=True)
+        if response.status_code != 200:
+            # The errors are short, and reading them releases the connection.
+            await response.aread()
+        return response
+
+    async def query(
+        self, query: str, search_uuid: str, generate_related_questions: bool
+    ) -> httpx.Response:
+        """
+        Sends the query, and returns the streamed response once its status is 200.
+        The errors of the api are raised as an HTTPException, or as
+        UpstreamUnavailable if the api is throttling or failing.
+        """
+        body = {
+            "query": query,
+            "search_uuid": search_uuid,
+            "generate_related_questions": generate_related_questions,
+        }
+        try:
+            response = await self.upstream.async_call(
+                lambda: self._send(body), SearchBackend._classify
+            )
+        except UpstreamUnavailable:
+            _delegated_queries.labels("unavailable").inc()
+            raise
+        except httpx.HTTPError as e:
+            _delegated_queries.labels("error").inc()
+            logger.error(f"Search api error: {e}")
+            raise HTTPException(504 if isinstance(e, httpx.TimeoutException) else 502)
+        if response.status_code != 200:
+            _delegated_queries.labels(str(response.status_code)).inc()
+            logger.error(f"Search api error: {response.status_code} {response.text}")
+            # The errors of the request itself are passed on, the others are
+            # errors of the gateway.
+            status_code = response.status_code if 400 <= response.status_code < 500 else 502
+            raise HTTPException(status_code, "Search api error.")
+        _delegated_queries.labels("streamed").inc()
+        return response
+
+    @staticmethod
+    async def iter_text(response: httpx.Response) -> AsyncGenerator[str, None]:
+        """
+        Yields the text of a response returned by query, and closes it, which also
+        cancels the query in the api if the response is not complete.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            async for data in response.aiter_bytes():
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            text = decoder.decode(b"", final=True)
+            if text:
+                yield text
+        finally:
+            await response.aclose()
@@ -0,0 +1,198 @@
+"""
+The single-flight de-duplication of concurrent identical queries.
+"""
+
+import asyncio
+import threading
+import time
+from typing import AsyncGenerator, List, Optional
+
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+from .store import TAIL_TIMEOUT
+
+single_flight_requests = Counter(
+    "rag_single_flight_requests_total",
+    "Number of queries by their role in single-flight de-duplication.",
+    ["role"],
+)
+_single_flight_bytes = Gauge(
+    "rag_single_flight_bytes",
+    "Total size of the in-flight responses buffered for their followers.",
+)
+
+
+def resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StreamBroadcast(object):
+    """
+    An in-memory fan-out buffer of a stream response. The producer appends chunks
+    to it from any thread, and any number of followers read all the chunks from
+    the beginning on the event loop, so that everyone gets identical bytes and
+    no follower holds a thread.
+    """
+
+    def __init__(self, keys: List[str]):
+        self.keys = keys
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.finished_at = None
+        self.updated_at = time.time()
+        # The number of requests following the stream, or waiting to.
+        self.followers = 0
+        self._lock = threading.Lock()
+        # (event loop, future) of the followers waiting for new chunks.
+        self._async_waiters = []
+
+    def _wake(self):
+        # Must be called with the lock held.
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(resolve_future, future)
+        self._async_waiters = []
+
+    def append(self, chunk):
+        with self._lock:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.updated_at = time.time()
+            self._wake()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self.finished_at = time.time()
+            self._wake()
+
+    def _ready(self, index: int) -> bool:
+        return len(self.chunks) > index or self.done
+
+    def add_follower(self):
+        with self._lock:
+            self.followers += 1
+
+    def remove_follower(self):
+        with self._lock:
+            self.followers -= 1
+
+    async def async_wait(self, index: int, timeout: float) -> bool:
+        """
+        Waits until there are more than index chunks, or the stream is done.
+        Returns False on timeout.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._ready(index):
+                return True
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self._ready(index)
+
+    def value(self) -> str:
+        return "".join(
+            c.decode() if isinstance(c, bytes) else c for c in self.chunks
+        )
+
+    async def async_follow(self) -> AsyncGenerator[str, None]:
+        """
+        Yields all the chunks of the stream, from the beginning.
+        """
+        index = 0
+        while await self.async_wait(index, TAIL_TIMEOUT):
+            chunks = self.chunks[index:]
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if self.done and index == len(self.chunks):
+                return
+        logger.error(f"Timed out while following {self.keys[0]}.")
+
+
+class SingleFlight(object):
+    """
+    Coordinates concurrent requests for the same search uuid or the same
+    normalized query: the first request becomes the producer of a StreamBroadcast,
+    and the later ones follow it instead of paying for another search and LLM
+    call.
+
+    Finished broadcasts are kept for a short while, so that requests arriving
+    right after the end of the stream, before the result is in the KV, are still
+    served from memory. Failed broadcasts are dropped right away, so that the next
+    request becomes a new producer. If the buffered responses exceed max_bytes,
+    finished broadcasts are dropped first, and new requests are not de-duplicated
+    until memory is available again.
+    """
+
+    def __init__(self, max_bytes: int, linger: float = 10):
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self._flights = {}
+        self._lock = threading.Lock()
+        _single_flight_bytes.set_function(self.size)
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(b.size for b in set(self._flights.values()))
+
+    def _collect(self, force: bool = False):
+        # Must be called with the lock held.
+        now = time.time()
+        for key, broadcast in list(self._flights.items()):
+            if broadcast.done:
+                expired = force or now - broadcast.finished_at > self.linger
+                if broadcast.error is None and not expired:
+                    continue
+            elif now - broadcast.updated_at <= TAIL_TIMEOUT:
+                continue
+            # Failed, expired, or stalled, for example because the stream was
+            # never started.
+            del self._flights[key]
+
+    def get(self, key: str) -> Optional[StreamBroadcast]:
+        """
+        Returns the broadcast of key, if there is one.
+        """
+        with self._lock:
+            self._collect()
+            return self._flights.get(key)
+
+    def join(self, keys: List[str]):
+        """
+        Returns the broadcast of any of the keys and False if there is one.
+        Otherwise, returns a new broadcast registered under all the keys and True,
+        in which case the caller is the producer and must finish the broadcast.
+        Under memory pressure, returns None and True.
+        """
+        with self._lock:
+            self._collect()
+            for key in keys:
+                if key in self._flights:
+                    broadcast = self._flights[key]
+                    # Later requests for any of the keys follow the same one.
+                    for k in keys:
+                        self._flights.setdefault(k, broadcast)
+                    return broadcast, False
+            size = sum(b.size for b in set(self._flights.values()))
+            if size > self.max_bytes:
+                self._collect(force=True)
+                size = sum(b.size for b in set(self._flights.values()))
+                if size > self.max_bytes:
+                    single_flight_requests.labels("bypass").inc()
+                    return None, True
+            broadcast = StreamBroadcast(keys)
+            for key in keys:
+                self._flights[key] = broadcast
+        single_flight_requests.labels("producer").inc()
+        return broadcast, True
@@ -0,0 +1,612 @@
+"""
+The local search index of BACKEND=LOCAL: an on-disk inverted index over a corpus
+of documents, and the command line that builds it.
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import fcntl
+import hashlib
+import heapq
+import html as htmllib
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from typing import List, Optional
+
+import anyio
+import httpx
+from loguru import logger
+import requests
+
+from .search import (
+    REFERENCE_COUNT,
+    SearchBackend,
+    SearchResult,
+    register_search_backend,
+)
+from .context import BM25_B, BM25_K1, WORD_RE
+from .pages import MIN_PASSAGE_WORDS, html_to_text
+
+# The query of the warm-up, which reads pages of the index.
+_WARM_UP_QUERY = "Who said 'live long and prosper'?"
+
+# The local index is a directory of immutable segments listed in manifest.json, so
+# that documents can be added without rebuilding the index. Each segment holds:
+#   docs.bin, docs.off: the passages as json [name, url, text], and their offsets
+#       (uint64, one more than the number of passages).
+#   terms.bin, terms.off: the sorted utf-8 terms, and their offsets (uint64).
+#   terms.post: the offsets of the postings of each term (uint64, one more than
+#       the number of terms).
+#   postings.doc, postings.imp: the passage ids (uint32) and the BM25 weights of
+#       the term in them (float32). The postings of each term are sorted by
+#       decreasing weight, so that a query only needs to read their head.
+#   urls.hash, urls.doc: the sorted hashes of the urls of the passages (uint64),
+#       and the matching passage ids (uint32), to find the passages of a url.
+# The passages of a url that is added again or deleted are tombstoned in a
+# deleted-N.u32 file listed in the manifest. Arrays are in native byte order.
+_LOCAL_INDEX_FILES = (
+    "docs.bin",
+    "docs.off",
+    "terms.bin",
+    "terms.off",
+    "terms.post",
+    "postings.doc",
+    "postings.imp",
+    "urls.hash",
+    "urls.doc",
+)
+_LOCAL_INDEX_EXTENSIONS = (".txt", ".md", ".html", ".htm")
+_HTML_TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title\s*>", re.IGNORECASE | re.DOTALL)
+# How many words of the best window of a passage make its snippet.
+_LOCAL_SNIPPET_WORDS = 48
+# However many segments there are, each query term reads at least this many
+# postings of each of them.
+_LOCAL_MIN_POSTINGS = 256
+
+
+def _url_hash(url: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def _write_array(path: str, typecode: str, values):
+    with open(path, "wb") as f:
+        array.array(typecode, values).tofile(f)
+
+
+def build_segment(directory: str, passages: List[tuple]):
+    """
+    Writes the passages, given as (name, url, text) tuples, to a new segment
+    directory.
+    """
+    os.makedirs(directory)
+    postings = collections.defaultdict(lambda: (array.array("I"), array.array("H")))
+    lengths = array.array("I")
+    offsets = array.array("Q", [0])
+    with open(os.path.join(directory, "docs.bin"), "wb") as f:
+        for doc_id, (name, url, text) in enumerate(passages):
+            record = json.dumps([name, url, text], ensure_ascii=False).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+            tokens = WORD_RE.findall(f"{name} {text}".casefold())
+            lengths.append(len(tokens))
+            for term, tf in collections.Counter(tokens).items():
+                docs, tfs = postings[term]
+                docs.append(doc_id)
+                tfs.append(min(tf, 65535))
+    _write_array(os.path.join(directory, "docs.off"), "Q", offsets)
+
+    average_length = sum(lengths) / max(1, len(lengths)) or 1
+    norms = [BM25_K1 * (1 - BM25_B + BM25_B * n / average_length) for n in lengths]
+    terms = sorted((term.encode("utf-8"), term) for term in postings)
+    term_offsets = array.array("Q", [0])
+    posting_offsets = array.array("Q", [0])
+    with open(os.path.join(directory, "postings.doc"), "wb") as doc_file, open(
+        os.path.join(directory, "postings.imp"), "wb"
+    ) as weight_file:
+        for encoded, term in terms:
+            docs, tfs = postings.pop(term)
+            weights = [
+                tf * (BM25_K1 + 1) / (tf + norms[doc]) for doc, tf in zip(docs, tfs)
+            ]
+            order = sorted(range(len(docs)), key=weights.__getitem__, reverse=True)
+            array.array("I", [docs[i] for i in order]).tofile(doc_file)
+            array.array("f", [weights[i] for i in order]).tofile(weight_file)
+            term_offsets.append(term_offsets[-1] + len(encoded))
+            posting_offsets.append(posting_offsets[-1] + len(docs))
+    with open(os.path.join(directory, "terms.bin"), "wb") as f:
+        for encoded, _ in terms:
+            f.write(encoded)
+    _write_array(os.path.join(directory, "terms.off"), "Q", term_offsets)
+    _write_array(os.path.join(directory, "terms.post"), "Q", posting_offsets)
+
+    urls = sorted((_url_hash(url), doc_id) for doc_id, (_, url, _) in enumerate(passages))
+    _write_array(os.path.join(directory, "urls.hash"), "Q", (h for h, _ in urls))
+    _write_array(os.path.join(directory, "urls.doc"), "I", (d for _, d in urls))
+
+
+class LocalSegment(object):
+    """
+    A segment of the local index, memory-mapped read-only.
+    """
+
+    def __init__(self, directory: str, deleted: Optional[str] = None):
+        self.directory = directory
+        self.docs = self._map("docs.bin")
+        self.doc_offsets = self._map("docs.off", "Q")
+        self.terms = self._map("terms.bin")
+        self.term_offsets = self._map("terms.off", "Q")
+        self.term_postings = self._map("terms.post", "Q")
+        self.posting_docs = self._map("postings.doc", "I")
+        self.posting_weights = self._map("postings.imp", "f")
+        self.url_hashes = self._map("urls.hash", "Q")
+        self.url_docs = self._map("urls.doc", "I")
+        self.deleted = set()
+        if deleted:
+            with open(deleted, "rb") as f:
+                self.deleted.update(array.array("I", f.read()))
+
+    def _map(self, name: str, typecode: Optional[str] = None) -> memoryview:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                view = memoryview(b"")
+            else:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return view.cast(typecode) if typecode else view
+
+    def __len__(self) -> int:
+        return len(self.doc_offsets) - 1
+
+    def _term(self, i: int) -> bytes:
+        return bytes(self.terms[self.term_offsets[i] : self.term_offsets[i + 1]])
+
+    def postings(self, term: bytes) -> Optional[tuple]:
+        """
+        Returns the (start, end) offsets of the postings of the term, or None if
+        the term is not in the segment.
+        """
+        num_terms = len(self.term_postings) - 1
+        lo, hi = 0, num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < num_terms and self._term(lo) == term:
+            return self.term_postings[lo], self.term_postings[lo + 1]
+        return None
+
+    def passage(self, doc_id: int) -> list:
+        """
+        Returns [name, url, text] of a passage.
+        """
+        return json.loads(
+            bytes(self.docs[self.doc_offsets[doc_id] : self.doc_offsets[doc_id + 1]])
+        )
+
+    def passages_of(self, url: str) -> List[int]:
+        """
+        Returns the ids of the passages of a url.
+        """
+        url_hash = _url_hash(url)
+        i = bisect.bisect_left(self.url_hashes, url_hash)
+        ids = []
+        while i < len(self.url_hashes) and self.url_hashes[i] == url_hash:
+            ids.append(self.url_docs[i])
+            i += 1
+        return ids
+
+    def live_passages(self):
+        """
+        Yields the passages that are not deleted, as (name, url, text) tuples.
+        """
+        for doc_id in range(len(self)):
+            if doc_id not in self.deleted:
+                yield tuple(self.passage(doc_id))
+
+
+def query_snippet(weights: dict, text: str, max_words: int = _LOCAL_SNIPPET_WORDS) -> str:
+    """
+    Returns the window of max_words words of the text where the query terms, given
+    as a dict from term to weight, weigh the most.
+    """
+    words = text.split()
+    if len(words) <= max_words:
+        return text
+    prefix = [0.0]
+    for word in words:
+        prefix.append(
+            prefix[-1] + sum(weights.get(t, 0.0) for t in WORD_RE.findall(word.casefold()))
+        )
+    start = max(
+        range(len(words) - max_words + 1),
+        key=lambda i: prefix[i + max_words] - prefix[i],
+    )
+    end = start + max_words
+    return (
+        ("... " if start > 0 else "")
+        + " ".join(words[start:end])
+        + (" ..." if end < len(words) else "")
+    )
+
+
+class LocalIndex(object):
+    """
+    Searches the local index. Each query term only reads the head of its postings
+    lists, up to max_postings postings split among the segments: as the postings
+    are sorted by weight, these are the passages where the term weighs the most,
+    which bounds the latency of a query whatever the size of the index.
+
+    The manifest is checked for updates every refresh_interval seconds, so that
+    the segments added by `python search_with_lepton.py index add` are picked up
+    without a restart.
+    """
+
+    def __init__(self, directory: str, max_postings: int = 2000, refresh_interval: float = 5):
+        self.directory = directory
+        self.max_postings = max_postings
+        self.refresh_interval = refresh_interval
+        self.segments = ()
+        self.num_passages = 0
+        self._manifest_mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False):
+        """
+        Reloads the segments if the manifest changed.
+        """
+        now = time.time()
+        if not force and now - self._checked_at < self.refresh_interval:
+            return
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.stat(os.path.join(self.directory, "manifest.json")).st_mtime_ns
+            except FileNotFoundError:
+                if force:
+                    logger.warning(f"No local index in {self.directory}.")
+                return
+            if mtime == self._manifest_mtime:
+                return
+            try:
+                manifest = read_manifest(self.directory)
+                segments = tuple(
+                    LocalSegment(
+                        os.path.join(self.directory, s["name"]),
+                        s["deleted"] and os.path.join(self.directory, s["deleted"]),
+                    )
+                    for s in manifest["segments"]
+                )
+            except Exception as e:
+                # The index is being compacted: the next refresh will do.
+                logger.error(f"Cannot load the local index: {e}")
+                return
+            # Readers hold on to the segments they started with.
+            self.segments = segments
+            self.num_passages = sum(len(s) - len(s.deleted) for s in segments)
+            self._manifest_mtime = mtime
+            logger.info(
+                f"Loaded the local index: {len(segments)} segments, {self.num_passages} passages."
+            )
+        finally:
+            self._lock.release()
+
+    def search(self, query: str, count: int = REFERENCE_COUNT) -> List[SearchResult]:
+        """
+        Returns the passages that best match the query according to BM25, at most
+        one per url.
+        """
+        self.refresh()
+        segments = self.segments
+        terms = set(WORD_RE.findall(query.casefold()))
+        if not segments or not terms:
+            return []
+        limit = max(_LOCAL_MIN_POSTINGS, self.max_postings // len(segments))
+        scores = {}
+        weights = {}
+        for term in terms:
+            ranges = [s.postings(term.encode("utf-8")) for s in segments]
+            df = sum(r[1] - r[0] for r in ranges if r is not None)
+            if df == 0:
+                continue
+            idf = math.log(1 + (self.num_passages - df + 0.5) / (df + 0.5))
+            weights[term] = idf
+            for i, (segment, r) in enumerate(zip(segments, ranges)):
+                if r is None:
+                    continue
+                start, end = r[0], min(r[1], r[0] + limit)
+                base = i << 32
+                for doc_id, weight in zip(
+                    segment.posting_docs[start:end].tolist(),
+                    segment.posting_weights[start:end].tolist(),
+                ):
+                    key = base | doc_id
+                    scores[key] = scores.get(key, 0.0) + idf * weight
+        results, seen = [], set()
+        for key in heapq.nlargest(count * 4, scores, key=scores.__getitem__):
+            segment, doc_id = segments[key >> 32], key & 0xFFFFFFFF
+            if doc_id in segment.deleted:
+                continue
+            name, url, text = segment.passage(doc_id)
+            if url in seen:
+                continue
+            seen.add(url)
+            results.append(SearchResult(name, url, query_snippet(weights, text)))
+            if len(results) == count:
+                break
+        return results
+
+
+def read_manifest(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": 1, "next_id": 1, "segments": []}
+
+
+def chunk_passages(text: str, passage_words: int) -> List[str]:
+    """
+    Splits a document into passages of passage_words words.
+    """
+    words = text.split()
+    passages = [
+        " ".join(words[i : i + passage_words]) for i in range(0, len(words), passage_words)
+    ]
+    # A short tail is merged into the previous passage.
+    if len(passages) > 1 and len(passages[-1].split()) < MIN_PASSAGE_WORDS:
+        passages[-2] += " " + passages.pop()
+    return passages
+
+
+def read_documents(path: str, base_url: Optional[str] = None):
+    """
+    Yields the (name, url, text) documents of a JSONL dump, whose lines have a url
+    and a text (or content), and optionally a name (or title), or of a directory of
+    text, markdown and html files, whose urls are their paths under base_url, or
+    file:// urls.
+    """
+    if not os.path.isdir(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                text = doc.get("text") or doc.get("content") or ""
+                yield doc.get("name") or doc.get("title") or doc["url"], doc["url"], text
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            if not file_name.lower().endswith(_LOCAL_INDEX_EXTENSIONS):
+                continue
+            file_path = os.path.join(root, file_name)
+            with open(file_path, encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            if file_name.lower().endswith((".html", ".htm")):
+                title = _HTML_TITLE_RE.search(content)
+                text = html_to_text(content)
+                name = htmllib.unescape(title.group(1)).strip() if title else ""
+            else:
+                text = content
+                name = next((l.strip("# ").strip() for l in text.splitlines() if l.strip()), "")
+            relative = os.path.relpath(file_path, path).replace(os.sep, "/")
+            url = (
+                f"{base_url.rstrip('/')}/{relative}"
+                if base_url
+                else "file://" + os.path.abspath(file_path)
+            )
+            yield name[:200] or file_name, url, text
+
+
+class LocalIndexWriter(object):
+    """
+    Updates the local index: documents are added as new segments, and the
+    passages of the urls that are added again or deleted are tombstoned in the
+    older segments. The manifest is replaced atomically once an update is done, so
+    that readers only ever see complete updates. Only one writer can update the
+    index at a time.
+    """
+
+    def __init__(self, directory: str, passage_words: int = 160, segment_passages: int = 100000):
+        self.directory = directory
+        self.passage_words = passage_words
+        self.segment_passages = segment_passages
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "lock"), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self.manifest = read_manifest(directory)
+
+    def close(self):
+        self._lock_file.close()
+
+    def _new_segment(self, passages: List[tuple]) -> dict:
+        name = f"segment-{self.manifest['next_id']:06d}"
+        self.manifest["next_id"] += 1
+        build_segment(os.path.join(self.directory, name), passages)
+        return {"name": name, "passages": len(passages), "deleted": None}
+
+    def _tombstone(self, segments: List[dict], urls: set):
+        for entry in segments:
+            segment = LocalSegment(
+                os.path.join(self.directory, entry["name"]),
+                entry["deleted"] and os.path.join(self.directory, entry["deleted"]),
+            )
+            ids = {doc_id for url in urls for doc_id in segment.passages_of(url)}
+            if ids - segment.deleted:
+                path = f"{entry['name']}/deleted-{self.manifest['next_id']:06d}.u32"
+                self.manifest["next_id"] += 1
+                _write_array(
+                    os.path.join(self.directory, path), "I", sorted(segment.deleted | ids)
+                )
+                entry["deleted"] = path
+
+    def _commit(self):
+        path = os.path.join(self.directory, "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def add(self, documents) -> int:
+        """
+        Adds the (name, url, text) documents, replacing the ones with the same url
+        that are already in the index. Returns the number of passages added.
+        """
+        old_segments = list(self.manifest["segments"])
+        passages, urls, total = [], set(), 0
+        for name, url, text in documents:
+            urls.add(url)
+            for passage in chunk_passages(text, self.passage_words):
+                passages.append((name, url, passage))
+            if len(passages) >= self.segment_passages:
+                self.manifest["segments"].append(self._new_segment(passages))
+                total += len(passages)
+                passages = []
+        if passages:
+            self.manifest["segments"].append(self._new_segment(passages))
+            total += len(passages)
+        self._tombstone(old_segments, urls)
+        self._commit()
+        return total
+
+    def delete(self, urls: List[str]):
+        """
+        Deletes the documents of the given urls.
+        """
+        self._tombstone(self.manifest["segments"], set(urls))
+        self._commit()
+
+    def compact(self):
+        """
+        Rewrites the live passages of all the segments into as few segments as
+        possible, and removes the files that are no longer used.
+        """
+        passages, segments = [], []
+        for entry in self.manifest["segments"]:
+            segment = LocalSegment(
+                os.path.join(self.directory, entry["name"]),
+                entry["deleted"] and os.path.join(self.directory, entry["deleted"]),
+            )
+            for passage in segment.live_passages():
+                passages.append(passage)
+                if len(passages) >= self.segment_passages:
+                    segments.append(self._new_segment(passages))
+                    passages = []
+        if passages:
+            segments.append(self._new_segment(passages))
+        self.manifest["segments"] = segments
+        self._commit()
+        # Readers keep the removed files mapped until they reload the manifest.
+        names = {entry["name"] for entry in segments}
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name not in names:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+@register_search_backend
+class LocalSearch(SearchBackend):
+    """
+    The local index in LOCAL_INDEX_DIR, built with
+    `python search_with_lepton.py index add`.
+    """
+
+    name = "LOCAL"
+
+    def __init__(self, index: LocalIndex):
+        self.index = index
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            LocalIndex(
+                os.environ["LOCAL_INDEX_DIR"],
+                max_postings=int(os.environ["LOCAL_INDEX_MAX_POSTINGS"]),
+            )
+        )
+
+    def warm_up(self, session: requests.Session):
+        # Pages in the index.
+        self.index.search(_WARM_UP_QUERY)
+
+    async def async_warm_up(self, client: httpx.AsyncClient):
+        await anyio.to_thread.run_sync(self.warm_up, None)
+
+    def search(self, query: str, session: Optional[requests.Session] = None) -> list:
+        return [r.to_dict() for r in self.index.search(query)]
+
+    async def async_search(self, query: str, client: httpx.AsyncClient) -> list:
+        return await anyio.to_thread.run_sync(self.search, query)
+
+
+def local_index_main(argv: List[str]):
+    """
+    The command line interface of the local index:
+
+        python search_with_lepton.py index add DIRECTORY_OR_JSONL...
+        python search_with_lepton.py index delete URL...
+        python search_with_lepton.py index compact
+        python search_with_lepton.py index search QUERY
+    """
+    parser = argparse.ArgumentParser(
+        prog="search_with_lepton.py index",
+        description="Builds and updates the local search index of BACKEND=LOCAL.",
+    )
+    parser.add_argument(
+        "--index", default=os.environ.get("LOCAL_INDEX_DIR", "local_index")
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser(
+        "add", help="Adds directories of documents or JSONL dumps to the index."
+    )
+    add.add_argument("paths", nargs="+")
+    add.add_argument("--base-url", help="The url of the documents of directories.")
+    add.add_argument("--passage-words", type=int, default=160)
+    add.add_argument("--segment-passages", type=int, default=100000)
+    delete = commands.add_parser("delete", help="Deletes documents by url.")
+    delete.add_argument("urls", nargs="+")
+    commands.add_parser("compact", help="Merges the segments of the index.")
+    search = commands.add_parser("search", help="Searches the index.")
+    search.add_argument("query")
+    args = parser.parse_args(argv)
+
+    if args.command == "search":
+        index = LocalIndex(args.index)
+        start = time.time()
+        results = index.search(args.query)
+        print(json.dumps([r.to_dict() for r in results], indent=2, ensure_ascii=False))
+        print(f"{len(results)} results in {(time.time() - start) * 1000:.1f}ms")
+        return
+    writer = LocalIndexWriter(
+        args.index,
+        passage_words=getattr(args, "passage_words", 160),
+        segment_passages=getattr(args, "segment_passages", 100000),
+    )
+    try:
+        start = time.time()
+        if args.command == "add":
+            for path in args.paths:
+                count = writer.add(read_documents(path, args.base_url))
+                print(f"Added {count} passages from {path}.")
+        elif args.command == "delete":
+            writer.delete(args.urls)
+        else:
+            writer.compact()
+        print(
+            f"{len(writer.manifest['segments'])} segments, done in {time.time() - start:.1f}s."
+        )
+    finally:
+        writer.close()
@@ -0,0 +1,557 @@
+"""
+The pooled clients of the LLM endpoints, and the routing of the LLM calls across
+models.
+"""
+
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+from .upstream import (
+    CircuitBreaker,
+    Upstream,
+    UpstreamUnavailable,
+    classify_llm_call,
+)
+
+# The connection limits of each pooled LLM client. With HTTP/2, many concurrent
+# streams are multiplexed over a single connection.
+LLM_MAX_CONNECTIONS = 64
+LLM_MAX_KEEPALIVE_CONNECTIONS = 64
+
+
+################################################################################
+# Connection pooling for the LLM endpoints.
+################################################################################
+
+try:
+    import h2  # noqa: F401
+
+    _http2_available = True
+except ImportError:
+    # httpx needs the h2 package for HTTP/2, otherwise we stay with HTTP/1.1.
+    _http2_available = False
+
+_llm_client_pool_hits = Counter(
+    "rag_llm_client_pool_hits_total",
+    "Number of times an LLM client is reused from the pool.",
+    ["base_url"],
+)
+_llm_client_pool_misses = Counter(
+    "rag_llm_client_pool_misses_total",
+    "Number of times an LLM client is created by the pool.",
+    ["base_url"],
+)
+_llm_client_pool_open_connections = Gauge(
+    "rag_llm_client_pool_open_connections",
+    "Number of open connections held by the LLM client pool.",
+)
+
+
+def _open_connections(http_client) -> int:
+    """
+    Returns the number of connections currently held by the httpx client.
+    """
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    return len(getattr(pool, "connections", ()))
+
+
+class LLMClientPool(object):
+    """
+    A pool of openai clients keyed by base url. openai clients are thread safe, so
+    a single client per endpoint is shared by all the handler threads, and its
+    connections are kept alive across requests. Steady-state requests therefore
+    do not open new connections to the LLM endpoint. The clients do not retry, as
+    the calls are retried by their Upstream.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_MAX_KEEPALIVE_CONNECTIONS,
+    ):
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        # We will set the connect timeout to be 10 seconds, and read/write
+        # timeout to be 120 seconds, in case the inference server is
+        # overloaded.
+        self.timeout = httpx.Timeout(connect=10, read=120, write=120, pool=10)
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+        _llm_client_pool_open_connections.set_function(self.open_connections)
+
+    def _get(self, clients: dict, base_url: str, create):
+        try:
+            client = clients[base_url]
+        except KeyError:
+            with self._lock:
+                client = clients.get(base_url)
+                if client is None:
+                    _llm_client_pool_misses.labels(base_url).inc()
+                    client = create()
+                    clients[base_url] = client
+                    return client
+        _llm_client_pool_hits.labels(base_url).inc()
+        return client
+
+    def get(self, base_url: str):
+        """
+        Gets the openai.OpenAI client of the given endpoint.
+        """
+        import openai
+
+        return self._get(
+            self._clients,
+            base_url,
+            lambda: openai.OpenAI(
+                base_url=base_url,
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=httpx.Client(
+                    limits=self.limits, http2=_http2_available
+                ),
+            ),
+        )
+
+    def get_async(self, base_url: str):
+        """
+        Gets the openai.AsyncOpenAI client of the given endpoint.
+        """
+        import openai
+
+        return self._get(
+            self._async_clients,
+            base_url,
+            lambda: openai.AsyncOpenAI(
+                base_url=base_url,
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=self.limits, http2=_http2_available
+                ),
+            ),
+        )
+
+    def warm_up(self, base_url: str):
+        """
+        Creates the client of the given endpoint and opens a connection to it,
+        with a call that generates nothing. Its response does not matter.
+        """
+        import openai
+
+        client = self.get(base_url)
+        # The chat resources are loaded on their first use.
+        _ = client.chat.completions
+        try:
+            client.models.list()
+        except openai.APIStatusError as e:
+            logger.debug(f"Warm-up call of {base_url}: {e}")
+
+    async def async_warm_up(self, base_url: str):
+        """
+        The async version of warm_up.
+        """
+        import openai
+
+        client = self.get_async(base_url)
+        _ = client.chat.completions
+        try:
+            await client.models.list()
+        except openai.APIStatusError as e:
+            logger.debug(f"Warm-up call of {base_url}: {e}")
+
+    def open_connections(self) -> int:
+        """
+        Returns the number of open connections across all the pooled clients.
+        """
+        clients = list(self._clients.values()) + list(self._async_clients.values())
+        return sum(_open_connections(c._client) for c in clients)
+
+
+################################################################################
+# Routing of the LLM calls across models.
+################################################################################
+
+_llm_route_calls = Counter(
+    "rag_llm_route_calls_total",
+    "Number of LLM calls sent to each model of a router, by outcome.",
+    ["router", "model", "outcome"],
+)
+_llm_route_fallbacks = Counter(
+    "rag_llm_route_fallbacks_total",
+    "Number of LLM calls sent to a model after the models before it failed.",
+    ["router", "model"],
+)
+_llm_route_ttft = Gauge(
+    "rag_llm_route_ttft_seconds",
+    "Moving average of the time to first chunk of each model of a router.",
+    ["router", "model"],
+)
+_llm_route_error_rate = Gauge(
+    "rag_llm_route_error_rate",
+    "Moving average of the error rate of each model of a router.",
+    ["router", "model"],
+)
+
+
+class ModelRoute(object):
+    """
+    A model of a ModelRouter and its endpoint, with the moving averages of its
+    time to first chunk and of its error rate.
+    """
+
+    def __init__(self, model: str, base_url: str, upstream: Upstream):
+        self.model = model
+        self.base_url = base_url
+        self.upstream = upstream
+        # None until the first successful call.
+        self.ttft = None
+        self.error_rate = 0.0
+
+
+class ModelRouter(object):
+    """
+    Sends the LLM calls of one kind, such as the answers or the related questions,
+    to a prioritized list of models. The models are tried from the one with the
+    lowest expected time to first chunk, which is its moving average divided by
+    its moving average success rate, and inflated by priority_penalty per rank so
+    that the preferred models win close calls. Models whose circuit is open are
+    tried last. A fraction explore of the calls try the models in priority order,
+    so that a preferred model that had a bad period gets a chance to recover.
+
+    A call that fails before its first chunk goes to the next model. When there is
+    a next model, a call that has no first chunk route_timeout seconds after it
+    was sent goes to the next model too. Once the first chunk is in, the stream
+    only has the read timeout of the clients, so that a long answer is not cut
+    off between two of its chunks.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        routes: List[ModelRoute],
+        client_pool: "LLMClientPool",
+        route_timeout: float = 10,
+        alpha: float = 0.2,
+        priority_penalty: float = 0.25,
+        explore: float = 0.02,
+        default_ttft: float = 1.0,
+        max_concurrency: int = 64,
+    ):
+        if not routes:
+            raise RuntimeError(f"The {name} router needs at least one model.")
+        self.name = name
+        self.routes = routes
+        self.client_pool = client_pool
+        self.route_timeout = route_timeout
+        self.alpha = alpha
+        self.priority_penalty = priority_penalty
+        self.explore = explore
+        self.default_ttft = default_ttft
+        self._lock = threading.Lock()
+        # The threads that wait for the first chunks of the sync streams, so that
+        # the callers can give up on them at the deadline. The last model is
+        # called on the thread of the caller, so there are none with one model. A
+        # call holds at most one of them at a time, and the threads are started
+        # on demand. When they are all busy, for example with calls given up on
+        # that are still waiting for their first chunk, the wait in the queue
+        # counts towards the deadline, and the call goes to the next model.
+        if len(routes) > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_concurrency,
+                thread_name_prefix=f"{name}-router",
+            )
+        else:
+            self.executor = None
+        for route in routes:
+            _llm_route_ttft.labels(name, route.model).set_function(
+                lambda route=route: route.ttft or 0
+            )
+            _llm_route_error_rate.labels(name, route.model).set_function(
+                lambda route=route: route.error_rate
+            )
+
+    def _cost(self, rank: int, route: ModelRoute) -> tuple:
+        ttft = self.default_ttft if route.ttft is None else route.ttft
+        cost = ttft * (1 + self.priority_penalty * rank)
+        cost /= max(1 - route.error_rate, 0.05)
+        return route.upstream.breaker.state == CircuitBreaker.OPEN, cost
+
+    def order(self) -> List[ModelRoute]:
+        """
+        Returns the models in the order in which to try them for a call.
+        """
+        if random.random() < self.explore:
+            return list(self.routes)
+        ranked = sorted(enumerate(self.routes), key=lambda r: self._cost(*r))
+        return [route for _, route in ranked]
+
+    def request(self, route: ModelRoute, request: dict, last: bool) -> dict:
+        """
+        Returns the keyword arguments of the call to the given model.
+        """
+        request = {**request, "model": route.model}
+        if not last:
+            # The reads keep the timeout of the client, and the wait for the first
+            # chunk is bounded by the deadline of the call instead.
+            timeout = self.client_pool.timeout
+            request["timeout"] = httpx.Timeout(
+                connect=min(timeout.connect, self.route_timeout),
+                read=timeout.read,
+                write=timeout.write,
+                pool=timeout.pool,
+            )
+        return request
+
+    def deadline(self, last: bool) -> Optional[float]:
+        """
+        Returns the seconds a call to a model has to send its first chunk, or None
+        if it is the last model to try.
+        """
+        return None if last else self.route_timeout
+
+    def succeeded(self, route: ModelRoute, ttft: float):
+        _llm_route_calls.labels(self.name, route.model, "ok").inc()
+        with self._lock:
+            if route.ttft is None:
+                route.ttft = ttft
+            else:
+                route.ttft += self.alpha * (ttft - route.ttft)
+            route.error_rate -= self.alpha * route.error_rate
+
+    def failed(self, route: ModelRoute, error: Exception):
+        logger.warning(f"LLM call to {route.model} of the {self.name} router failed: {error}")
+        _llm_route_calls.labels(self.name, route.model, "error").inc()
+        with self._lock:
+            route.error_rate += self.alpha * (1 - route.error_rate)
+
+    def check(self):
+        """
+        Raises UpstreamUnavailable if the circuits of all the models are open, so
+        that a call that would be refused anyway is refused before its response
+        starts.
+        """
+        breakers = [route.upstream.breaker for route in self.routes]
+        if all(b.state == CircuitBreaker.OPEN for b in breakers):
+            retry_after = min(b.retry_after() for b in breakers)
+            if retry_after > 0:
+                raise UpstreamUnavailable(self.name, retry_after)
+
+    def stream(self, request: dict) -> "RoutedStream":
+        """
+        Returns the stream of a streaming chat completion request. The request is
+        only sent when the stream is opened, so that the caller can send
+        something else, such as the sources, first.
+        """
+        self.check()
+        return RoutedStream(self, self.order(), request)
+
+    def async_stream(self, request: dict) -> "AsyncRoutedStream":
+        """
+        The async version of stream.
+        """
+        self.check()
+        return AsyncRoutedStream(self, self.order(), request)
+
+    async def async_complete(self, request: dict):
+        """
+        Sends a chat completion request that is not streamed, and returns its
+        response.
+        """
+        routes = self.order()
+        for index, route in enumerate(routes):
+            if index > 0:
+                _llm_route_fallbacks.labels(self.name, route.model).inc()
+            client = self.client_pool.get_async(route.base_url)
+            arguments = self.request(route, request, index == len(routes) - 1)
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    route.upstream.async_call(
+                        lambda: client.chat.completions.create(**arguments),
+                        classify_llm_call,
+                    ),
+                    self.deadline(index == len(routes) - 1),
+                )
+            except Exception as e:
+                self.failed(route, e)
+                if index == len(routes) - 1:
+                    raise
+                continue
+            self.succeeded(route, time.perf_counter() - start)
+            return response
+
+
+class RoutedStream(object):
+    """
+    The stream of a call routed by a ModelRouter. The request is sent to the
+    models in order until one sends its first chunk, and if a model fails or
+    misses the deadline before its first chunk, the request goes to the next
+    model, so that the caller sees a single stream either way. It is opened with
+    open(0), or on the first iteration.
+    """
+
+    def __init__(self, router: ModelRouter, routes: List[ModelRoute], request: dict):
+        self.router = router
+        self.routes = routes
+        self.request = request
+        self.stream = None
+        self.index = 0
+        self._iterator = None
+        self._first = None
+
+    @property
+    def model(self) -> str:
+        """
+        The model that answers the call.
+        """
+        return self.routes[self.index].model
+
+    def _send(self, route: ModelRoute, arguments: dict) -> tuple:
+        """
+        Sends the request to a model, and returns its stream, the iterator of the
+        stream and its first chunk, which is None if the stream is empty.
+        """
+        client = self.router.client_pool.get(route.base_url)
+        stream = route.upstream.call(
+            lambda: client.chat.completions.create(**arguments), classify_llm_call
+        )
+        try:
+            iterator = iter(stream)
+            return stream, iterator, next(iterator, None)
+        except BaseException:
+            stream.close()
+            raise
+
+    def _send_until(self, route: ModelRoute, arguments: dict, deadline: float) -> tuple:
+        """
+        Calls _send on a thread of the router, and gives up on it after deadline
+        seconds. The stream of a call given up on is closed when it is sent.
+        """
+        future = self.router.executor.submit(self._send, route, arguments)
+        try:
+            return future.result(timeout=deadline)
+        except concurrent.futures.TimeoutError:
+            if not future.cancel():
+                future.add_done_callback(
+                    lambda f: f.exception() is None and f.result()[0].close()
+                )
+            raise TimeoutError(f"No first chunk from {route.model} in {deadline}s.")
+
+    def open(self, index: int):
+        """
+        Sends the request to the models from the one at index, until one sends its
+        first chunk.
+        """
+        for self.index in range(index, len(self.routes)):
+            route, last = self.routes[self.index], self.index == len(self.routes) - 1
+            if self.index > 0:
+                _llm_route_fallbacks.labels(self.router.name, route.model).inc()
+            arguments = self.router.request(route, self.request, last)
+            deadline = self.router.deadline(last)
+            start = time.perf_counter()
+            try:
+                if deadline is None:
+                    sent = self._send(route, arguments)
+                else:
+                    sent = self._send_until(route, arguments, deadline)
+            except Exception as e:
+                self.router.failed(route, e)
+                if last:
+                    raise
+                continue
+            self.stream, self._iterator, self._first = sent
+            self.router.succeeded(route, time.perf_counter() - start)
+            return
+
+    def __iter__(self):
+        if self._iterator is None:
+            self.open(0)
+        if self._first is not None:
+            yield self._first
+            yield from self._iterator
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+class AsyncRoutedStream(object):
+    """
+    The async version of RoutedStream.
+    """
+
+    def __init__(self, router: ModelRouter, routes: List[ModelRoute], request: dict):
+        self.router = router
+        self.routes = routes
+        self.request = request
+        self.stream = None
+        self.index = 0
+        self._iterator = None
+        self._first = None
+
+    @property
+    def model(self) -> str:
+        return self.routes[self.index].model
+
+    async def _send(self, route: ModelRoute, arguments: dict) -> tuple:
+        client = self.router.client_pool.get_async(route.base_url)
+        stream = await route.upstream.async_call(
+            lambda: client.chat.completions.create(**arguments), classify_llm_call
+        )
+        try:
+            iterator = stream.__aiter__()
+            try:
+                first = await iterator.__anext__()
+            except StopAsyncIteration:
+                first = None
+            return stream, iterator, first
+        except BaseException:
+            await stream.close()
+            raise
+
+    async def open(self, index: int):
+        for self.index in range(index, len(self.routes)):
+            route, last = self.routes[self.index], self.index == len(self.routes) - 1
+            if self.index > 0:
+                _llm_route_fallbacks.labels(self.router.name, route.model).inc()
+            arguments = self.router.request(route, self.request, last)
+            start = time.perf_counter()
+            try:
+                sent = await asyncio.wait_for(
+                    self._send(route, arguments), self.router.deadline(last)
+                )
+            except Exception as e:
+                self.router.failed(route, e)
+                if last:
+                    raise
+                continue
+            self.stream, self._iterator, self._first = sent
+            self.router.succeeded(route, time.perf_counter() - start)
+            return
+
+    async def __aiter__(self):
+        if self._iterator is None:
+            await self.open(0)
+        if self._first is not None:
+            yield self._first
+            async for chunk in self._iterator:
+                yield chunk
+
+    async def close(self):
+        if self.stream is not None:
+            await self.stream.close()
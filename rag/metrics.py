@@ -0,0 +1,176 @@
+"""
+The instrumentation of the hot path: the timing of the stages of the queries, and
+the sampling of the slow ones.
+"""
+
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+
+# The stages of a query whose durations are exported: kv_lookup, search, enrich
+# (fetching the pages of the search results, if enabled), prompt,
+# llm_request (until the LLM sends its response headers), llm_first_token (from
+# the LLM request to the first token), llm_stream (from the first token to the
+# last), related_questions and related_questions_wait (how long the stream
+# waits for them after the answer), and kv_upload.
+_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120
+)  # fmt: skip
+stage_seconds = Histogram(
+    "rag_stage_seconds",
+    "Duration of each stage of a query.",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+_time_to_first_token = Histogram(
+    "rag_time_to_first_token_seconds",
+    "Time from the arrival of a query to its first LLM token.",
+    buckets=_LATENCY_BUCKETS,
+)
+query_seconds = Histogram(
+    "rag_query_seconds",
+    "Time from the arrival of a query to the end of its generated response.",
+    buckets=_LATENCY_BUCKETS,
+)
+related_questions_timeouts = Counter(
+    "rag_related_questions_timeouts_total",
+    "Number of related questions given up because they missed their deadline.",
+)
+cancelled_generations = Counter(
+    "rag_cancelled_generations_total",
+    "Number of generations cancelled because their client went away.",
+)
+batch_queries = Counter(
+    "rag_batch_queries_total",
+    "Number of queries of the batches, by how they were answered.",
+    ["status"],
+)
+_llm_tokens_per_second = Histogram(
+    "rag_llm_tokens_per_second",
+    "Decoding speed of the LLM streams, counting one token per stream chunk.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+
+
+class RequestTrace(object):
+    """
+    The timings of the stages of a single query. Each stage is exported to the
+    stage histogram as soon as it ends, and the trace as a whole is kept so that
+    slow queries can be logged with their breakdown.
+    """
+
+    def __init__(self, search_uuid: str):
+        self.search_uuid = search_uuid
+        self.start = time.time()
+        self.stages = {}
+        # The admission permit of the generation, if any.
+        self.permit = None
+        self._llm_start = None
+        self._first_token = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        stage_seconds.labels(name).observe(seconds)
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def start_llm(self):
+        self._llm_start = time.perf_counter()
+
+    def first_token(self):
+        self._first_token = time.perf_counter()
+        _time_to_first_token.observe(time.time() - self.start)
+        if self.permit is not None:
+            self.permit.observe()
+        if self._llm_start is not None:
+            self.observe("llm_first_token", self._first_token - self._llm_start)
+
+    def end_llm(self, num_tokens: int):
+        if self._first_token is None:
+            return
+        seconds = time.perf_counter() - self._first_token
+        self.observe("llm_stream", seconds)
+        if seconds > 0:
+            _llm_tokens_per_second.observe(num_tokens / seconds)
+
+    def release(self):
+        if self.permit is not None:
+            self.permit.release()
+
+    def elapsed(self) -> float:
+        return time.time() - self.start
+
+    def summary(self) -> str:
+        return " ".join(f"{k}={v:.3f}s" for k, v in self.stages.items())
+
+
+# Frames of these files are where idle threads wait, and are not worth reporting.
+_IDLE_FRAME_FILES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+
+
+class StackSampler(object):
+    """
+    A sampling profiler: a daemon thread that records the stacks of all the other
+    threads every interval seconds, and keeps the samples of the last window
+    seconds. It costs nothing to the request threads, and is used to report
+    where the time of slow queries went.
+    """
+
+    def __init__(self, interval: float = 0.01, window: float = 300):
+        self.interval = interval
+        self._samples = collections.deque(maxlen=int(window / interval))
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    @staticmethod
+    def _stack(frame, max_depth: int = 32) -> tuple:
+        stack = []
+        while frame is not None and len(stack) < max_depth:
+            code = frame.f_code
+            stack.append(
+                f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+            )
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or frame.f_code.co_filename.endswith(
+                    _IDLE_FRAME_FILES
+                ):
+                    continue
+                stacks.append(self._stack(frame))
+            self._samples.append((now, stacks))
+
+    def report(self, start: float, end: float, top: int = 10) -> str:
+        """
+        Returns the most frequent stacks sampled between start and end.
+        """
+        counter = collections.Counter()
+        num_samples = 0
+        for timestamp, stacks in list(self._samples):
+            if start <= timestamp <= end:
+                num_samples += 1
+                counter.update(stacks)
+        lines = [f"{num_samples} samples, most frequent stacks:"]
+        for stack, count in counter.most_common(top):
+            lines.append(f"{count:6d} {';'.join(stack)}")
+        return "\n".join(lines)
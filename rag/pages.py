@@ -0,0 +1,271 @@
+"""
+The enrichment of the search results with the text of the pages they link to.
+"""
+
+import asyncio
+import collections
+import hashlib
+import html as htmllib
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+import anyio
+import httpx
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+from .search import ASYNC_MAX_CONNECTIONS, ASYNC_MAX_KEEPALIVE_CONNECTIONS
+from .context import bm25_scores, estimate_tokens
+
+_HTML_DROP_RE = re.compile(
+    r"<(script|style|noscript|svg|head|nav|header|footer|form|iframe)\b.*?</\1\s*>",
+    re.IGNORECASE | re.DOTALL,
+)
+_HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_HTML_BLOCK_RE = re.compile(
+    r"</?(p|div|br|li|tr|h[1-6]|section|article|blockquote|pre|table)\b[^>]*>",
+    re.IGNORECASE,
+)
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+
+# Pages are split into passages of about this many words, and passages shorter
+# than the minimum, such as menus and captions, are ignored.
+_PASSAGE_WORDS = 80
+MIN_PASSAGE_WORDS = 8
+
+_page_fetches = Counter(
+    "rag_page_fetches_total",
+    "Number of pages looked up for enrichment, by outcome.",
+    ["outcome"],
+)
+_page_cache_bytes = Gauge(
+    "rag_page_cache_bytes", "Total size of the pages in the on-disk page cache."
+)
+
+
+def html_to_text(html: str) -> str:
+    """
+    A fast, regex based extraction of the readable text of an html page: scripts,
+    styles and page chrome are dropped, block elements become line breaks, and
+    the other tags are stripped.
+    """
+    html = _HTML_COMMENT_RE.sub(" ", html)
+    html = _HTML_DROP_RE.sub(" ", html)
+    html = _HTML_BLOCK_RE.sub("\n", html)
+    text = htmllib.unescape(_HTML_TAG_RE.sub(" ", html))
+    lines = (_SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def best_passages(query: str, text: str, max_tokens: int) -> str:
+    """
+    Returns the passages of the text that are the most relevant to the query
+    according to BM25, in their original order, within max_tokens.
+    """
+    passages = []
+    for line in text.split("\n"):
+        words = line.split()
+        for i in range(0, len(words), _PASSAGE_WORDS):
+            if len(words) - i >= MIN_PASSAGE_WORDS:
+                passages.append(" ".join(words[i : i + _PASSAGE_WORDS]))
+    if not passages:
+        return ""
+    scores = bm25_scores(query, passages)
+    chosen, used = [], 0
+    for i in sorted(range(len(passages)), key=lambda i: -scores[i]):
+        tokens = estimate_tokens(passages[i])
+        if used + tokens > max_tokens:
+            break
+        chosen.append(i)
+        used += tokens
+    return " ... ".join(passages[i] for i in sorted(chosen))
+
+
+class PageCache(object):
+    """
+    An on-disk cache of the text of the fetched pages, keyed by url, which keeps
+    the ETag of each page so that stale entries are revalidated with a
+    conditional request instead of fetched again. Entries younger than ttl are
+    used without revalidation. When the total size exceeds max_bytes, the least
+    recently used entries are evicted. It is shared by the replicas that share
+    the directory, but each replica only evicts what it knows about.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        # file name -> size, from the least to the most recently used.
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        files = [e for e in os.scandir(directory) if e.name.endswith(".json")]
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            self._entries[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+        _page_cache_bytes.set_function(lambda: self._size)
+
+    @staticmethod
+    def _name(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest() + ".json"
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        Returns the entry of url, with its etag, text and fetched_at, or None.
+        """
+        name = self._name(url)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return entry if entry.get("url") == url else None
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def put(self, url: str, etag: Optional[str], text: str):
+        name = self._name(url)
+        data = json.dumps(
+            {"url": url, "etag": etag, "fetched_at": time.time(), "text": text}
+        )
+        path = os.path.join(self.directory, name)
+        try:
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Page cache error while writing {url}: {e}")
+            return
+        evicted = []
+        with self._lock:
+            self._size += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                old, size = self._entries.popitem(last=False)
+                self._size -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+
+class PageFetcher(object):
+    """
+    Fetches the pages of the top search results concurrently on a pooled async
+    client, and extracts their passages that are the most relevant to the query.
+    Each fetch has its own deadline and size cap, read as a stream, and the whole
+    enrichment has a total deadline after which the pages still on their way are
+    given up.
+    """
+
+    def __init__(
+        self,
+        cache: PageCache,
+        top_k: int,
+        fetch_timeout: float,
+        total_timeout: float,
+        max_bytes: int,
+        passage_tokens: int,
+    ):
+        self.cache = cache
+        self.top_k = top_k
+        self.fetch_timeout = fetch_timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.passage_tokens = passage_tokens
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=fetch_timeout,
+            follow_redirects=True,
+            headers={"User-Agent": "Mozilla/5.0 (compatible; search_with_lepton)"},
+        )
+
+    async def _download(self, url: str, cached: Optional[dict]) -> Optional[str]:
+        headers = {}
+        if cached is not None and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and cached is not None:
+                _page_fetches.labels("not_modified").inc()
+                await anyio.to_thread.run_sync(
+                    self.cache.put, url, cached.get("etag"), cached["text"]
+                )
+                return cached["text"]
+            content_type = response.headers.get("content-type", "")
+            if response.status_code != 200 or not content_type.startswith(
+                ("text/html", "text/plain")
+            ):
+                _page_fetches.labels("error").inc()
+                return None
+            body = bytearray()
+            async for data in response.aiter_bytes():
+                body += data
+                if len(body) >= self.max_bytes:
+                    # Good enough: the beginning of a page is what matters most.
+                    _page_fetches.labels("truncated").inc()
+                    del body[self.max_bytes :]
+                    break
+            html = body.decode(response.encoding or "utf-8", errors="ignore")
+            etag = response.headers.get("etag")
+        text = await anyio.to_thread.run_sync(html_to_text, html)
+        await anyio.to_thread.run_sync(self.cache.put, url, etag, text)
+        _page_fetches.labels("fetched").inc()
+        return text
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """
+        Returns the text of the page at url, from the cache if possible, or None
+        if it cannot be fetched in time.
+        """
+        cached = await anyio.to_thread.run_sync(self.cache.get, url)
+        if cached is not None and self.cache.is_fresh(cached):
+            _page_fetches.labels("cache_hit").inc()
+            return cached["text"]
+        try:
+            return await asyncio.wait_for(
+                self._download(url, cached), self.fetch_timeout
+            )
+        except asyncio.TimeoutError:
+            _page_fetches.labels("timeout").inc()
+        except Exception as e:
+            _page_fetches.labels("error").inc()
+            logger.debug(f"Cannot fetch {url}: {e}")
+        return None
+
+    async def enrich(self, query: str, contexts: list) -> dict:
+        """
+        Returns the best passages of the pages of the top_k contexts, as a dict
+        from url to passage, for the pages fetched within the total deadline.
+        """
+        urls = [c["url"] for c in contexts[: self.top_k] if c.get("url")]
+        tasks = {asyncio.ensure_future(self.fetch(url)): url for url in urls}
+        if not tasks:
+            return {}
+        done, pending = await asyncio.wait(tasks, timeout=self.total_timeout)
+        for task in pending:
+            task.cancel()
+            _page_fetches.labels("timeout").inc()
+        passages = {}
+        for task in done:
+            text = task.result()
+            if text:
+                passages[tasks[task]] = best_passages(query, text, self.passage_tokens)
+        return passages
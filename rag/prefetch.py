@@ -0,0 +1,147 @@
+"""
+The speculative prefetch of the search results of the related questions.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+from typing import Callable, List, Optional
+
+from loguru import logger
+from prometheus_client import Counter
+
+from .cache import normalize_query
+from .upstream import TokenBucket
+
+prefetches = Counter(
+    "rag_prefetches_total",
+    "Number of related questions considered for a prefetch of their search"
+    " results, by outcome: started, or skipped because they were cached, the"
+    " prefetch workers were busy, the budget was spent or the queries were queued,"
+    " or failed.",
+    ["outcome"],
+)
+_prefetch_results = Counter(
+    "rag_prefetch_results_total",
+    "Number of prefetched search results, by whether a query used them (hit), or"
+    " they expired or were evicted unused.",
+    ["outcome"],
+)
+_prefetch_wasted_seconds = Counter(
+    "rag_prefetch_wasted_search_seconds_total",
+    "Time spent searching for prefetched results that no query used.",
+)
+
+
+class Prefetcher(object):
+    """
+    Searches the related questions of the answers in the background, so that when
+    the user clicks one of them, its query finds the search results ready. The
+    results are kept for ttl seconds by normalized query, and taken by the first
+    query that asks for them.
+
+    The prefetches run on a pool of their own, at most rate per second, and are
+    dropped rather than queued when the pool is busy, so that they never compete
+    with the queries for the search engine.
+    """
+
+    def __init__(
+        self,
+        search: Callable[[str], list],
+        ttl: float,
+        max_entries: int,
+        workers: int,
+        rate: float,
+        is_cached: Optional[Callable[[str], bool]] = None,
+        fetch_pages: Optional[Callable[[str, list], None]] = None,
+    ):
+        self.search = search
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.workers = workers
+        # Bursts of the five related questions of an answer are allowed.
+        self.budget = TokenBucket(rate, burst=max(rate, 5), max_wait=0)
+        self.is_cached = is_cached
+        self.fetch_pages = fetch_pages
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="prefetch"
+        )
+        # normalized query -> (expiration time, search seconds, contexts), in the
+        # order of expiration.
+        self._entries = collections.OrderedDict()
+        # The normalized queries being searched.
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def prefetch(self, queries: List[str]):
+        """
+        Starts the prefetch of the search results of the queries. It does not
+        block.
+        """
+        for query in queries:
+            key = normalize_query(query)
+            if self.is_cached is not None and self.is_cached(query):
+                prefetches.labels("cached").inc()
+                continue
+            with self._lock:
+                self._expire()
+                if key in self._entries or key in self._pending:
+                    prefetches.labels("cached").inc()
+                    continue
+                if len(self._pending) >= self.workers:
+                    prefetches.labels("busy").inc()
+                    continue
+                if self.budget.reserve() is None:
+                    prefetches.labels("budget").inc()
+                    continue
+                self._pending.add(key)
+            prefetches.labels("started").inc()
+            self.executor.submit(self._prefetch, query, key)
+
+    def _prefetch(self, query: str, key: str):
+        start = time.perf_counter()
+        try:
+            contexts = self.search(query)
+            if contexts and self.fetch_pages is not None:
+                self.fetch_pages(query, contexts)
+        except Exception as e:
+            logger.debug(f"Prefetch of {query!r} failed: {e}")
+            prefetches.labels("failed").inc()
+            contexts = None
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self._pending.discard(key)
+            if not contexts:
+                return
+            self._entries[key] = (time.time() + self.ttl, seconds, contexts)
+            while len(self._entries) > self.max_entries:
+                self._waste(self._entries.popitem(last=False)[1], "evicted")
+
+    def _expire(self):
+        # Must be called with the lock held.
+        now = time.time()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                return
+            del self._entries[key]
+            self._waste(entry, "expired")
+
+    @staticmethod
+    def _waste(entry: tuple, reason: str):
+        _prefetch_results.labels(reason).inc()
+        _prefetch_wasted_seconds.inc(entry[1])
+
+    def take(self, query: str) -> Optional[list]:
+        """
+        Returns the prefetched search results of the query, or None if there are
+        none.
+        """
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(normalize_query(query), None)
+        if entry is None:
+            return None
+        _prefetch_results.labels("hit").inc()
+        return entry[2]
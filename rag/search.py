@@ -0,0 +1,751 @@
+"""
+The search engine backends, which normalize the responses of the search engines
+into the contexts of the prompt, and the search over several backends at once.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from fastapi import HTTPException
+import httpx
+from loguru import logger
+from prometheus_client import Counter, Histogram
+import requests
+
+from .upstream import (
+    RETRIABLE_STATUS_CODES,
+    Upstream,
+    default_scheduler,
+    parse_retry_after,
+)
+
+# Search engine related. You don't really need to change this.
+BING_SEARCH_V7_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
+BING_MKT = "en-US"
+GOOGLE_SEARCH_ENDPOINT = "https://customsearch.googleapis.com/customsearch/v1"
+SERPER_SEARCH_ENDPOINT = "https://google.serper.dev/search"
+SEARCHAPI_SEARCH_ENDPOINT = "https://www.searchapi.io/api/v1/search"
+
+# Specify the number of references from the search engine you want to use.
+# 8 is usually a good number.
+REFERENCE_COUNT = 8
+
+# Specify the default timeout for the search engine. If the search engine
+# does not respond within this time, we will return an error.
+DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
+
+# In the async mode, the search engine calls share a long-lived, keep-alive async
+# client. These are the connection limits of that client.
+ASYNC_MAX_CONNECTIONS = 512
+ASYNC_MAX_KEEPALIVE_CONNECTIONS = 128
+
+
+################################################################################
+# Search engine backends.
+################################################################################
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    # orjson decodes the search responses several times faster, but the standard
+    # json module does the job too.
+    _json_loads = json.loads
+
+
+def search_session(pool_maxsize: int = ASYNC_MAX_KEEPALIVE_CONNECTIONS) -> requests.Session:
+    """
+    Creates the requests.Session shared by the search engine calls of the threaded
+    mode, so that their connections are kept alive across queries.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=8, pool_maxsize=pool_maxsize
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# The session of the search_with_* functions, created by their first call.
+_default_search_session = None
+_default_search_session_lock = threading.Lock()
+
+
+def default_search_session() -> requests.Session:
+    """
+    Returns the module-level session shared by the search_with_* functions, so
+    that their connections are reused across calls like the ones of the photon.
+    """
+    global _default_search_session
+    with _default_search_session_lock:
+        if _default_search_session is None:
+            _default_search_session = search_session()
+        return _default_search_session
+
+
+class SearchResult(object):
+    """
+    A search result, normalized from the response of any of the search engines.
+    Only the fields that the prompts and the UI use are kept, rather than the
+    whole json objects of the search engines.
+    """
+
+    __slots__ = ("name", "url", "snippet", "image")
+
+    def __init__(self, name: str, url: str, snippet: str, image: Optional[dict] = None):
+        self.name = name
+        self.url = url
+        self.snippet = snippet
+        self.image = image
+
+    def to_dict(self) -> dict:
+        """
+        Returns the context dict that is passed to the rest of the pipeline and
+        streamed to the UI.
+        """
+        context = {
+            # The UI keys the sources by id, which is stable across the search
+            # engines and the replays of a result.
+            "id": hashlib.sha1(self.url.encode("utf-8")).hexdigest()[:16],
+            "name": self.name,
+            "url": self.url,
+            "snippet": self.snippet,
+        }
+        if self.image:
+            context["primaryImageOfPage"] = self.image
+        return context
+
+
+class SearchBackend(object):
+    """
+    A search engine. Subclasses build the request of a query and parse the json
+    response into SearchResult records, while sending the request, the timeout,
+    the retries and the error handling are shared by all of them.
+
+    Subclasses are registered with register_search_backend under their name, which
+    is the value of the BACKEND env variable that selects them.
+
+    The calls go through the Upstream of the backend, which rate limits them,
+    retries them and fails them fast while the search engine is unhealthy.
+    """
+
+    name = None
+    # Seconds before the search engine call is given up.
+    timeout = DEFAULT_SEARCH_ENGINE_TIMEOUT
+    # How many times a failed call is retried.
+    retries = 1
+    retry_backoff = 0.1
+    _upstream = None
+
+    @property
+    def upstream(self) -> "Upstream":
+        """
+        The Upstream the calls go through. Unless it is set, for example by the
+        RAG photon, the backend gets one from a default scheduler without rate
+        limits.
+        """
+        if self._upstream is None:
+            self._upstream = default_scheduler.upstream(
+                self.name, self.retries, self.retry_backoff
+            )
+        return self._upstream
+
+    @upstream.setter
+    def upstream(self, upstream: "Upstream"):
+        self._upstream = upstream
+
+    def deadline(self) -> float:
+        """
+        The longest a search can take through the upstream of the backend, with
+        the timeout of each attempt and the waits before and between them.
+        """
+        return self.upstream.max_duration(self.timeout)
+
+    @classmethod
+    def from_env(cls) -> "SearchBackend":
+        """
+        Creates the backend with the credentials in the env variables.
+        """
+        raise NotImplementedError
+
+    def request(self, query: str) -> dict:
+        """
+        Returns the keyword arguments of the request of the query, without the
+        timeout.
+        """
+        raise NotImplementedError
+
+    def parse(self, json_content: dict) -> List[SearchResult]:
+        """
+        Converts the json response to search results, best first.
+        """
+        raise NotImplementedError
+
+    def contexts(self, content: bytes) -> list:
+        """
+        Decodes the response body, and returns the contexts of the top
+        REFERENCE_COUNT search results.
+        """
+        json_content = _json_loads(content)
+        try:
+            results = self.parse(json_content)
+        except (KeyError, TypeError):
+            logger.error(f"Error encountered: {json_content}")
+            return []
+        return [r.to_dict() for r in results[:REFERENCE_COUNT] if r.url]
+
+    @staticmethod
+    def _classify(response, error: Optional[Exception]) -> Optional[tuple]:
+        """
+        The classify function of the search engine calls, for Upstream.call.
+        Connection errors and timeouts are retried, but the responses with a
+        status that says that the request itself is wrong are not.
+        """
+        if isinstance(error, requests.RequestException):
+            return isinstance(error, (requests.ConnectionError, requests.Timeout)), None
+        if isinstance(error, httpx.TransportError):
+            return True, None
+        if error is None and response.status_code in RETRIABLE_STATUS_CODES:
+            return True, parse_retry_after(response.headers.get("Retry-After"))
+        return None
+
+    def _check(self, status_code: int, text: str):
+        if not 200 <= status_code < 300:
+            logger.error(f"{status_code} {text}")
+            raise HTTPException(status_code, "Search engine error.")
+
+    def warm_up(self, session: requests.Session):
+        """
+        Opens a connection to the search engine in the session, so that the first
+        search does not pay for it. The request has no query and no credentials,
+        so it is not a billed search, and its response does not matter.
+        """
+        session.head(self.request("")["url"], timeout=self.timeout)
+
+    async def async_warm_up(self, client: httpx.AsyncClient):
+        """
+        The async version of warm_up.
+        """
+        await client.head(self.request("")["url"], timeout=self.timeout)
+
+    def search(self, query: str, session: Optional[requests.Session] = None) -> list:
+        """
+        Searches the query and returns the contexts. The request is sent over the
+        given session, so that its connections are reused.
+        """
+        request = self.request(query)
+        response = self.upstream.call(
+            lambda: (session or requests).request(**request, timeout=self.timeout),
+            self._classify,
+        )
+        self._check(response.status_code, response.text)
+        return self.contexts(response.content)
+
+    async def async_search(self, query: str, client: httpx.AsyncClient) -> list:
+        """
+        The async version of search, which sends the request over a shared,
+        keep-alive httpx.AsyncClient.
+        """
+        request = self.request(query)
+        response = await self.upstream.async_call(
+            lambda: client.request(**request, timeout=self.timeout), self._classify
+        )
+        self._check(response.status_code, response.text)
+        return self.contexts(response.content)
+
+
+# The registered search backends, by name.
+SEARCH_BACKENDS = {}
+
+
+def register_search_backend(cls):
+    """
+    Registers a SearchBackend subclass under its name, so that it can be selected
+    with the BACKEND and MULTI_SEARCH_BACKENDS env variables.
+    """
+    SEARCH_BACKENDS[cls.name] = cls
+    return cls
+
+
+def _result_count() -> int:
+    # Serper and SearchApi.io only support multiples of 10.
+    return (
+        REFERENCE_COUNT
+        if REFERENCE_COUNT % 10 == 0
+        else (REFERENCE_COUNT // 10 + 1) * 10
+    )
+
+
+@register_search_backend
+class BingSearch(SearchBackend):
+    """
+    The Bing Web Search API v7.
+    """
+
+    name = "BING"
+
+    def __init__(self, subscription_key: str):
+        self.subscription_key = subscription_key
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"])
+
+    def request(self, query: str) -> dict:
+        return {
+            "method": "GET",
+            "url": BING_SEARCH_V7_ENDPOINT,
+            "headers": {"Ocp-Apim-Subscription-Key": self.subscription_key},
+            "params": {"q": query, "mkt": BING_MKT},
+        }
+
+    def parse(self, json_content: dict) -> List[SearchResult]:
+        return [
+            SearchResult(
+                v["name"], v["url"], v.get("snippet", ""), v.get("primaryImageOfPage")
+            )
+            for v in json_content["webPages"]["value"]
+        ]
+
+
+@register_search_backend
+class GoogleSearch(SearchBackend):
+    """
+    The Google Programmable Search Engine.
+    """
+
+    name = "GOOGLE"
+
+    def __init__(self, subscription_key: str, cx: str):
+        self.subscription_key = subscription_key
+        self.cx = cx
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ["GOOGLE_SEARCH_API_KEY"], os.environ["GOOGLE_SEARCH_CX"])
+
+    def request(self, query: str) -> dict:
+        return {
+            "method": "GET",
+            "url": GOOGLE_SEARCH_ENDPOINT,
+            "params": {
+                "key": self.subscription_key,
+                "cx": self.cx,
+                "q": query,
+                "num": REFERENCE_COUNT,
+            },
+        }
+
+    def parse(self, json_content: dict) -> List[SearchResult]:
+        return [
+            SearchResult(item["title"], item["link"], item.get("snippet", ""))
+            for item in json_content["items"]
+        ]
+
+
+@register_search_backend
+class SerperSearch(SearchBackend):
+    """
+    Google search through Serper.
+    """
+
+    name = "SERPER"
+
+    def __init__(self, subscription_key: str):
+        self.subscription_key = subscription_key
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ["SERPER_SEARCH_API_KEY"])
+
+    def request(self, query: str) -> dict:
+        return {
+            "method": "POST",
+            "url": SERPER_SEARCH_ENDPOINT,
+            "headers": {
+                "X-API-KEY": self.subscription_key,
+                "Content-Type": "application/json",
+            },
+            "json": {"q": query, "num": _result_count()},
+        }
+
+    def parse(self, json_content: dict) -> List[SearchResult]:
+        results = []
+        knowledge_graph = json_content.get("knowledgeGraph")
+        if knowledge_graph:
+            url = knowledge_graph.get("descriptionUrl") or knowledge_graph.get("website")
+            snippet = knowledge_graph.get("description")
+            if url and snippet:
+                results.append(
+                    SearchResult(knowledge_graph.get("title", ""), url, snippet)
+                )
+        answer_box = json_content.get("answerBox")
+        if answer_box:
+            url = answer_box.get("url")
+            snippet = answer_box.get("snippet") or answer_box.get("answer")
+            if url and snippet:
+                results.append(SearchResult(answer_box.get("title", ""), url, snippet))
+        results += [
+            SearchResult(c["title"], c["link"], c.get("snippet", ""))
+            for c in json_content["organic"]
+        ]
+        return results
+
+
+@register_search_backend
+class SearchApiSearch(SearchBackend):
+    """
+    Google search through SearchApi.io.
+    """
+
+    name = "SEARCHAPI"
+    timeout = 30
+
+    def __init__(self, subscription_key: str):
+        self.subscription_key = subscription_key
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ["SEARCHAPI_API_KEY"])
+
+    def request(self, query: str) -> dict:
+        return {
+            "method": "GET",
+            "url": SEARCHAPI_SEARCH_ENDPOINT,
+            "headers": {
+                "Authorization": f"Bearer {self.subscription_key}",
+                "Content-Type": "application/json",
+            },
+            "params": {"q": query, "engine": "google", "num": _result_count()},
+        }
+
+    def parse(self, json_content: dict) -> List[SearchResult]:
+        results = []
+        answer_box = json_content.get("answer_box")
+        if answer_box:
+            if answer_box.get("organic_result"):
+                title = answer_box["organic_result"].get("title", "")
+                url = answer_box["organic_result"].get("link", "")
+            elif answer_box.get("type") == "population_graph":
+                title = answer_box.get("place", "")
+                url = answer_box.get("explore_more_link", "")
+            else:
+                title = answer_box.get("title", "")
+                url = answer_box.get("link")
+            snippet = answer_box.get("answer") or answer_box.get("snippet")
+            if url and snippet:
+                results.append(SearchResult(title, url, snippet))
+        knowledge_graph = json_content.get("knowledge_graph")
+        if knowledge_graph:
+            # The source is where the description comes from.
+            url = (knowledge_graph.get("source") or {}).get(
+                "link"
+            ) or knowledge_graph.get("website", "")
+            snippet = knowledge_graph.get("description")
+            if url and snippet:
+                results.append(
+                    SearchResult(knowledge_graph.get("title", ""), url, snippet)
+                )
+        results += [
+            SearchResult(c["title"], c["link"], c.get("snippet", ""))
+            for c in json_content["organic_results"]
+        ]
+        for question in json_content.get("related_questions") or []:
+            url = (question.get("source") or {}).get("link", "")
+            snippet = question.get("answer", "")
+            if url and snippet:
+                results.append(SearchResult(question.get("question", ""), url, snippet))
+        return results
+
+
+def search_with_bing(query: str, subscription_key: str):
+    """
+    Search with bing and return the contexts.
+    """
+    return BingSearch(subscription_key).search(query, default_search_session())
+
+
+def search_with_google(query: str, subscription_key: str, cx: str):
+    """
+    Search with google and return the contexts.
+    """
+    return GoogleSearch(subscription_key, cx).search(query, default_search_session())
+
+
+def search_with_serper(query: str, subscription_key: str):
+    """
+    Search with serper and return the contexts.
+    """
+    return SerperSearch(subscription_key).search(query, default_search_session())
+
+
+def search_with_searchapi(query: str, subscription_key: str):
+    """
+    Search with SearchApi.io and return the contexts.
+    """
+    return SearchApiSearch(subscription_key).search(query, default_search_session())
+
+
+################################################################################
+# Searching with multiple backends.
+################################################################################
+
+_search_latency = Histogram(
+    "rag_search_latency_seconds",
+    "Latency of the search engine calls.",
+    ["backend"],
+    buckets=(0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30),
+)
+_search_hedges = Counter(
+    "rag_search_hedges_total",
+    "Number of hedged search engine calls, fired because the previous backends were slow.",
+    ["backend"],
+)
+_search_wins = Counter(
+    "rag_search_wins_total",
+    "Number of search queries answered by each backend in the MULTI mode.",
+    ["backend"],
+)
+
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent latencies of an upstream, to estimate its quantiles.
+    """
+
+    def __init__(self, window: int = 256):
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def quantile(self, q: float, default: float) -> float:
+        """
+        Returns the q-th quantile of the recent latencies, or default if there are
+        too few of them to tell.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return default
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def merge_contexts(results: List[list]) -> list:
+    """
+    Merges the contexts of several backends by interleaving them by rank, drops
+    duplicated urls and keeps the first REFERENCE_COUNT ones.
+    """
+    merged, seen = [], set()
+    for rank in range(max((len(r) for r in results), default=0)):
+        for contexts in results:
+            if rank >= len(contexts):
+                continue
+            url = contexts[rank]["url"].rstrip("/")
+            if url in seen:
+                continue
+            seen.add(url)
+            merged.append(contexts[rank])
+    return merged[:REFERENCE_COUNT]
+
+
+class MultiSearch(object):
+    """
+    Queries several search backends for the same query, so that a slow or failing
+    backend does not stall the request. Three modes are supported:
+        - hedge: queries the backends in order, firing the next one only if the
+            previous ones have not answered within the hedge delay. The first
+            non-empty result wins.
+        - race: queries all the backends at once, and the first non-empty result
+            wins.
+        - merge: queries all the backends at once, and merges the results
+            returned before the slowest backend times out, retries included,
+            deduplicated by url.
+
+    The hedge delay of each backend is the p95 of its recent latencies, so it
+    adapts to how the backend is doing.
+    """
+
+    def __init__(
+        self,
+        backends: dict,
+        mode: str,
+        executor: concurrent.futures.Executor,
+        hedge_quantile: float = 0.95,
+        default_hedge_delay: float = 1.0,
+        min_hedge_delay: float = 0.05,
+    ):
+        if mode not in ("hedge", "race", "merge"):
+            raise RuntimeError("MULTI_SEARCH_MODE must be hedge, race or merge.")
+        if not backends:
+            raise RuntimeError("MULTI_SEARCH_BACKENDS must not be empty.")
+        # name -> SearchBackend
+        self.backends = backends
+        self.mode = mode
+        self.executor = executor
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.latencies = {name: LatencyTracker() for name in backends}
+
+    def hedge_delay(self, name: str) -> float:
+        """
+        Returns how long to wait for the given backend before firing the next one.
+        """
+        if self.mode != "hedge":
+            return 0
+        return max(
+            self.min_hedge_delay,
+            self.latencies[name].quantile(self.hedge_quantile, self.default_hedge_delay),
+        )
+
+    def _record(self, name: str, start: float):
+        latency = time.time() - start
+        self.latencies[name].record(latency)
+        _search_latency.labels(name).observe(latency)
+
+    def _search_one(self, name: str, query: str, session: Optional[requests.Session]):
+        start = time.time()
+        result = self.backends[name].search(query, session)
+        self._record(name, start)
+        return result
+
+    async def _async_search_one(self, name: str, query: str, client: httpx.AsyncClient):
+        start = time.time()
+        result = await self.backends[name].async_search(query, client)
+        self._record(name, start)
+        return result
+
+    def search(self, query: str, session: Optional[requests.Session] = None):
+        """
+        Searches the query with the configured backends.
+        """
+        names = list(self.backends)
+        futures = {}
+        results = {}
+        last_error = None
+        # The backends that are still running are waited for until the slowest
+        # of them times out, retries included.
+        deadline = 0.0
+
+        def fire():
+            nonlocal deadline
+            name = names.pop(0)
+            deadline = max(deadline, time.monotonic() + self.backends[name].deadline())
+            if futures:
+                _search_hedges.labels(name).inc()
+            futures[self.executor.submit(self._search_one, name, query, session)] = name
+
+        try:
+            fire()
+            while self.mode != "hedge" and names:
+                fire()
+            while futures:
+                timeout = max(deadline - time.monotonic(), 0)
+                if self.mode == "hedge" and names:
+                    last = futures[next(reversed(futures))]
+                    timeout = min(timeout, self.hedge_delay(last))
+                done, _ = concurrent.futures.wait(
+                    futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                if not done:
+                    if self.mode == "hedge" and names:
+                        fire()
+                        continue
+                    break
+                for future in done:
+                    name = futures.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.error(f"Search backend {name} failed: {e}")
+                        last_error = e
+                        continue
+                    if results[name] and self.mode != "merge":
+                        _search_wins.labels(name).inc()
+                        return results[name]
+                if not futures and names:
+                    fire()
+        finally:
+            # Calls that are already running cannot be interrupted: they finish in
+            # the background, and their latencies are still recorded.
+            for future in futures:
+                future.cancel()
+        return self._finish(results, last_error)
+
+    async def async_search(self, query: str, client: httpx.AsyncClient):
+        """
+        The async version of search. Losing backend calls are cancelled.
+        """
+        names = list(self.backends)
+        tasks = {}
+        results = {}
+        last_error = None
+        deadline = 0.0
+
+        def fire():
+            nonlocal deadline
+            name = names.pop(0)
+            deadline = max(deadline, time.monotonic() + self.backends[name].deadline())
+            if tasks:
+                _search_hedges.labels(name).inc()
+            task = asyncio.create_task(self._async_search_one(name, query, client))
+            tasks[task] = name
+
+        try:
+            fire()
+            while self.mode != "hedge" and names:
+                fire()
+            while tasks:
+                timeout = max(deadline - time.monotonic(), 0)
+                if self.mode == "hedge" and names:
+                    last = tasks[next(reversed(tasks))]
+                    timeout = min(timeout, self.hedge_delay(last))
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if self.mode == "hedge" and names:
+                        fire()
+                        continue
+                    break
+                for task in done:
+                    name = tasks.pop(task)
+                    try:
+                        results[name] = task.result()
+                    except Exception as e:
+                        logger.error(f"Search backend {name} failed: {e}")
+                        last_error = e
+                        continue
+                    if results[name] and self.mode != "merge":
+                        _search_wins.labels(name).inc()
+                        return results[name]
+                if not tasks and names:
+                    fire()
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self._finish(results, last_error)
+
+    def _finish(self, results: dict, last_error: Optional[Exception]):
+        if self.mode == "merge" and any(results.values()):
+            for name, contexts in results.items():
+                if contexts:
+                    _search_wins.labels(name).inc()
+            return merge_contexts(
+                [results[name] for name in self.backends if name in results]
+            )
+        if not results and last_error is not None:
+            raise last_error
+        return []
@@ -0,0 +1,659 @@
+"""
+The storage of the results in the KV: their format, the local tiers in front of
+the KV, and the incremental persistence of the answers being generated.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import fcntl
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import AsyncGenerator, Generator, Iterable, List, Optional
+
+import anyio
+from loguru import logger
+from prometheus_client import Counter, Gauge, Histogram
+
+from leptonai.kv import KV
+
+from .metrics import stage_seconds
+
+################################################################################
+# Storage format of the results in the KV.
+################################################################################
+
+try:
+    import zstandard
+except ImportError:
+    # Results are compressed with zlib instead.
+    zstandard = None
+
+# The markers that separate the sections of a stream response.
+LLM_RESPONSE_MARKER = "\n\n__LLM_RESPONSE__\n\n"
+RELATED_QUESTIONS_MARKER = "\n\n__RELATED_QUESTIONS__\n\n"
+
+# A stored result starts with this magic, which cannot start the plain text
+# results of the earlier versions, followed by the version of the format, the
+# codec, the length of the json header, the json header and the sections. The
+# header lists the compressed and raw lengths of the sections, which are
+# compressed separately, so that each of them can be decompressed when it is
+# streamed, and the metadata of the result.
+_RESULT_MAGIC = b"\x00RAG"
+_RESULT_VERSION = 1
+_RESULT_PREFIX = struct.Struct("<4sBBI")
+CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+_ZSTD_LEVEL = 3
+_ZLIB_LEVEL = 6
+# Replays are streamed in chunks of at most this many characters, so that a long
+# answer is not written to the socket in one piece.
+_REPLAY_CHUNK_SIZE = 16384
+
+# zstd compressors are not thread-safe, but are expensive enough to reuse.
+_codec_state = threading.local()
+
+
+def _compress(codec: int, data: bytes) -> bytes:
+    if codec == CODECS["zstd"]:
+        if not hasattr(_codec_state, "compressor"):
+            _codec_state.compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+        return _codec_state.compressor.compress(data)
+    if codec == CODECS["zlib"]:
+        return zlib.compress(data, _ZLIB_LEVEL)
+    return data
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODECS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is needed to read this result.")
+        if not hasattr(_codec_state, "decompressor"):
+            _codec_state.decompressor = zstandard.ZstdDecompressor()
+        return _codec_state.decompressor.decompress(data)
+    if codec == CODECS["zlib"]:
+        return zlib.decompress(data)
+    return data
+
+
+def split_result(result: str) -> List[tuple]:
+    """
+    Splits a stream response into its sources, answer and related questions
+    sections, as (name, text) tuples. The sections that are missing, for example
+    the related questions when they are turned off, are left out.
+    """
+    sources, marker, answer = result.partition(LLM_RESPONSE_MARKER)
+    if not marker:
+        return [("answer", result)]
+    answer, marker, related = answer.partition(RELATED_QUESTIONS_MARKER)
+    sections = [("sources", sources), ("answer", answer)]
+    if marker:
+        sections.append(("related", related))
+    return sections
+
+
+def encode_result(result: str, metadata: Optional[dict] = None, codec: str = "none") -> bytes:
+    """
+    Encodes a stream response for the KV. With the "none" codec, the result is
+    stored as plain text, which is what the earlier versions read.
+    """
+    if codec == "none":
+        return result.encode("utf-8")
+    if codec == "zstd" and zstandard is None:
+        codec = "zlib"
+    codec_id = CODECS[codec]
+    header, bodies = {"sections": [], "metadata": metadata or {}}, []
+    for name, text in split_result(result):
+        raw = text.encode("utf-8")
+        body = _compress(codec_id, raw)
+        header["sections"].append([name, len(body), len(raw)])
+        bodies.append(body)
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    prefix = _RESULT_PREFIX.pack(_RESULT_MAGIC, _RESULT_VERSION, codec_id, len(header))
+    return b"".join([prefix, header, *bodies])
+
+
+def read_result_header(value: bytes) -> Optional[dict]:
+    """
+    Returns the header of a stored result, with its codec, sections and metadata,
+    or None if the result is in the plain text format.
+    """
+    if not value.startswith(_RESULT_MAGIC):
+        return None
+    _, version, codec, length = _RESULT_PREFIX.unpack_from(value)
+    if version != _RESULT_VERSION:
+        raise ValueError(f"Unknown version {version} of the stored result.")
+    header = json.loads(value[_RESULT_PREFIX.size : _RESULT_PREFIX.size + length])
+    header["codec"] = codec
+    header["offset"] = _RESULT_PREFIX.size + length
+    return header
+
+
+def _iter_sections(value: bytes, header: dict) -> Generator[str, None, None]:
+    offset = header["offset"]
+    for name, length, _ in header["sections"]:
+        text = _decompress(header["codec"], value[offset : offset + length]).decode("utf-8")
+        offset += length
+        if name == "sources":
+            yield text + LLM_RESPONSE_MARKER
+        elif name == "related":
+            yield RELATED_QUESTIONS_MARKER + text
+        else:
+            yield text
+
+
+def _iter_chunks(texts: Iterable[str]) -> Generator[str, None, None]:
+    for text in texts:
+        for start in range(0, len(text), _REPLAY_CHUNK_SIZE):
+            yield text[start : start + _REPLAY_CHUNK_SIZE]
+
+
+def iter_result(value: bytes) -> Generator[str, None, None]:
+    """
+    Returns a generator of the stream response of a stored result, in either
+    format, in chunks of at most _REPLAY_CHUNK_SIZE characters. The header is
+    read right away, so that a result that cannot be read fails here rather than
+    in the middle of a response, and the sections are decompressed one at a
+    time, sources first, as they are streamed.
+    """
+    header = read_result_header(value)
+    if header is None:
+        return _iter_chunks([value.decode("utf-8")])
+    if header["codec"] == CODECS["zstd"] and zstandard is None:
+        raise RuntimeError("The zstandard package is needed to read this result.")
+    return _iter_chunks(_iter_sections(value, header))
+
+
+async def async_iter_result(value: bytes) -> AsyncGenerator[str, None]:
+    """
+    The async version of iter_result, for StreamingResponse.
+    """
+    for chunk in iter_result(value):
+        yield chunk
+
+
+def decode_result(value: bytes) -> str:
+    """
+    Returns the stream response of a stored result, in either format.
+    """
+    return "".join(iter_result(value))
+
+
+################################################################################
+# Local tiers of the stored results in front of the KV.
+################################################################################
+
+_result_lookups = Counter(
+    "rag_result_lookups_total",
+    "Number of lookups of stored results, by the tier that answered them.",
+    ["tier"],
+)
+_result_lookup_seconds = Histogram(
+    "rag_result_lookup_seconds",
+    "Latency of the lookups of stored results, by the tier that answered them.",
+    ["tier"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+_result_tier_bytes = Gauge(
+    "rag_result_tier_bytes", "Total size of the results held by each local tier.", ["tier"]
+)
+_result_writes = Counter(
+    "rag_result_writes_total",
+    "Number of writes of complete results to the KV, by outcome: ok, or error, in"
+    " which case the local tiers are not written either.",
+    ["outcome"],
+)
+
+# Each record of the disk tier is this header, the key and the value. The
+# generation of the segment is repeated in each record, so that the records left
+# over from the previous use of a segment are not read back after a restart.
+_DISK_RECORD = struct.Struct("<IIHII")
+_DISK_RECORD_MAGIC = 0x52414752
+_DISK_SEGMENT_HEADER = struct.Struct("<I")
+
+
+class DiskTier(object):
+    """
+    A cache of the results that survives restarts, in two memory-mapped segment
+    files of max_bytes / 2 each. Records are appended to the current segment, and
+    when it is full, the other segment is cleared and becomes the current one, so
+    that the older half of the entries is evicted at once. Entries read from the
+    older segment are copied to the current one, so that the hot ones stay.
+
+    Only one process can use a directory at a time.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise RuntimeError(f"{directory} is used by another process.")
+        self.segment_size = max_bytes // 2
+        self._maps = [self._open(os.path.join(directory, f"segment-{i}")) for i in (0, 1)]
+        self._generations = [_DISK_SEGMENT_HEADER.unpack_from(m)[0] for m in self._maps]
+        self._current = 0 if self._generations[0] >= self._generations[1] else 1
+        # key -> (segment, offset of the value, length of the value)
+        self._index = {}
+        self._ends = [0, 0]
+        self._lock = threading.Lock()
+        # The older segment first, so that the newer records win.
+        for segment in (1 - self._current, self._current):
+            self._ends[segment] = self._scan(segment)
+        _result_tier_bytes.labels("disk").set_function(lambda: sum(self._ends))
+
+    def _open(self, path: str) -> mmap.mmap:
+        with open(path, "a+b") as f:
+            if os.fstat(f.fileno()).st_size != self.segment_size:
+                f.truncate(0)
+                f.truncate(self.segment_size)
+            return mmap.mmap(f.fileno(), self.segment_size)
+
+    def _scan(self, segment: int) -> int:
+        """
+        Indexes the valid records of a segment, and returns where they end.
+        """
+        data, generation = self._maps[segment], self._generations[segment]
+        offset = _DISK_SEGMENT_HEADER.size
+        while offset + _DISK_RECORD.size <= self.segment_size:
+            magic, record_generation, key_length, value_length, crc = (
+                _DISK_RECORD.unpack_from(data, offset)
+            )
+            start = offset + _DISK_RECORD.size
+            end = start + key_length + value_length
+            if (
+                magic != _DISK_RECORD_MAGIC
+                or record_generation != generation
+                or end > self.segment_size
+                or zlib.crc32(data[start:end]) != crc
+            ):
+                break
+            key = data[start : start + key_length].decode("utf-8")
+            self._index[key] = (segment, start + key_length, value_length)
+            offset = end
+        return offset
+
+    def _rotate(self):
+        segment = 1 - self._current
+        generation = max(self._generations) + 1
+        self._index = {k: v for k, v in self._index.items() if v[0] != segment}
+        _DISK_SEGMENT_HEADER.pack_into(self._maps[segment], 0, generation)
+        self._generations[segment] = generation
+        self._ends[segment] = _DISK_SEGMENT_HEADER.size
+        self._current = segment
+
+    def _append(self, key: str, value: bytes):
+        encoded = key.encode("utf-8")
+        size = _DISK_RECORD.size + len(encoded) + len(value)
+        if size > self.segment_size - _DISK_SEGMENT_HEADER.size:
+            return
+        if self._ends[self._current] + size > self.segment_size:
+            self._rotate()
+        segment, offset = self._current, self._ends[self._current]
+        start = offset + _DISK_RECORD.size
+        data = self._maps[segment]
+        data[start : start + len(encoded)] = encoded
+        data[start + len(encoded) : start + len(encoded) + len(value)] = value
+        crc = zlib.crc32(data[start : start + len(encoded) + len(value)])
+        _DISK_RECORD.pack_into(
+            data,
+            offset,
+            _DISK_RECORD_MAGIC,
+            self._generations[segment],
+            len(encoded),
+            len(value),
+            crc,
+        )
+        self._index[key] = (segment, start + len(encoded), len(value))
+        self._ends[segment] = offset + size
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment, offset, length = location
+            value = self._maps[segment][offset : offset + length]
+            if segment != self._current:
+                self._append(key, value)
+            return value
+
+    def put(self, key: str, value: bytes):
+        with self._lock:
+            self._append(key, value)
+
+    def close(self):
+        """
+        Unmaps the segments and releases the directory.
+        """
+        with self._lock:
+            for data in self._maps:
+                data.close()
+            self._lock_file.close()
+
+
+class ResultStore(object):
+    """
+    The stored results, with local tiers in front of the KV: a size-bounded LRU
+    in memory, and optionally a DiskTier. Results are put in the local tiers when
+    they are written and when they are read from the KV, so that a shared link
+    that goes viral is read from the KV once per replica. Keys that are missing
+    from the KV are remembered for negative_ttl seconds, so that repeated lookups
+    of missing keys do not go to the KV either; writing the key forgets it.
+
+    Only the complete results go through the store: the partial results change
+    all the time, and are read from the KV directly.
+    """
+
+    def __init__(
+        self,
+        kv: KV,
+        max_bytes: int,
+        negative_ttl: float,
+        disk: Optional[DiskTier] = None,
+        max_negative_keys: int = 65536,
+    ):
+        self.kv = kv
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.disk = disk
+        self.max_negative_keys = max_negative_keys
+        # key -> value, from the least to the most recently used.
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        # key -> expiration time of the negative entry.
+        self._missing = collections.OrderedDict()
+        self._lock = threading.Lock()
+        _result_tier_bytes.labels("memory").set_function(lambda: self._size)
+
+    def _put_local(self, key: str, value: bytes, disk: bool = True):
+        if len(value) <= self.max_bytes:
+            with self._lock:
+                self._missing.pop(key, None)
+                self._size += len(value) - len(self._entries.pop(key, b""))
+                self._entries[key] = value
+                while self._size > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self._size -= len(old)
+        else:
+            with self._lock:
+                self._missing.pop(key, None)
+        if disk and self.disk is not None:
+            self.disk.put(key, value)
+
+    def get_local(self, key: str) -> Optional[bytes]:
+        """
+        Returns the result from the local tiers, or None if it is not there.
+        Raises KeyError if the key is known to be missing from the KV.
+        """
+        start = time.time()
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            elif key in self._missing:
+                if self._missing[key] > start:
+                    _result_lookups.labels("negative").inc()
+                    raise KeyError(key)
+                del self._missing[key]
+        if value is not None:
+            _result_lookups.labels("memory").inc()
+            _result_lookup_seconds.labels("memory").observe(time.time() - start)
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._put_local(key, value, disk=False)
+                _result_lookups.labels("disk").inc()
+                _result_lookup_seconds.labels("disk").observe(time.time() - start)
+                return value
+        return None
+
+    def get(self, key: str, negative: bool = True) -> bytes:
+        """
+        Returns the result of key like KV.get, from the fastest tier that has it.
+        If negative is False, a key known to be missing is looked up in the KV
+        anyway, for callers that wait for it to appear.
+        """
+        try:
+            value = self.get_local(key)
+        except KeyError:
+            if negative:
+                raise
+            value = None
+        if value is not None:
+            return value
+        start = time.time()
+        try:
+            value = self.kv.get(key)
+        except KeyError:
+            _result_lookups.labels("miss").inc()
+            if self.negative_ttl > 0:
+                with self._lock:
+                    self._missing[key] = time.time() + self.negative_ttl
+                    self._missing.move_to_end(key)
+                    while len(self._missing) > self.max_negative_keys:
+                        self._missing.popitem(last=False)
+            raise
+        _result_lookups.labels("kv").inc()
+        _result_lookup_seconds.labels("kv").observe(time.time() - start)
+        self._put_local(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        """
+        Writes the result to the KV, and then to the local tiers. If the KV write
+        fails, the error is logged and raised, and the local tiers are left alone,
+        so that this replica does not serve a result that the others cannot.
+        """
+        try:
+            self.kv.put(key, value)
+        except Exception as e:
+            _result_writes.labels("error").inc()
+            logger.error(f"KV error while storing the result {key}: {e}")
+            raise
+        _result_writes.labels("ok").inc()
+        self._put_local(key, value)
+
+
+################################################################################
+# Incremental persistence of the stream responses.
+################################################################################
+
+# While a response is being generated, the part generated so far is stored in the
+# KV under the search uuid with this prefix, so that other viewers of the same
+# search uuid can tail it. The search uuids cannot contain a "/", so they never
+# collide with it.
+_PARTIAL_KEY_PREFIX = "partial/"
+
+# A partial result that has not been updated for this many seconds is considered
+# abandoned, for example because its replica went away, and is generated again.
+PARTIAL_STALE_SECONDS = 30
+
+# How often, and for how long at most, viewers poll the KV to tail a partial
+# result.
+TAIL_POLL_INTERVAL = 0.5
+TAIL_TIMEOUT = 180
+
+
+def partial_key(search_uuid: str) -> str:
+    return _PARTIAL_KEY_PREFIX + search_uuid
+
+
+def decode_partial(value: bytes):
+    """
+    Returns the update time and the content of a partial result stored in the KV.
+    """
+    timestamp, _, content = value.partition(b"\n")
+    return float(timestamp), content
+
+
+def close_llm_response(llm_response):
+    """
+    Closes an LLM stream, which closes its connection so that the LLM stops
+    generating. The stream may also be the future of a stream still being
+    requested.
+    """
+    if not isinstance(llm_response, concurrent.futures.Future):
+        llm_response.close()
+    elif not llm_response.cancel():
+        llm_response.add_done_callback(
+            lambda f: f.exception() is None and f.result().close()
+        )
+
+
+async def async_close_llm_response(llm_response):
+    """
+    The async version of close_llm_response.
+    """
+    if not isinstance(llm_response, asyncio.Future):
+        await llm_response.close()
+    elif (
+        not llm_response.cancel()
+        and not llm_response.cancelled()
+        and llm_response.exception() is None
+    ):
+        await llm_response.result().close()
+
+
+async def iterate_in_threadpool(iterator) -> AsyncGenerator:
+    """
+    Like starlette's iterate_in_threadpool, which StreamingResponse uses for sync
+    iterators, but closes the iterator as soon as the response is abandoned, for
+    example when the client goes away, instead of whenever it is garbage collected.
+    """
+    done = object()
+    try:
+        while True:
+            chunk = await anyio.to_thread.run_sync(next, iterator, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        iterator.close()
+
+
+class IncrementalResult(object):
+    """
+    Accumulates the chunks of a stream response and persists them to the KV as
+    they come: every flush_bytes bytes or flush_interval seconds, the result so
+    far is written to the partial key in the background, and when the stream is
+    complete, the whole result is encoded with the codec and its metadata and
+    written once to the final key, through the store if one is given, and the
+    partial key is deleted.
+
+    At most one flush is in flight at any time, and flushes that would overlap
+    with it are skipped, so a slow KV never queues up writes. Since each flush
+    rewrites the whole result so far, there are at most max_flushes of them per
+    result, after which the partial result is only rewritten every half of
+    PARTIAL_STALE_SECONDS, so that it is not taken for an abandoned one.
+    """
+
+    def __init__(
+        self,
+        kv: KV,
+        key: str,
+        executor: concurrent.futures.Executor,
+        flush_bytes: int,
+        flush_interval: float,
+        codec: str = "none",
+        metadata: Optional[dict] = None,
+        store: Optional["ResultStore"] = None,
+        max_flushes: int = 20,
+    ):
+        self.kv = kv
+        self.store = store
+        self.key = key
+        self.executor = executor
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_flushes = max_flushes
+        self.flushes = 0
+        self.codec = codec
+        self.metadata = metadata
+        self._buffer = io.StringIO()
+        self._size = 0
+        self._flushed_size = 0
+        # The first chunk is flushed right away, so that other viewers can start
+        # tailing as early as possible.
+        self._last_flush = 0.0
+        self._pending_flush = None
+
+    def append(self, chunk: str):
+        self._buffer.write(chunk)
+        self._size += len(chunk)
+        if self.flush_bytes <= 0:
+            return
+        if self._pending_flush is not None and not self._pending_flush.done():
+            return
+        now = time.time()
+        if self.flushes >= self.max_flushes:
+            due = now - self._last_flush >= PARTIAL_STALE_SECONDS / 2
+        else:
+            due = (
+                self._size - self._flushed_size >= self.flush_bytes
+                or now - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flushes += 1
+            self._flushed_size = self._size
+            self._last_flush = now
+            self._pending_flush = self.executor.submit(
+                self._put_partial, f"{now:.3f}\n{self._buffer.getvalue()}"
+            )
+
+    def _put_partial(self, value: str):
+        try:
+            self.kv.put(partial_key(self.key), value)
+        except Exception as e:
+            logger.error(f"KV error while flushing {self.key}: {e}")
+
+    def finalize(self) -> str:
+        """
+        Writes the complete result to the KV in the background, and returns it.
+        Note that if uploading to KV fails, we will silently ignore it, because we
+        don't want to affect the user experience.
+        """
+        result = self._buffer.getvalue()
+        self._buffer = None
+        self.executor.submit(self._put_final, result)
+        return result
+
+    def abandon(self):
+        """
+        Gives up on the result, for example because its generation is cancelled.
+        The partial result is deleted, so that the next viewer generates it again
+        instead of tailing it.
+        """
+        self._buffer = None
+        if self._pending_flush is not None:
+            self.executor.submit(self._delete_partial, self._pending_flush)
+
+    def _delete_partial(self, pending_flush: concurrent.futures.Future):
+        concurrent.futures.wait([pending_flush])
+        try:
+            self.kv.delete(partial_key(self.key))
+        except Exception as e:
+            logger.error(f"KV error while deleting {partial_key(self.key)}: {e}")
+
+    def _put_final(self, result: str):
+        pending_flush = self._pending_flush
+        if pending_flush is not None:
+            # Make sure that a late partial flush does not outlive the result.
+            concurrent.futures.wait([pending_flush])
+        try:
+            with stage_seconds.labels("kv_upload").time():
+                (self.store or self.kv).put(
+                    self.key, encode_result(result, self.metadata, self.codec)
+                )
+            if pending_flush is not None:
+                self.kv.delete(partial_key(self.key))
+        except Exception as e:
+            logger.error(f"KV error while uploading {self.key}: {e}")
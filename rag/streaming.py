@@ -0,0 +1,257 @@
+"""
+The framed streaming protocols of the responses.
+"""
+
+import asyncio
+import codecs
+import json
+import time
+import traceback
+import zlib
+from typing import AsyncGenerator, List
+
+from fastapi.responses import StreamingResponse
+from loguru import logger
+from prometheus_client import Counter
+from starlette.datastructures import Headers
+
+from .store import LLM_RESPONSE_MARKER, RELATED_QUESTIONS_MARKER
+from .ui import accepted_encodings
+
+# The version of the framed protocol, which clients ask for as "ndjson/1" or
+# "sse/1", or just "ndjson" or "sse" for the current version.
+_STREAM_PROTOCOL_VERSION = 1
+_STREAM_PROTOCOLS = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+# The response header that tells the protocol of a framed stream.
+_STREAM_PROTOCOL_HEADER = "X-Stream-Protocol"
+_STREAM_GZIP_LEVEL = 6
+
+_stream_events = Counter(
+    "rag_stream_events_total",
+    "Events sent in the framed streams, by protocol and type.",
+    ["protocol", "type"],
+)
+
+
+def parse_stream_protocol(protocol: str) -> str:
+    """
+    Returns the name of the framed protocol asked for, such as "sse" for "sse/1".
+    Raises ValueError if the protocol or its version is unknown.
+    """
+    name, _, version = protocol.strip().lower().partition("/")
+    if name not in _STREAM_PROTOCOLS:
+        raise ValueError(f"The stream protocol must be one of {', '.join(_STREAM_PROTOCOLS)}.")
+    if version and version != str(_STREAM_PROTOCOL_VERSION):
+        raise ValueError(f"Version {version} of the stream protocol is not supported.")
+    return name
+
+
+def _marker_prefix_length(text: str, marker: str) -> int:
+    """
+    Returns the length of the longest end of text that starts the marker.
+    """
+    for length in range(min(len(text), len(marker) - 1), 0, -1):
+        if marker.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class StreamFramer(object):
+    """
+    Splits the chunks of a stream response into the typed events of the framed
+    protocol, as (type, data) tuples: "sources" with the list of contexts,
+    "delta" with a piece of the answer, and "related" with the list of related
+    questions. The markers between the sections may be split across chunks.
+    """
+
+    def __init__(self):
+        self.section = "sources"
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[tuple]:
+        self.buffer += text
+        events = []
+        if self.section == "sources":
+            sources, marker, rest = self.buffer.partition(LLM_RESPONSE_MARKER)
+            if not marker:
+                return events
+            events.append(("sources", json.loads(sources)))
+            self.section, self.buffer = "answer", rest
+        if self.section == "answer":
+            answer, marker, rest = self.buffer.partition(RELATED_QUESTIONS_MARKER)
+            if marker:
+                self.section, self.buffer = "related", rest
+            else:
+                # The end of the buffer may be the start of the marker.
+                keep = _marker_prefix_length(answer, RELATED_QUESTIONS_MARKER)
+                answer, self.buffer = answer[: len(answer) - keep], answer[len(answer) - keep :]
+            if answer:
+                events.append(("delta", answer))
+        return events
+
+    def finish(self) -> List[tuple]:
+        """
+        Returns the events left at the end of the stream. Like split_result, a
+        stream without sources is all answer.
+        """
+        buffer, self.buffer = self.buffer, ""
+        if self.section == "related":
+            return [("related", json.loads(buffer) if buffer.strip() else [])]
+        return [("delta", buffer)] if buffer else []
+
+
+def _format_event(protocol: str, event_type: str, data=None) -> str:
+    event = {"type": event_type} if data is None else {"type": event_type, "data": data}
+    if protocol == "sse":
+        return f"event: {event_type}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+
+async def frame_stream(
+    chunks: AsyncGenerator,
+    protocol: str,
+    flush_interval: float,
+    flush_bytes: int,
+) -> AsyncGenerator[str, None]:
+    """
+    Converts the chunks of a stream response, text or bytes, into the events of
+    the framed protocol, and ends with a "done" event, or an "error" event if the
+    stream fails. The answer deltas are coalesced into one event per
+    flush_interval seconds or flush_bytes bytes, whichever comes first, instead
+    of one per token, except for the first one, so that the time to first token
+    does not change. Each yielded string is one write to the socket.
+    """
+    framer = StreamFramer()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending, pending_bytes, deadline = [], 0, None
+    first_delta = True
+    iterator = chunks.__aiter__()
+    next_chunk = None
+
+    def flush() -> str:
+        nonlocal pending, pending_bytes, deadline
+        text = "".join(pending)
+        pending, pending_bytes, deadline = [], 0, None
+        if not text:
+            return ""
+        _stream_events.labels(protocol, "delta").inc()
+        return _format_event(protocol, "delta", text)
+
+    def emit(events: List[tuple]) -> str:
+        nonlocal pending_bytes, deadline, first_delta
+        out = []
+        for event_type, data in events:
+            if event_type != "delta":
+                out.append(flush())
+                _stream_events.labels(protocol, event_type).inc()
+                out.append(_format_event(protocol, event_type, data))
+                continue
+            pending.append(data)
+            pending_bytes += len(data.encode("utf-8"))
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+            if first_delta or pending_bytes >= flush_bytes:
+                first_delta = False
+                out.append(flush())
+        return "".join(out)
+
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            if deadline is not None:
+                # Waits for the next chunk until the pending deltas are due.
+                await asyncio.wait(
+                    [next_chunk], timeout=max(0.0, deadline - time.monotonic())
+                )
+                if not next_chunk.done():
+                    yield flush()
+                    continue
+            try:
+                chunk = await next_chunk
+            except StopAsyncIteration:
+                break
+            finally:
+                if next_chunk.done():
+                    next_chunk = None
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            out = emit(framer.feed(chunk))
+            if out:
+                yield out
+        out = emit(framer.feed(decoder.decode(b"", final=True)) + framer.finish())
+        yield out + flush() + _format_event(protocol, "done")
+        _stream_events.labels(protocol, "done").inc()
+    except Exception as e:
+        logger.error(f"Error in the framed stream: {e}\n{traceback.format_exc()}")
+        _stream_events.labels(protocol, "error").inc()
+        yield flush() + _format_event(protocol, "error", "Internal server error.")
+    finally:
+        # If the client went away, the stream response is stopped as if it had
+        # no wrapper: cancelled where it waits, or closed where it yielded.
+        if next_chunk is not None:
+            next_chunk.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class FramedStreamingResponse(StreamingResponse):
+    """
+    A stream in the framed protocol, compressed with gzip if compress is true
+    and the client accepts it. The compressor is flushed after each write, so
+    that each event reaches the client as soon as it is sent, which starlette's
+    GZipMiddleware does not do for streaming responses.
+    """
+
+    def __init__(self, *args, compress: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress = compress
+
+    async def __call__(self, scope, receive, send):
+        if not self.compress or "gzip" not in accepted_encodings(
+            Headers(scope=scope).get("accept-encoding", "")
+        ):
+            await super().__call__(scope, receive, send)
+            return
+        self.headers["Content-Encoding"] = "gzip"
+        self.headers.add_vary_header("Accept-Encoding")
+        compressor = zlib.compressobj(_STREAM_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.body":
+                body = compressor.compress(message.get("body", b""))
+                if message.get("more_body", False):
+                    body += compressor.flush(zlib.Z_SYNC_FLUSH)
+                else:
+                    body += compressor.flush()
+                message = {**message, "body": body}
+            await send(message)
+
+        await super().__call__(scope, receive, send_compressed)
+
+
+def framed_response(
+    response: StreamingResponse,
+    protocol: str,
+    flush_interval: float,
+    flush_bytes: int,
+    compress: bool = False,
+) -> FramedStreamingResponse:
+    """
+    Returns the stream response in the framed protocol.
+    """
+    headers = {
+        _STREAM_PROTOCOL_HEADER: f"{protocol}/{_STREAM_PROTOCOL_VERSION}",
+        "Cache-Control": "no-cache",
+        # Proxies such as nginx would otherwise buffer the events.
+        "X-Accel-Buffering": "no",
+    }
+    return FramedStreamingResponse(
+        frame_stream(response.body_iterator, protocol, flush_interval, flush_bytes),
+        media_type=_STREAM_PROTOCOLS[protocol],
+        headers=headers,
+        compress=compress,
+    )
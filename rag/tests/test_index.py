@@ -0,0 +1,102 @@
+"""
+Tests of the local index: adding, replacing, deleting and compacting documents,
+and querying them.
+"""
+
+import json
+import os
+
+from rag.index import LocalIndex, LocalIndexWriter, read_documents
+
+DOCUMENTS = [
+    {"url": "https://a", "title": "Rust", "text": "Rust is a systems programming language."},
+    {"url": "https://b", "title": "Go", "text": "Go is a language with goroutines."},
+    {"url": "https://c", "title": "Python", "text": "Python is a dynamic language."},
+]
+
+
+def write_jsonl(path: str, documents: list) -> str:
+    with open(path, "w") as f:
+        for document in documents:
+            f.write(json.dumps(document) + "\n")
+    return path
+
+
+def search(directory: str, query: str) -> list:
+    return [r.url for r in LocalIndex(directory).search(query)]
+
+
+def add(directory: str, path: str) -> int:
+    writer = LocalIndexWriter(directory)
+    try:
+        return writer.add(read_documents(path))
+    finally:
+        writer.close()
+
+
+def test_add_and_query(tmp_path):
+    directory = str(tmp_path / "index")
+    assert add(directory, write_jsonl(str(tmp_path / "docs.jsonl"), DOCUMENTS)) == 3
+    assert search(directory, "goroutines") == ["https://b"]
+    assert sorted(search(directory, "language")) == ["https://a", "https://b", "https://c"]
+    result = LocalIndex(directory).search("rust")[0]
+    assert (result.name, result.url) == ("Rust", "https://a")
+    assert "Rust" in result.snippet
+    assert search(directory, "") == []
+    assert search(directory, "haskell") == []
+
+
+def test_add_replaces_the_documents_of_the_same_url(tmp_path):
+    directory = str(tmp_path / "index")
+    add(directory, write_jsonl(str(tmp_path / "docs.jsonl"), DOCUMENTS))
+    updated = [{"url": "https://a", "title": "Rust", "text": "Rust has a borrow checker."}]
+    add(directory, write_jsonl(str(tmp_path / "update.jsonl"), updated))
+    assert search(directory, "systems") == []
+    assert search(directory, "borrow") == ["https://a"]
+    assert LocalIndex(directory).num_passages == 3
+
+
+def test_delete(tmp_path):
+    directory = str(tmp_path / "index")
+    add(directory, write_jsonl(str(tmp_path / "docs.jsonl"), DOCUMENTS))
+    writer = LocalIndexWriter(directory)
+    writer.delete(["https://b"])
+    writer.close()
+    assert search(directory, "goroutines") == []
+    assert "https://b" not in search(directory, "language")
+    assert LocalIndex(directory).num_passages == 2
+
+
+def test_compact(tmp_path):
+    directory = str(tmp_path / "index")
+    for i, document in enumerate(DOCUMENTS):
+        add(directory, write_jsonl(str(tmp_path / f"doc-{i}.jsonl"), [document]))
+    writer = LocalIndexWriter(directory)
+    writer.delete(["https://c"])
+    before = {query: search(directory, query) for query in ("rust", "goroutines", "dynamic")}
+    writer.compact()
+    writer.close()
+    index = LocalIndex(directory)
+    assert len(index.segments) == 1
+    assert index.num_passages == 2
+    assert [n for n in os.listdir(directory) if n.startswith("segment-")] == [
+        writer.manifest["segments"][0]["name"]
+    ]
+    for query, urls in before.items():
+        assert search(directory, query) == urls
+    assert before["dynamic"] == []
+
+
+def test_read_documents_of_a_directory(tmp_path):
+    (tmp_path / "docs" / "sub").mkdir(parents=True)
+    (tmp_path / "docs" / "sub" / "a.md").write_text("# Title A\nSome text.")
+    (tmp_path / "docs" / "b.html").write_text(
+        "<html><head><title>Title B</title></head><body><p>Other text.</p></body></html>"
+    )
+    (tmp_path / "docs" / "c.bin").write_text("skipped")
+    documents = list(read_documents(str(tmp_path / "docs"), "https://docs/"))
+    assert [(name, url) for name, url, _ in documents] == [
+        ("Title B", "https://docs/b.html"),
+        ("Title A", "https://docs/sub/a.md"),
+    ]
+    assert "Other text." in documents[0][2]
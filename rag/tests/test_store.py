@@ -0,0 +1,146 @@
+"""
+Tests of the disk tier of the stored results, of the write order of the result
+store, and of the incremental persistence of the stream responses.
+"""
+
+import concurrent.futures
+import os
+
+import pytest
+
+from rag.store import (
+    DiskTier,
+    IncrementalResult,
+    ResultStore,
+    decode_partial,
+    decode_result,
+    partial_key,
+)
+
+
+def test_disk_tier_round_trip(tmp_path):
+    directory = str(tmp_path / "results")
+    tier = DiskTier(directory, 1 << 20)
+    values = {f"key-{i}": os.urandom(100 + i) for i in range(50)}
+    for key, value in values.items():
+        tier.put(key, value)
+    tier.put("key-0", b"replaced")
+    values["key-0"] = b"replaced"
+    assert all(tier.get(key) == value for key, value in values.items())
+    assert tier.get("missing") is None
+    tier.close()
+
+    tier = DiskTier(directory, 1 << 20)
+    assert all(tier.get(key) == value for key, value in values.items())
+    tier.close()
+
+
+def test_disk_tier_is_used_by_one_process_at_a_time(tmp_path):
+    tier = DiskTier(str(tmp_path), 1 << 16)
+    with pytest.raises(RuntimeError):
+        DiskTier(str(tmp_path), 1 << 16)
+    tier.close()
+
+
+def test_disk_tier_detects_corrupt_records(tmp_path):
+    directory = str(tmp_path / "results")
+    tier = DiskTier(directory, 1 << 20)
+    for key in ("a", "b", "c"):
+        tier.put(key, key.encode() * 100)
+    segment, offset, _ = tier._index["b"]
+    tier.close()
+    with open(os.path.join(directory, f"segment-{segment}"), "r+b") as f:
+        f.seek(offset + 10)
+        f.write(b"x")
+
+    # The records from the corrupt one on are dropped.
+    tier = DiskTier(directory, 1 << 20)
+    assert tier.get("a") == b"a" * 100
+    assert tier.get("b") is None
+    assert tier.get("c") is None
+    tier.put("d", b"d")
+    assert tier.get("d") == b"d"
+    tier.close()
+
+
+def test_disk_tier_evicts_the_older_half(tmp_path):
+    directory = str(tmp_path / "results")
+    tier = DiskTier(directory, 8192)
+    value = b"v" * 1000
+    for i in range(3):
+        tier.put(f"old-{i}", value)
+    # Fills the first segment, so that the next puts go to the second one.
+    for i in range(3):
+        tier.put(f"new-{i}", value)
+    # Reading an entry of the older segment keeps it when that one is cleared.
+    assert tier.get("old-0") == value
+    for i in range(3):
+        tier.put(f"newer-{i}", value)
+    assert tier.get("old-0") == value
+    assert tier.get("old-1") is None
+    assert tier.get("new-0") is None
+    tier.close()
+
+    # The cleared records are not read back after a restart either.
+    tier = DiskTier(directory, 8192)
+    assert tier.get("old-0") == value
+    assert tier.get("old-1") is None
+    assert tier.get("newer-2") == value
+    tier.close()
+
+
+class FailingKV(dict):
+    def get(self, key):
+        return self[key]
+
+    def put(self, key, value):
+        raise RuntimeError("The KV is down.")
+
+
+def test_result_store_skips_the_local_tiers_when_the_kv_fails(tmp_path):
+    disk = DiskTier(str(tmp_path), 1 << 16)
+    store = ResultStore(FailingKV(), 1 << 16, negative_ttl=10, disk=disk)
+    with pytest.raises(RuntimeError):
+        store.put("key", b"value")
+    assert store.get_local("key") is None
+    assert disk.get("key") is None
+    disk.close()
+
+
+class RecordingKV(dict):
+    def __init__(self):
+        super().__init__()
+        self.puts = []
+
+    def get(self, key):
+        return self[key]
+
+    def put(self, key, value):
+        self.puts.append(key)
+        self[key] = value
+
+    def delete(self, key):
+        del self[key]
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def test_incremental_result_caps_the_flushes():
+    kv = RecordingKV()
+    result = IncrementalResult(
+        kv, "abc", InlineExecutor(), flush_bytes=1, flush_interval=0, max_flushes=3
+    )
+    for i in range(10):
+        result.append(f"chunk {i} ")
+    assert kv.puts == ["partial/abc"] * 3
+    _, content = decode_partial(kv[partial_key("abc")].encode())
+    assert content == b"chunk 0 chunk 1 chunk 2 "
+
+    assert result.finalize() == "".join(f"chunk {i} " for i in range(10))
+    assert decode_result(kv["abc"]) == "".join(f"chunk {i} " for i in range(10))
+    assert partial_key("abc") not in kv
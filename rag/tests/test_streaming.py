@@ -0,0 +1,188 @@
+"""
+Tests of the framed streaming protocols: the events of each protocol decode back
+to the plain text stream response, however it is split into chunks.
+"""
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from rag.store import LLM_RESPONSE_MARKER, RELATED_QUESTIONS_MARKER
+from rag.streaming import (
+    FramedStreamingResponse,
+    StreamFramer,
+    frame_stream,
+    parse_stream_protocol,
+)
+
+SOURCES = [{"name": "Café", "url": "https://a", "snippet": "Ünïcode snippet"}]
+ANSWER = "The answer, with a multi-byte character: 日本語 [citation:1]. " * 20
+RELATED = ["What next?", "Why?"]
+RESULT = (
+    json.dumps(SOURCES)
+    + LLM_RESPONSE_MARKER
+    + ANSWER
+    + RELATED_QUESTIONS_MARKER
+    + json.dumps(RELATED)
+)
+
+
+def decode_events(protocol: str, text: str) -> list:
+    """
+    Returns the (type, data) events of a framed stream.
+    """
+    events = []
+    if protocol == "ndjson":
+        for line in text.splitlines():
+            event = json.loads(line)
+            events.append((event["type"], event.get("data")))
+        return events
+    for block in text.split("\n\n"):
+        if not block:
+            continue
+        name, data = block.split("\n")
+        event = json.loads(data[len("data: ") :])
+        assert name == f"event: {event['type']}"
+        events.append((event["type"], event.get("data")))
+    return events
+
+
+def frame(
+    chunks: list, protocol: str, flush_interval: float = 0.01, flush_bytes: int = 64
+) -> str:
+    async def generate():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return "".join(
+            [
+                out
+                async for out in frame_stream(
+                    generate(), protocol, flush_interval, flush_bytes
+                )
+            ]
+        )
+
+    return asyncio.run(collect())
+
+
+def split(data, size: int) -> list:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("protocol", ["ndjson", "sse"])
+@pytest.mark.parametrize("size", [1, 3, 7, 100, 100000])
+@pytest.mark.parametrize("as_bytes", [False, True])
+def test_frame_stream_round_trip(protocol, size, as_bytes):
+    data = RESULT.encode("utf-8") if as_bytes else RESULT
+    events = decode_events(protocol, frame(split(data, size), protocol))
+    assert events[0] == ("sources", SOURCES)
+    assert "".join(data for kind, data in events if kind == "delta") == ANSWER
+    assert events[-2:] == [("related", RELATED), ("done", None)]
+    assert {kind for kind, _ in events[1:-2]} == {"delta"}
+
+
+@pytest.mark.parametrize("protocol", ["ndjson", "sse"])
+def test_frame_stream_coalesces_the_deltas(protocol):
+    chunks = split(RESULT, 1)
+    events = decode_events(protocol, frame(chunks, protocol, 60, flush_bytes=256))
+    deltas = [data for kind, data in events if kind == "delta"]
+    # The first delta is sent right away, and the next ones every 256 bytes.
+    assert len(deltas[0]) == 1
+    assert all(len(delta.encode("utf-8")) >= 256 for delta in deltas[1:-1])
+    assert len(deltas) <= 2 + len(ANSWER.encode("utf-8")) // 256
+
+
+@pytest.mark.parametrize("protocol", ["ndjson", "sse"])
+def test_frame_stream_without_sources(protocol):
+    events = decode_events(protocol, frame(split("Just an answer.", 4), protocol))
+    assert "".join(data for kind, data in events if kind == "delta") == "Just an answer."
+    assert events[-1] == ("done", None)
+
+
+@pytest.mark.parametrize("protocol", ["ndjson", "sse"])
+def test_frame_stream_error(protocol):
+    async def generate():
+        yield json.dumps(SOURCES) + LLM_RESPONSE_MARKER + "Partial"
+        raise RuntimeError("The LLM went away.")
+
+    async def collect():
+        return "".join([out async for out in frame_stream(generate(), protocol, 0.01, 64)])
+
+    events = decode_events(protocol, asyncio.run(collect()))
+    assert events[0] == ("sources", SOURCES)
+    assert events[-1] == ("error", "Internal server error.")
+
+
+def test_framer_holds_back_a_split_marker():
+    framer = StreamFramer()
+    head, tail = RELATED_QUESTIONS_MARKER[:5], RELATED_QUESTIONS_MARKER[5:]
+    assert framer.feed(json.dumps(SOURCES) + LLM_RESPONSE_MARKER) == [("sources", SOURCES)]
+    assert framer.feed("answer" + head) == [("delta", "answer")]
+    assert framer.feed(tail + json.dumps(RELATED)) == []
+    assert framer.finish() == [("related", RELATED)]
+
+
+def test_parse_stream_protocol():
+    assert parse_stream_protocol("ndjson") == "ndjson"
+    assert parse_stream_protocol(" SSE/1 ") == "sse"
+    with pytest.raises(ValueError):
+        parse_stream_protocol("sse/2")
+    with pytest.raises(ValueError):
+        parse_stream_protocol("websocket")
+
+
+def respond(accept_encoding: str) -> tuple:
+    """
+    Returns the Content-Encoding and the body of a compressed framed response.
+    """
+
+    async def generate():
+        yield "data"
+
+    async def call():
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(10)
+
+        async def send(message):
+            messages.append(message)
+
+        response = FramedStreamingResponse(generate(), compress=True)
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "headers": [(b"accept-encoding", accept_encoding.encode())],
+        }
+        await response(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(call())
+    headers = dict(messages[0]["headers"])
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return headers.get(b"content-encoding"), body
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, compressed",
+    [
+        ("gzip, deflate, br", True),
+        ("br;q=1.0, GZIP;q=0.5", True),
+        ("gzip;q=0", False),
+        ("gzip; q=0.0, identity", False),
+        ("identity", False),
+        ("", False),
+    ],
+)
+def test_framed_response_compression(accept_encoding, compressed):
+    encoding, body = respond(accept_encoding)
+    if compressed:
+        assert encoding == b"gzip"
+        assert gzip.decompress(body) == b"data"
+    else:
+        assert encoding is None
+        assert body == b"data"
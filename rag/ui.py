@@ -0,0 +1,230 @@
+"""
+The static assets of the UI, served from memory and precompressed.
+
+It does not depend on the photon, so that the build of the UI can run
+`python -m rag.ui compress` without the rest of the backend.
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+import time
+from typing import List
+
+from fastapi.responses import Response
+from fastapi.staticfiles import StaticFiles
+from loguru import logger
+from prometheus_client import Counter, Gauge
+from starlette.datastructures import Headers
+
+try:
+    import brotli
+except ImportError:
+    # The UI is compressed with gzip only.
+    brotli = None
+
+# The encodings of the precompressed sidecars of the UI files, such as
+# index.html.gz, in order of preference.
+_UI_ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# The files of these types are worth compressing.
+_UI_COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "image/svg+xml",
+)
+# The files whose name has a hash of their content, which never change.
+_UI_IMMUTABLE_PREFIX = os.path.join("_next", "static") + os.sep
+_UI_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The other files, such as the html pages, are revalidated with their ETag.
+_UI_CACHE_CONTROL = "no-cache"
+
+_ui_responses = Counter(
+    "rag_ui_responses_total",
+    "Responses of the UI static files, by how they were served: from memory in an"
+    " encoding, not modified, or from disk.",
+    ["outcome"],
+)
+_ui_cache_bytes = Gauge(
+    "rag_ui_cache_bytes", "Bytes of the UI static files held in memory."
+)
+
+
+def _ui_compressible(path: str) -> bool:
+    media_type = mimetypes.guess_type(path)[0] or ""
+    return media_type.startswith(_UI_COMPRESSIBLE_TYPES)
+
+
+def compress_ui(directory: str) -> int:
+    """
+    Writes the gzip sidecar, and the brotli one if the brotli package is
+    installed, of each compressible file of the exported UI, at the highest
+    levels, since they are written once at build time. Returns the number of
+    files compressed.
+    """
+    count = 0
+    for path in glob.glob(os.path.join(directory, "**", "*"), recursive=True):
+        if (
+            not os.path.isfile(path)
+            or path.endswith(tuple(_UI_ENCODINGS.values()))
+            or not _ui_compressible(path)
+        ):
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+        with open(path + _UI_ENCODINGS["gzip"], "wb") as f:
+            # mtime=0, so that the sidecars of the same build are identical.
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + _UI_ENCODINGS["br"], "wb") as f:
+                f.write(brotli.compress(content, quality=11))
+        count += 1
+    return count
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """
+    Returns the encodings of an Accept-Encoding header, without those with q=0.
+    """
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:] or 0) == 0:
+                    continue
+            except ValueError:
+                # A malformed weight: the encoding is ignored.
+                continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class StaticAsset(object):
+    """
+    A UI file held in memory, with its precompressed variants by encoding.
+    """
+
+    __slots__ = ("media_type", "variants", "etag", "cache_control")
+
+    def __init__(self, path: str, content: bytes, variants: dict):
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = {"identity": content, **variants}
+        self.etag = hashlib.sha1(content).hexdigest()[:20]
+        self.cache_control = (
+            _UI_IMMUTABLE_CACHE_CONTROL
+            if path.startswith(_UI_IMMUTABLE_PREFIX)
+            else _UI_CACHE_CONTROL
+        )
+
+    def size(self) -> int:
+        return sum(len(v) for v in self.variants.values())
+
+
+class StaticAssets(StaticFiles):
+    """
+    Serves the exported UI from memory: the files are read once at startup, up
+    to max_bytes in total, along with their precompressed sidecars written by
+    `python -m rag.ui compress`, or compressed with gzip at
+    startup if there are none. Each response is the smallest variant that the
+    client accepts, with a strong ETag per variant, and conditional requests
+    are answered with 304. The files with a hash in their name are cached by the
+    browsers for good. The files beyond max_bytes are served from disk.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.assets = {}
+        start = time.time()
+        total = 0
+        for path in sorted(glob.glob(os.path.join(directory, "**", "*"), recursive=True)):
+            name = os.path.relpath(path, directory)
+            if not os.path.isfile(path) or name.endswith(tuple(_UI_ENCODINGS.values())):
+                continue
+            asset = self._load(path, name)
+            if total + asset.size() > max_bytes:
+                continue
+            self.assets[name] = asset
+            total += asset.size()
+        _ui_cache_bytes.set(total)
+        logger.info(
+            f"Loaded {len(self.assets)} UI files ({total} bytes) in"
+            f" {time.time() - start:.2f}s."
+        )
+
+    @staticmethod
+    def _load(path: str, name: str) -> StaticAsset:
+        with open(path, "rb") as f:
+            content = f.read()
+        variants = {}
+        if _ui_compressible(name):
+            for encoding, suffix in _UI_ENCODINGS.items():
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, "rb") as f:
+                        variants[encoding] = f.read()
+            if "gzip" not in variants:
+                variants["gzip"] = gzip.compress(content, compresslevel=6, mtime=0)
+            # A variant that is not smaller is not worth it.
+            variants = {e: v for e, v in variants.items() if len(v) < len(content)}
+        return StaticAsset(name, content, variants)
+
+    async def get_response(self, path: str, scope) -> Response:
+        asset = self.assets.get(path)
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            _ui_responses.labels("disk").inc()
+            return await super().get_response(path, scope)
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        encoding = next(
+            (e for e in _UI_ENCODINGS if e in asset.variants and e in accepted),
+            "identity",
+        )
+        etag = f'"{asset.etag}"' if encoding == "identity" else f'"{asset.etag}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if_none_match = request_headers.get("if-none-match", "")
+        if if_none_match:
+            tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+            if "*" in tags or etag in tags:
+                _ui_responses.labels("not_modified").inc()
+                return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        _ui_responses.labels(encoding).inc()
+        return Response(
+            asset.variants[encoding], media_type=asset.media_type, headers=headers
+        )
+
+
+def ui_main(argv: List[str]):
+    """
+    The command line interface of the static UI, which is also available as
+    `python search_with_lepton.py ui`:
+
+        python -m rag.ui compress
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m rag.ui",
+        description="Prepares the exported UI to be served.",
+    )
+    parser.add_argument("--directory", default="ui")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "compress", help="Writes the precompressed sidecars of the UI files."
+    )
+    args = parser.parse_args(argv)
+    start = time.time()
+    count = compress_ui(args.directory)
+    encodings = "gzip and brotli" if brotli is not None else "gzip"
+    print(f"Compressed {count} files with {encodings} in {time.time() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    ui_main(sys.argv[1:])
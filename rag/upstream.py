@@ -0,0 +1,478 @@
+"""
+The scheduling of the upstream calls: rate limits, retries and circuit breakers.
+"""
+
+import asyncio
+import collections
+import email.utils
+import math
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+from .admission import Overloaded
+
+# Responses with these status codes are retried, as well as connection errors.
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+_upstream_tokens = Gauge(
+    "rag_upstream_rate_limit_tokens",
+    "Tokens left in the rate limiter of each upstream, negative when calls wait for it.",
+    ["upstream"],
+)
+_upstream_throttled = Counter(
+    "rag_upstream_throttled_total",
+    "Number of upstream calls delayed or rejected by the rate limiter or by a Retry-After.",
+    ["upstream", "outcome"],
+)
+_upstream_retries = Counter(
+    "rag_upstream_retries_total",
+    "Number of failed upstream calls retried, or not retried for lack of retry budget.",
+    ["upstream", "outcome"],
+)
+_circuit_breaker_state = Gauge(
+    "rag_circuit_breaker_state",
+    "State of the circuit breaker of each upstream: 0 closed, 1 half open, 2 open.",
+    ["upstream"],
+)
+_circuit_breaker_transitions = Counter(
+    "rag_circuit_breaker_transitions_total",
+    "Number of transitions of the circuit breakers, by upstream and new state.",
+    ["upstream", "state"],
+)
+search_fallbacks = Counter(
+    "rag_search_fallbacks_total",
+    "Number of searches sent to the fallback backend after the search backend failed.",
+    ["backend"],
+)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Returns the seconds of a Retry-After header, given either in seconds or as an
+    HTTP date, or None if there is none.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamUnavailable(Overloaded):
+    """
+    Raised when an upstream is not called, because its circuit is open or its
+    rate limit is exceeded, or when it keeps failing. Like Overloaded, it is
+    returned to the client as a 503 with a Retry-After header.
+    """
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(503, max(1, int(math.ceil(retry_after))))
+        self.upstream = upstream
+        self.args = (f"{upstream} is unavailable, retry after {self.retry_after} seconds.",)
+
+
+class TokenBucket(object):
+    """
+    A token bucket of rate tokens per second, holding at most burst tokens. A call
+    reserves a token, and waits until it is due, so that bursts are spread at the
+    rate rather than rejected, unless it would wait more than max_wait seconds.
+    """
+
+    def __init__(self, rate: float, burst: float, max_wait: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        # Must be called with the lock held.
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self) -> Optional[float]:
+        """
+        Reserves a token, and returns how many seconds to wait before using it, or
+        None if that would be more than max_wait.
+        """
+        with self._lock:
+            self._refill()
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > self.max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class CircuitBreaker(object):
+    """
+    Fails the calls to an upstream fast while it is unhealthy. After failures
+    consecutive failed calls, the circuit opens, and calls are refused for
+    reset_timeout seconds. Then a single call at a time is let through to probe
+    the upstream: the circuit closes when a probe succeeds, and opens again when
+    it fails.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    _STATE_NAMES = ("closed", "half_open", "open")
+
+    def __init__(self, name: str, failures: int = 5, reset_timeout: float = 10):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        _circuit_breaker_state.labels(name).set_function(lambda: self.state)
+
+    def _set(self, state: int):
+        # Must be called with the lock held.
+        logger.warning(
+            f"Circuit breaker of {self.name}: {self._STATE_NAMES[self.state]} ->"
+            f" {self._STATE_NAMES[state]}."
+        )
+        self.state = state
+        _circuit_breaker_transitions.labels(self.name, self._STATE_NAMES[state]).inc()
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+
+    def allow(self) -> bool:
+        """
+        Whether a call can be made now. If it is the probe of a half open circuit,
+        its outcome must be recorded, or the probe cancelled.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() < self._opened_at + self.reset_timeout:
+                    return False
+                self._set(self.HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the circuit lets a probe through.
+        """
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def cancel(self):
+        """
+        Gives up on a call allowed by allow, without an outcome.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._set(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self._consecutive_failures >= self.failures
+            ):
+                self._set(self.OPEN)
+
+
+class RetryBudget(object):
+    """
+    Bounds the retries of all the upstreams together, so that retries cannot
+    multiply the load on upstreams that are already failing: over the last window
+    seconds, there can be at most ratio retries per call, plus min_per_second
+    retries per second so that retries still work at low traffic.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1, window: float = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._calls = collections.deque()
+        self._retries = collections.deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        # Must be called with the lock held.
+        for times in (self._calls, self._retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def deposit(self):
+        """
+        Records a call, other than a retry.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._calls.append(now)
+
+    def withdraw(self) -> bool:
+        """
+        Records a retry and returns True if the budget allows it, or returns False.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            allowed = self.ratio * len(self._calls) + self.min_per_second * self.window
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+class Upstream(object):
+    """
+    Schedules the calls to one upstream, a search engine or an LLM model: they go
+    through its circuit breaker and its rate limiter, if any, and wait out the
+    Retry-After of its last throttled response. Failed calls are retried up to
+    retries times, with jittered exponential backoff, within the retry budget
+    shared by all the upstreams. When a call is not made or keeps failing,
+    UpstreamUnavailable is raised.
+
+    Whether a call failed is told by a classify(result, error) function, which
+    returns None if the upstream did its job, even if the result is an error for
+    the caller, or a (retriable, retry_after) tuple if the upstream failed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        budget: RetryBudget,
+        bucket: Optional[TokenBucket] = None,
+        retries: int = 1,
+        backoff: float = 0.1,
+        max_wait: float = 1,
+    ):
+        self.name = name
+        self.breaker = breaker
+        self.budget = budget
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        # The longest wait for a token or a Retry-After before giving up.
+        self.max_wait = max_wait
+        self._blocked_until = 0.0
+        if bucket is not None:
+            _upstream_tokens.labels(name).set_function(bucket.tokens)
+
+    def max_duration(self, timeout: float) -> float:
+        """
+        The longest a call can take, retries included, if each attempt is given up
+        after timeout seconds.
+        """
+        backoffs = sum(2 * self.backoff * 2**attempt for attempt in range(self.retries))
+        return (self.retries + 1) * (self.max_wait + timeout) + backoffs
+
+    def admit(self) -> float:
+        """
+        Admits a call, and returns how many seconds it must wait before it is made.
+        Raises UpstreamUnavailable if it cannot be made.
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(self.name, self.breaker.retry_after())
+        wait = max(0.0, self._blocked_until - time.monotonic())
+        if wait > self.max_wait:
+            self.breaker.cancel()
+            _upstream_throttled.labels(self.name, "rejected").inc()
+            raise UpstreamUnavailable(self.name, wait)
+        if self.bucket is not None:
+            bucket_wait = self.bucket.reserve()
+            if bucket_wait is None:
+                self.breaker.cancel()
+                _upstream_throttled.labels(self.name, "rejected").inc()
+                raise UpstreamUnavailable(self.name, 1 / self.bucket.rate)
+            wait = max(wait, bucket_wait)
+        if wait > 0:
+            _upstream_throttled.labels(self.name, "delayed").inc()
+        return wait
+
+    def _failed(self, attempt: int, failure: tuple, error: Optional[Exception]) -> float:
+        """
+        Records a failed call, and returns the delay before retrying it. Raises
+        UpstreamUnavailable if it is not retried.
+        """
+        self.breaker.record_failure()
+        retriable, retry_after = failure
+        if retry_after is not None:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        give_up = UpstreamUnavailable(
+            self.name, retry_after if retry_after is not None else self.breaker.retry_after()
+        )
+        if (
+            not retriable
+            or attempt >= self.retries
+            or self.breaker.state != self.breaker.CLOSED
+        ):
+            raise give_up from error
+        if retry_after is not None and retry_after > self.max_wait:
+            raise give_up from error
+        if not self.budget.withdraw():
+            _upstream_retries.labels(self.name, "budget_exhausted").inc()
+            raise give_up from error
+        _upstream_retries.labels(self.name, "retried").inc()
+        logger.warning(f"Retrying {self.name} after {error or 'a retriable response'}.")
+        return self.backoff * 2**attempt * random.uniform(1, 2)
+
+    def call(self, send: Callable, classify: Callable):
+        """
+        Makes the call send() and returns its result, retrying it if it fails.
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            wait = self.admit()
+            try:
+                if wait > 0:
+                    time.sleep(wait)
+                result, error = send(), None
+            except Exception as e:
+                result, error = None, e
+            except BaseException:
+                self.breaker.cancel()
+                raise
+            failure = classify(result, error)
+            if failure is None:
+                self.breaker.record_success()
+                if error is not None:
+                    raise error
+                return result
+            time.sleep(self._failed(attempt, failure, error))
+            attempt += 1
+
+    async def async_call(self, send: Callable, classify: Callable):
+        """
+        The async version of call, where send() returns an awaitable.
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            wait = self.admit()
+            try:
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                result, error = await send(), None
+            except Exception as e:
+                result, error = None, e
+            except BaseException:
+                self.breaker.cancel()
+                raise
+            failure = classify(result, error)
+            if failure is None:
+                self.breaker.record_success()
+                if error is not None:
+                    raise error
+                return result
+            await asyncio.sleep(self._failed(attempt, failure, error))
+            attempt += 1
+
+
+class UpstreamScheduler(object):
+    """
+    Makes the Upstream of each search backend and LLM model by name, with the
+    rate limit configured for the name if any, and one retry budget shared by all
+    of them.
+    """
+
+    def __init__(
+        self,
+        rate_limits: Optional[dict] = None,
+        max_wait: float = 1,
+        budget: Optional[RetryBudget] = None,
+        breaker_failures: int = 5,
+        breaker_reset_timeout: float = 10,
+    ):
+        # name -> (rate, burst)
+        self.rate_limits = rate_limits or {}
+        self.max_wait = max_wait
+        self.budget = budget or RetryBudget()
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self._upstreams = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse_rate_limits(spec: str) -> dict:
+        """
+        Parses rate limits given as comma separated name=rate or name=rate:burst,
+        in calls per second, such as "BING=50:100,mixtral-8x7b=20".
+        """
+        rate_limits = {}
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            name, _, limit = item.partition("=")
+            rate, _, burst = limit.partition(":")
+            rate = float(rate)
+            rate_limits[name.strip()] = (rate, float(burst) if burst else rate)
+        return rate_limits
+
+    def upstream(self, name: str, retries: int = 1, backoff: float = 0.1) -> Upstream:
+        with self._lock:
+            upstream = self._upstreams.get(name)
+            if upstream is None:
+                bucket = None
+                if name in self.rate_limits:
+                    rate, burst = self.rate_limits[name]
+                    bucket = TokenBucket(rate, burst, self.max_wait)
+                upstream = self._upstreams[name] = Upstream(
+                    name,
+                    CircuitBreaker(name, self.breaker_failures, self.breaker_reset_timeout),
+                    self.budget,
+                    bucket,
+                    retries=retries,
+                    backoff=backoff,
+                    max_wait=self.max_wait,
+                )
+            return upstream
+
+
+# The scheduler of the search backends that are used outside of the RAG photon,
+# for example by the benchmarks.
+default_scheduler = UpstreamScheduler()
+
+
+def classify_llm_call(result, error: Optional[Exception]) -> Optional[tuple]:
+    """
+    The classify function of the LLM calls, for Upstream.call.
+    """
+    import openai
+
+    if error is None:
+        return None
+    if isinstance(error, openai.APIConnectionError):
+        # Timeouts are not retried, as the LLM would likely time out again.
+        return not isinstance(error, openai.APITimeoutError), None
+    if isinstance(error, openai.APIStatusError) and (
+        error.status_code in RETRIABLE_STATUS_CODES
+    ):
+        return True, parse_retry_after(error.response.headers.get("retry-after"))
+    return None
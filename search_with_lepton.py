@@ -1,44 +1,127 @@
+import asyncio
+import collections
 import concurrent.futures
+import functools
 import glob
+import importlib
 import json
 import os
 import re
-import threading
-import requests
+import sys
+import time
 import traceback
-from typing import Annotated, List, Generator, Optional
+import uuid
+from typing import (
+    Annotated,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Generator,
+    List,
+    Optional,
+)
 
+import anyio
 from fastapi import HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 import httpx
 from loguru import logger
 
 import leptonai
-from leptonai import Client
 from leptonai.kv import KV
-from leptonai.photon import Photon, StaticFiles
+from leptonai.photon import Photon
 from leptonai.photon.types import to_bool
 from leptonai.api.v0.workspace import WorkspaceInfoLocalRecord
 from leptonai.util import tool
 
+# The subsystems of the photon are in the rag package next to this file, which is
+# shipped with the photon as extra files. The photon is loaded by path, so the
+# directory of this file is not on the path otherwise.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from rag.search import (  # noqa: E402
+    ASYNC_MAX_CONNECTIONS,
+    ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+    SEARCH_BACKENDS,
+    MultiSearch,
+    SearchBackend,
+    search_session,
+)
+from rag.context import build_context_text, select_contexts  # noqa: E402
+from rag.pages import PageCache, PageFetcher  # noqa: E402
+from rag.index import local_index_main  # noqa: E402
+from rag.cache import AnswerCache, SearchCache, normalize_query  # noqa: E402
+from rag.prefetch import Prefetcher, prefetches  # noqa: E402
+from rag.store import (  # noqa: E402
+    CODECS,
+    LLM_RESPONSE_MARKER,
+    PARTIAL_STALE_SECONDS,
+    RELATED_QUESTIONS_MARKER,
+    TAIL_POLL_INTERVAL,
+    TAIL_TIMEOUT,
+    DiskTier,
+    IncrementalResult,
+    ResultStore,
+    async_close_llm_response,
+    async_iter_result,
+    close_llm_response,
+    decode_partial,
+    decode_result,
+    encode_result,
+    iter_result,
+    iterate_in_threadpool,
+    partial_key,
+    split_result,
+)
+from rag.flight import SingleFlight, StreamBroadcast, single_flight_requests  # noqa: E402
+from rag.llm import LLMClientPool, ModelRoute, ModelRouter  # noqa: E402
+from rag.metrics import (  # noqa: E402
+    RequestTrace,
+    StackSampler,
+    batch_queries,
+    cancelled_generations,
+    query_seconds,
+    related_questions_timeouts,
+    stage_seconds,
+)
+from rag.admission import (  # noqa: E402
+    AdaptiveLimiter,
+    CountingExecutor,
+    Overloaded,
+    executor_queue_depth,
+    rejections,
+)
+from rag.upstream import (  # noqa: E402
+    RetryBudget,
+    UpstreamScheduler,
+    UpstreamUnavailable,
+    search_fallbacks,
+)
+from rag.streaming import framed_response, parse_stream_protocol  # noqa: E402
+from rag.delegate import DelegateProxy  # noqa: E402
+from rag.ui import StaticAssets, ui_main  # noqa: E402
+
 ################################################################################
 # Constant values for the RAG model.
 ################################################################################
 
-# Search engine related. You don't really need to change this.
-BING_SEARCH_V7_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
-BING_MKT = "en-US"
-GOOGLE_SEARCH_ENDPOINT = "https://customsearch.googleapis.com/customsearch/v1"
-SERPER_SEARCH_ENDPOINT = "https://google.serper.dev/search"
-SEARCHAPI_SEARCH_ENDPOINT = "https://www.searchapi.io/api/v1/search"
+# The OpenAI compatible endpoint of the LLM model. {model} is replaced by the
+# LLM_MODEL env variable.
+LLM_BASE_URL_TEMPLATE = "https://{model}.lepton.run/api/v1/"
 
-# Specify the number of references from the search engine you want to use.
-# 8 is usually a good number.
-REFERENCE_COUNT = 8
-
-# Specify the default timeout for the search engine. If the search engine
-# does not respond within this time, we will return an error.
-DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
+# The modules that the LLM clients import on their first use, which takes about a
+# second. They are imported during init instead, in the background.
+_LAZY_IMPORTS = ["openai", "openai.resources.chat"]
+# The key read from the KV to open a connection to it when the replica starts.
+_WARM_UP_KEY = "warm-up"
+# How long a query of a batch waits for a rate limited or unhealthy upstream.
+_BATCH_UPSTREAM_WAIT = 60
 
 
 # If the user did not provide a query, we will use this default query.
@@ -94,200 +177,6 @@ Remember, based on the original question and related contexts, suggest three suc
 """
 
 
-def search_with_bing(query: str, subscription_key: str):
-    """
-    Search with bing and return the contexts.
-    """
-    params = {"q": query, "mkt": BING_MKT}
-    response = requests.get(
-        BING_SEARCH_V7_ENDPOINT,
-        headers={"Ocp-Apim-Subscription-Key": subscription_key},
-        params=params,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
-    try:
-        contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-    return contexts
-
-
-def search_with_google(query: str, subscription_key: str, cx: str):
-    """
-    Search with google and return the contexts.
-    """
-    params = {
-        "key": subscription_key,
-        "cx": cx,
-        "q": query,
-        "num": REFERENCE_COUNT,
-    }
-    response = requests.get(
-        GOOGLE_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
-    try:
-        contexts = json_content["items"][:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-    return contexts
-
-
-def search_with_serper(query: str, subscription_key: str):
-    """
-    Search with serper and return the contexts.
-    """
-    payload = json.dumps({
-        "q": query,
-        "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
-        ),
-    })
-    headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SERPER_SEARCH_ENDPOINT}"
-    )
-    response = requests.post(
-        SERPER_SEARCH_ENDPOINT,
-        headers=headers,
-        data=payload,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
-    try:
-        # convert to the same format as bing/google
-        contexts = []
-        if json_content.get("knowledgeGraph"):
-            url = json_content["knowledgeGraph"].get("descriptionUrl") or json_content["knowledgeGraph"].get("website")
-            snippet = json_content["knowledgeGraph"].get("description")
-            if url and snippet:
-                contexts.append({
-                    "name": json_content["knowledgeGraph"].get("title",""),
-                    "url": url,
-                    "snippet": snippet
-                })
-        if json_content.get("answerBox"):
-            url = json_content["answerBox"].get("url")
-            snippet = json_content["answerBox"].get("snippet") or json_content["answerBox"].get("answer")
-            if url and snippet:
-                contexts.append({
-                    "name": json_content["answerBox"].get("title",""),
-                    "url": url,
-                    "snippet": snippet
-                })
-        contexts += [
-            {"name": c["title"], "url": c["link"], "snippet": c.get("snippet","")}
-            for c in json_content["organic"]
-        ]
-        return contexts[:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-
-def search_with_searchapi(query: str, subscription_key: str):
-    """
-    Search with SearchApi.io and return the contexts.
-    """
-    payload = {
-        "q": query,
-        "engine": "google",
-        "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
-        ),
-    }
-    headers = {"Authorization": f"Bearer {subscription_key}", "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SEARCHAPI_SEARCH_ENDPOINT}"
-    )
-    response = requests.get(
-        SEARCHAPI_SEARCH_ENDPOINT,
-        headers=headers,
-        params=payload,
-        timeout=30,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
-    try:
-        # convert to the same format as bing/google
-        contexts = []
-
-        if json_content.get("answer_box"):
-            if json_content["answer_box"].get("organic_result"):
-                title = json_content["answer_box"].get("organic_result").get("title", "")
-                url = json_content["answer_box"].get("organic_result").get("link", "")
-            if json_content["answer_box"].get("type") == "population_graph":
-                title = json_content["answer_box"].get("place", "")
-                url = json_content["answer_box"].get("explore_more_link", "")
-
-            title = json_content["answer_box"].get("title", "")
-            url = json_content["answer_box"].get("link")
-            snippet =  json_content["answer_box"].get("answer") or json_content["answer_box"].get("snippet")
-
-            if url and snippet:
-                contexts.append({
-                    "name": title,
-                    "url": url,
-                    "snippet": snippet
-                })
-
-        if json_content.get("knowledge_graph"):
-            if json_content["knowledge_graph"].get("source"):
-                url = json_content["knowledge_graph"].get("source").get("link", "")
-
-            url = json_content["knowledge_graph"].get("website", "")
-            snippet = json_content["knowledge_graph"].get("description")
-
-            if url and snippet:
-                contexts.append({
-                    "name": json_content["knowledge_graph"].get("title", ""),
-                    "url": url,
-                    "snippet": snippet
-                })
-
-        contexts += [
-            {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
-            for c in json_content["organic_results"]
-        ]
-        
-        if json_content.get("related_questions"):
-            for question in json_content["related_questions"]:
-                if question.get("source"):
-                    url = question.get("source").get("link", "")
-                else:
-                    url = ""  
-                    
-                snippet = question.get("answer", "")
-
-                if url and snippet:
-                    contexts.append({
-                        "name": question.get("question", ""),
-                        "url": url,
-                        "snippet": snippet
-                    })
-
-        return contexts[:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-
 class RAG(Photon):
     """
     Retrieval-Augmented Generation Demo from Lepton AI.
@@ -302,7 +191,7 @@ class RAG(Photon):
         "openai",  # for openai client usage.
     ]
 
-    extra_files = glob.glob("ui/**/*", recursive=True)
+    extra_files = glob.glob("ui/**/*", recursive=True) + glob.glob("rag/*.py")
 
     deployment_template = {
         # All actual computations are carried out via remote apis, so
@@ -311,23 +200,219 @@ class RAG(Photon):
         "resource_shape": "cpu.small",
         # You most likely don't need to change this.
         "env": {
-            # Choose the backend. Currently, we support BING and GOOGLE. For
+            # Choose the backend. Currently, we support BING, GOOGLE, SERPER,
+            # SEARCHAPI and LOCAL, a self-hosted index (see SEARCH_BACKENDS), as
+            # well as MULTI to use several backends at once. For
             # simplicity, in this demo, if you specify the backend as LEPTON,
             # we will use the hosted serverless version of lepton search api
             # at https://search-api.lepton.run/ to do the search and RAG, which
             # runs the same code (slightly modified and might contain improvements)
             # as this demo.
             "BACKEND": "LEPTON",
+            # The url of the hosted search api used by BACKEND=LEPTON, and the
+            # longest wait in seconds for the next chunk of its responses. The
+            # answers it returns are stored like the other backends' ones, so
+            # that their replays are served locally.
+            "LEPTON_SEARCH_API_URL": "https://search-api.lepton.run/",
+            "LEPTON_SEARCH_API_TIMEOUT": "120",
             # If you are using google, specify the search cx.
             "GOOGLE_SEARCH_CX": "",
             # Specify the LLM model you are going to use.
             "LLM_MODEL": "mixtral-8x7b",
+            # To route the answers and the related questions to several models,
+            # the comma separated models to use, in order of preference, such as
+            # "mixtral-8x7b,llama2-70b". A model can be given an OpenAI compatible
+            # endpoint of its own as model=base_url. The calls go to the model
+            # with the best recent time to first token and error rate, and fall
+            # back to the next one if they fail before the first token, or have
+            # no first token LLM_ROUTE_TIMEOUT seconds after they were sent. If
+            # empty, LLM_MODEL is used for the answers, and the answer models for
+            # the related questions.
+            "LLM_MODELS": "",
+            "RELATED_QUESTIONS_MODELS": "",
+            "LLM_ROUTE_TIMEOUT": "10",
             # For all the search queries and results, we will use the Lepton KV to
             # store them so that we can retrieve them later. Specify the name of the
             # KV here.
             "KV_NAME": "search-with-lepton",
             # If set to true, will generate related questions. Otherwise, will not.
             "RELATED_QUESTIONS": "true",
+            # If the related questions are not ready this many seconds after the
+            # answer, they are cancelled and the stream ends without them.
+            "RELATED_QUESTIONS_DEADLINE": "2",
+            # If set to more than 0, the search results of the related questions
+            # are prefetched in the background on this many threads, at most
+            # PREFETCH_RATE searches per second, and kept for PREFETCH_TTL
+            # seconds, so that the query of a related question that is clicked
+            # skips the search. The prefetches are skipped when the threads are
+            # busy or queries are queued.
+            "PREFETCH_WORKERS": "0",
+            "PREFETCH_RATE": "2",
+            "PREFETCH_TTL": "300",
+            "PREFETCH_MAX_ENTRIES": "1024",
+            # If set to true, the pages of the top prefetched results are fetched
+            # into the page cache too, when PAGE_FETCH_TOP_K is set.
+            "PREFETCH_PAGES": "false",
+            # The search results are deduplicated, reranked if CONTEXT_RERANK is
+            # true, and packed into at most this many tokens of context for the
+            # LLM, shared by the answer and the related questions. Set to 0 for
+            # no limit.
+            "CONTEXT_TOKEN_BUDGET": "2048",
+            "CONTEXT_RERANK": "true",
+            # The directory of the local index of BACKEND=LOCAL, built with
+            # `python search_with_lepton.py index add`, and how many postings of
+            # each query term are read at most: fewer is faster, but may miss
+            # passages where each of the terms weighs little.
+            "LOCAL_INDEX_DIR": "local_index",
+            "LOCAL_INDEX_MAX_POSTINGS": "2000",
+            # If set to more than 0, the pages of this many top search results are
+            # fetched, and their passages that are the most relevant to the query
+            # are added to the context. Each page is fetched within
+            # PAGE_FETCH_TIMEOUT seconds and PAGE_FETCH_MAX_BYTES bytes, and the
+            # pages not fetched within PAGE_FETCH_BUDGET seconds are skipped.
+            "PAGE_FETCH_TOP_K": "0",
+            "PAGE_FETCH_TIMEOUT": "1",
+            "PAGE_FETCH_BUDGET": "1.5",
+            "PAGE_FETCH_MAX_BYTES": "1048576",
+            # The maximum number of tokens of passages added per page.
+            "PAGE_FETCH_PASSAGE_TOKENS": "256",
+            # If set to true, the sources are streamed to the client before the
+            # pages are fetched, so that the time to first byte does not change.
+            "PAGE_FETCH_SOURCES_FIRST": "true",
+            # The fetched pages are cached on disk in PAGE_CACHE_DIR, up to
+            # PAGE_CACHE_MAX_BYTES bytes, and revalidated with their ETag after
+            # PAGE_CACHE_TTL seconds.
+            "PAGE_CACHE_DIR": "/tmp/search_with_lepton/pages",
+            "PAGE_CACHE_MAX_BYTES": "268435456",
+            "PAGE_CACHE_TTL": "86400",
+            # If set to true, a generation whose client goes away is cancelled,
+            # unless other requests follow it, to free the LLM capacity. If set to
+            # false, it runs to the end and is stored for later viewers.
+            "CANCEL_ON_DISCONNECT": "true",
+            # If set to true, the search, the LLM stream and the related questions
+            # are all carried out with asyncio on shared keep-alive clients, so a
+            # single replica can hold many more in-flight streams than there are
+            # handler threads.
+            "ASYNC_MODE": "false",
+            # The maximum number of concurrent search engine calls and LLM calls
+            # of the /batch_query batches of this replica, and the maximum number
+            # of queries in a batch.
+            "BATCH_SEARCH_CONCURRENCY": "16",
+            "BATCH_LLM_CONCURRENCY": "16",
+            "BATCH_MAX_QUERIES": "10000",
+            # In the framed protocols of /query (see stream_protocol), the pieces
+            # of the answer are coalesced into one event per
+            # STREAM_COALESCE_SECONDS seconds or STREAM_COALESCE_BYTES bytes, and
+            # the events are compressed with gzip if STREAM_COMPRESSION is true
+            # and the client accepts it.
+            "STREAM_COALESCE_SECONDS": "0.03",
+            "STREAM_COALESCE_BYTES": "512",
+            "STREAM_COMPRESSION": "true",
+            # If BACKEND is MULTI, the comma separated search backends to use, in
+            # order of preference.
+            "MULTI_SEARCH_BACKENDS": "SERPER,BING",
+            # How the MULTI backend uses its search backends: "hedge" fires the
+            # next backend only if the previous ones are slower than their p95
+            # latency, "race" fires all of them and takes the first good result,
+            # and "merge" fires all of them and merges their results.
+            "MULTI_SEARCH_MODE": "hedge",
+            # Search results are cached by normalized query for this many seconds,
+            # so that popular queries do not hit the search engine again. Set to 0
+            # to disable the cache.
+            "SEARCH_CACHE_TTL": "3600",
+            # The maximum total size in bytes of the search results cached in
+            # memory.
+            "SEARCH_CACHE_MAX_BYTES": "67108864",
+            # If set to true, the search results are also cached in the KV, so
+            # that they are shared by all the replicas.
+            "SEARCH_CACHE_KV": "false",
+            # Generated answers are replayed for near-identical queries asked
+            # within this many seconds, skipping the search and the LLM. Set to 0
+            # to disable the answer cache.
+            "ANSWER_CACHE_TTL": "0",
+            # The minimum similarity (between 0 and 1) for two queries to share
+            # the same answer.
+            "ANSWER_CACHE_THRESHOLD": "0.9",
+            # The maximum total size in bytes of the answers cached in memory.
+            "ANSWER_CACHE_MAX_BYTES": "67108864",
+            # While an answer is being generated, the part generated so far is
+            # flushed to the KV every KV_FLUSH_BYTES bytes or KV_FLUSH_INTERVAL
+            # seconds, so that other viewers of the same search can tail it. Set
+            # KV_FLUSH_BYTES to 0 to only write the complete answer. Each flush
+            # rewrites the whole answer so far, so there are at most
+            # KV_MAX_FLUSHES of them per answer, and then one every 15 seconds.
+            "KV_FLUSH_BYTES": "2048",
+            "KV_FLUSH_INTERVAL": "1",
+            "KV_MAX_FLUSHES": "20",
+            # How the complete answers are compressed in the KV: none keeps the
+            # plain text format, which every version reads, and zstd (or zlib if
+            # the zstandard package is not installed) or zlib store them smaller,
+            # once no replica of an earlier version reads the KV. Answers in
+            # either format can be read.
+            "KV_COMPRESSION": "none",
+            # The complete answers read from or written to the KV are kept in
+            # memory, up to RESULT_CACHE_MAX_BYTES, so that the replays of a shared
+            # link do not go to the KV each time. If RESULT_CACHE_DIR is set, they
+            # are also kept in memory-mapped files there, up to
+            # RESULT_CACHE_DISK_BYTES, which survive restarts. Search uuids missing
+            # from the KV are remembered for RESULT_CACHE_NEGATIVE_TTL seconds.
+            "RESULT_CACHE_MAX_BYTES": "134217728",
+            "RESULT_CACHE_DIR": "",
+            "RESULT_CACHE_DISK_BYTES": "1073741824",
+            "RESULT_CACHE_NEGATIVE_TTL": "10",
+            # If set to true, concurrent requests for the same search uuid or the
+            # same query on this replica share a single search and LLM call, and
+            # the later ones follow the stream of the first one.
+            "SINGLE_FLIGHT": "true",
+            # The maximum total size in bytes of the in-flight responses buffered
+            # for their followers. Beyond that, requests are not de-duplicated.
+            "SINGLE_FLIGHT_MAX_BYTES": "268435456",
+            # Queries that take longer than this many seconds are logged with the
+            # time spent in each stage. Set to 0 to disable.
+            "SLOW_QUERY_SECONDS": "0",
+            # If set to true, a sampling profiler runs in the background, and the
+            # hottest stacks are logged along with the slow queries.
+            "PROFILE_SLOW_QUERIES": "false",
+            # The number of concurrent generations is adapted between these two
+            # bounds: it grows while the search and the LLM get to the first
+            # token within ADMISSION_TARGET_LATENCY seconds, and shrinks when they
+            # do not.
+            "ADMISSION_MIN_CONCURRENCY": "16",
+            "ADMISSION_MAX_CONCURRENCY": "256",
+            "ADMISSION_TARGET_LATENCY": "5",
+            # Queries over the limit wait up to ADMISSION_MAX_WAIT seconds, and
+            # at most ADMISSION_MAX_QUEUE of them at once. The others are
+            # rejected right away with 429 or 503 and a Retry-After header.
+            "ADMISSION_MAX_QUEUE": "64",
+            "ADMISSION_MAX_WAIT": "2",
+            # The rate limits of the search backends and LLM models, as comma
+            # separated name=rate or name=rate:burst, in calls per second, such as
+            # "BING=50:100,mixtral-8x7b=20". Calls over the limit wait up to
+            # UPSTREAM_MAX_WAIT seconds, like those to an upstream that returned a
+            # Retry-After, and fail with 503 beyond that.
+            "UPSTREAM_RATE_LIMITS": "",
+            "UPSTREAM_MAX_WAIT": "1",
+            # Failed upstream calls are retried as long as the retries of the last
+            # 10 seconds are fewer than RETRY_BUDGET_RATIO of the calls, plus
+            # RETRY_BUDGET_MIN_PER_SECOND per second.
+            "RETRY_BUDGET_RATIO": "0.1",
+            "RETRY_BUDGET_MIN_PER_SECOND": "1",
+            # After CIRCUIT_BREAKER_FAILURES consecutive failures, the calls to an
+            # upstream fail fast for CIRCUIT_BREAKER_RESET_TIMEOUT seconds, and
+            # the search goes to SEARCH_FALLBACK_BACKEND if it is set.
+            "CIRCUIT_BREAKER_FAILURES": "5",
+            "CIRCUIT_BREAKER_RESET_TIMEOUT": "10",
+            "SEARCH_FALLBACK_BACKEND": "",
+            # If set to true, the connections to the search engine, the LLM
+            # endpoints and the KV are opened on the first readiness probe, and
+            # /readyz reports the replica ready once they are, or after
+            # WARM_UP_TIMEOUT seconds, so that it gets traffic only once it is
+            # warm. /healthz always reports it alive.
+            "WARM_UP": "true",
+            "WARM_UP_TIMEOUT": "10",
+            # The UI files are served from memory, up to this many bytes in
+            # total, including their compressed versions.
+            "UI_CACHE_MAX_BYTES": "67108864",
             # On the lepton platform, allow web access when you are logged in.
             "LEPTON_ENABLE_AUTH_BY_COOKIE": "true",
         },
@@ -355,84 +440,497 @@ class RAG(Photon):
 
     def local_client(self):
         """
-        Gets a thread-local client, so in case openai clients are not thread safe,
-        each thread will have its own client.
+        Gets the pooled client of the LLM endpoint. The client is shared by all the
+        handler threads, as openai clients are thread safe.
         """
-        import openai
+        return self.llm_client_pool.get(LLM_BASE_URL_TEMPLATE.format(model=self.model))
 
-        thread_local = threading.local()
-        try:
-            return thread_local.client
-        except AttributeError:
-            thread_local.client = openai.OpenAI(
-                base_url=f"https://{self.model}.lepton.run/api/v1/",
-                api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
-                or WorkspaceInfoLocalRecord.get_current_workspace_token(),
-                # We will set the connect timeout to be 10 seconds, and read/write
-                # timeout to be 120 seconds, in case the inference server is
-                # overloaded.
-                timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+    def local_async_client(self):
+        """
+        Gets the pooled async client of the LLM endpoint, used in the async mode.
+        """
+        return self.llm_client_pool.get_async(
+            LLM_BASE_URL_TEMPLATE.format(model=self.model)
+        )
+
+    def _model_router(self, name: str, models: str) -> ModelRouter:
+        """
+        Creates the router of the given comma separated models, each given as
+        model or model=base_url. A model with a fallback is not retried, as it is
+        faster to go to the next one. Otherwise, its Upstream retries it, in
+        place of the openai clients, which do not retry.
+        """
+        entries = [m.strip().partition("=") for m in models.split(",") if m.strip()]
+        routes = [
+            ModelRoute(
+                model,
+                base_url or LLM_BASE_URL_TEMPLATE.format(model=model),
+                self.upstreams.upstream(
+                    model, retries=0 if len(entries) > 1 else 2, backoff=0.5
+                ),
             )
-            return thread_local.client
+            for model, _, base_url in entries
+        ]
+        return ModelRouter(
+            name,
+            routes,
+            self.llm_client_pool,
+            route_timeout=float(os.environ["LLM_ROUTE_TIMEOUT"]),
+            max_concurrency=int(os.environ["ADMISSION_MAX_CONCURRENCY"]),
+        )
+
+    def _search_backend(self, name: str) -> SearchBackend:
+        """
+        Returns the registered search backend of the given name, scheduled by the
+        upstream scheduler.
+        """
+        name = name.strip()
+        if name not in SEARCH_BACKENDS:
+            raise RuntimeError(
+                f"Backend must be LEPTON, MULTI or one of {', '.join(SEARCH_BACKENDS)}."
+            )
+        backend = SEARCH_BACKENDS[name].from_env()
+        backend.upstream = self.upstreams.upstream(
+            name, backend.retries, backend.retry_backoff
+        )
+        return backend
 
     def init(self):
         """
         Initializes photon configs.
         """
-        # First, log in to the workspace.
-        leptonai.api.v0.workspace.login()
+        start = time.perf_counter()
+        # Executors to carry out async tasks. Foreground work that a query is
+        # waiting for and the background KV writes have their own threads, so
+        # that neither queues behind the other. The related questions hold no
+        # thread, as they are always generated on the event loop.
+        self.executor = CountingExecutor(max_workers=self.handler_max_concurrency * 2)
+        self.kv_executor = CountingExecutor(max_workers=self.handler_max_concurrency)
+        for pool, executor in (
+            ("foreground", self.executor),
+            ("kv", self.kv_executor),
+        ):
+            executor_queue_depth.labels(pool).set_function(
+                functools.partial(getattr, executor, "waiting")
+            )
+        # The workspace login and the creation of the KV, which call the Lepton
+        # API, run in the background while the rest is set up. So do the imports
+        # that the LLM clients need, which the warm-up waits for.
+        login = self.executor.submit(leptonai.api.v0.workspace.login)
+        kv = self.executor.submit(self._create_kv, login)
+        self._imports = [
+            self.executor.submit(importlib.import_module, name)
+            for name in _LAZY_IMPORTS
+        ]
+        # The admission control of the generations.
+        self.admission = AdaptiveLimiter(
+            initial_limit=int(os.environ["ADMISSION_MIN_CONCURRENCY"]),
+            min_limit=int(os.environ["ADMISSION_MIN_CONCURRENCY"]),
+            max_limit=int(os.environ["ADMISSION_MAX_CONCURRENCY"]),
+            target_latency=float(os.environ["ADMISSION_TARGET_LATENCY"]),
+            max_queue=int(os.environ["ADMISSION_MAX_QUEUE"]),
+            max_wait=float(os.environ["ADMISSION_MAX_WAIT"]),
+        )
+        # The rate limits, retries and circuit breakers of the upstream calls.
+        self.upstreams = UpstreamScheduler(
+            rate_limits=UpstreamScheduler.parse_rate_limits(
+                os.environ["UPSTREAM_RATE_LIMITS"]
+            ),
+            max_wait=float(os.environ["UPSTREAM_MAX_WAIT"]),
+            budget=RetryBudget(
+                ratio=float(os.environ["RETRY_BUDGET_RATIO"]),
+                min_per_second=float(os.environ["RETRY_BUDGET_MIN_PER_SECOND"]),
+            ),
+            breaker_failures=int(os.environ["CIRCUIT_BREAKER_FAILURES"]),
+            breaker_reset_timeout=float(os.environ["CIRCUIT_BREAKER_RESET_TIMEOUT"]),
+        )
         self.backend = os.environ["BACKEND"].upper()
         if self.backend == "LEPTON":
-            self.leptonsearch_client = Client(
-                "https://search-api.lepton.run/",
+            login.result()
+            self.delegate = DelegateProxy(
+                os.environ["LEPTON_SEARCH_API_URL"],
                 token=os.environ.get("LEPTON_WORKSPACE_TOKEN")
                 or WorkspaceInfoLocalRecord.get_current_workspace_token(),
-                stream=True,
-                timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+                timeout=float(os.environ["LEPTON_SEARCH_API_TIMEOUT"]),
+                upstream=self.upstreams.upstream("LEPTON"),
             )
-        elif self.backend == "BING":
-            self.search_api_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
-            self.search_function = lambda query: search_with_bing(
-                query,
-                self.search_api_key,
+        elif self.backend == "MULTI":
+            self.multi_search = MultiSearch(
+                {
+                    name: self._search_backend(name)
+                    for name in os.environ["MULTI_SEARCH_BACKENDS"].upper().split(",")
+                    if name.strip()
+                },
+                mode=os.environ["MULTI_SEARCH_MODE"].lower(),
+                executor=self.executor,
             )
-        elif self.backend == "GOOGLE":
-            self.search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_google(
-                query,
-                self.search_api_key,
-                os.environ["GOOGLE_SEARCH_CX"],
+        else:
+            self.search_backend = self._search_backend(self.backend)
+        # The backend to search with when the search backend fails.
+        self.search_fallback = None
+        if os.environ["SEARCH_FALLBACK_BACKEND"] and self.backend != "LEPTON":
+            self.search_fallback = self._search_backend(
+                os.environ["SEARCH_FALLBACK_BACKEND"].upper()
             )
-        elif self.backend == "SERPER":
-            self.search_api_key = os.environ["SERPER_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_serper(
-                query,
-                self.search_api_key,
+        # The pooled session of the search engine calls in the threaded mode.
+        self.search_session = search_session()
+        self.model = os.environ["LLM_MODEL"]
+        # The KV to store the search results.
+        self.kv = kv.result()
+        # How often the in-progress answers are flushed to the KV.
+        self.kv_flush_bytes = int(os.environ["KV_FLUSH_BYTES"])
+        self.kv_flush_interval = float(os.environ["KV_FLUSH_INTERVAL"])
+        self.kv_max_flushes = int(os.environ["KV_MAX_FLUSHES"])
+        self.kv_compression = os.environ["KV_COMPRESSION"].lower()
+        if self.kv_compression not in CODECS:
+            raise RuntimeError("KV_COMPRESSION must be zstd, zlib or none.")
+        # The local tiers of the complete answers in front of the KV.
+        result_disk = None
+        if os.environ["RESULT_CACHE_DIR"]:
+            try:
+                result_disk = DiskTier(
+                    os.environ["RESULT_CACHE_DIR"],
+                    int(os.environ["RESULT_CACHE_DISK_BYTES"]),
+                )
+            except RuntimeError as e:
+                logger.warning(f"Not using the disk tier of the results: {e}")
+        self.results = ResultStore(
+            self.kv,
+            max_bytes=int(os.environ["RESULT_CACHE_MAX_BYTES"]),
+            negative_ttl=float(os.environ["RESULT_CACHE_NEGATIVE_TTL"]),
+            disk=result_disk,
+        )
+        # Tasks that need to outlive the request that started them.
+        self._background_tasks = set()
+        # The cache of search results, keyed by normalized query and backend.
+        search_cache_ttl = float(os.environ["SEARCH_CACHE_TTL"])
+        if search_cache_ttl > 0 and self.backend != "LEPTON":
+            self.search_cache = SearchCache(
+                ttl=search_cache_ttl,
+                max_bytes=int(os.environ["SEARCH_CACHE_MAX_BYTES"]),
+                kv=self.kv if to_bool(os.environ["SEARCH_CACHE_KV"]) else None,
+                prefix="search-cache/",
             )
-        elif self.backend == "SEARCHAPI":
-            self.search_api_key = os.environ["SEARCHAPI_API_KEY"]
-            self.search_function = lambda query: search_with_searchapi(
-                query,
-                self.search_api_key,
+        else:
+            self.search_cache = None
+        # The cache of the complete answers, for near-identical queries.
+        answer_cache_ttl = float(os.environ["ANSWER_CACHE_TTL"])
+        if answer_cache_ttl > 0 and self.backend != "LEPTON":
+            self.answer_cache = AnswerCache(
+                threshold=float(os.environ["ANSWER_CACHE_THRESHOLD"]),
+                ttl=answer_cache_ttl,
+                max_bytes=int(os.environ["ANSWER_CACHE_MAX_BYTES"]),
             )
         else:
-            raise RuntimeError("Backend must be LEPTON, BING, GOOGLE, SERPER or SEARCHAPI.")
-        self.model = os.environ["LLM_MODEL"]
-        # An executor to carry out async tasks, such as uploading to KV.
-        self.executor = concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.handler_max_concurrency * 2
+            self.answer_cache = None
+        # De-duplication of the concurrent identical queries on this replica.
+        if to_bool(os.environ["SINGLE_FLIGHT"]):
+            self.single_flight = SingleFlight(
+                max_bytes=int(os.environ["SINGLE_FLIGHT_MAX_BYTES"])
+            )
+        else:
+            self.single_flight = None
+        # Logging of the slow queries.
+        self.slow_query_seconds = float(os.environ["SLOW_QUERY_SECONDS"])
+        if self.slow_query_seconds > 0 and to_bool(os.environ["PROFILE_SLOW_QUERIES"]):
+            self.stack_sampler = StackSampler()
+        else:
+            self.stack_sampler = None
+        # whether we should generate related questions.
+        self.should_do_related_questions = to_bool(os.environ["RELATED_QUESTIONS"])
+        self.related_questions_deadline = float(
+            os.environ["RELATED_QUESTIONS_DEADLINE"]
+        )
+        # How the search results are packed into the prompts.
+        self.context_token_budget = int(os.environ["CONTEXT_TOKEN_BUDGET"])
+        self.context_rerank = to_bool(os.environ["CONTEXT_RERANK"])
+        # The enrichment of the contexts with the pages they link to.
+        page_fetch_top_k = int(os.environ["PAGE_FETCH_TOP_K"])
+        if page_fetch_top_k > 0 and self.backend != "LEPTON":
+            self.page_fetcher = PageFetcher(
+                PageCache(
+                    os.environ["PAGE_CACHE_DIR"],
+                    max_bytes=int(os.environ["PAGE_CACHE_MAX_BYTES"]),
+                    ttl=float(os.environ["PAGE_CACHE_TTL"]),
+                ),
+                top_k=page_fetch_top_k,
+                fetch_timeout=float(os.environ["PAGE_FETCH_TIMEOUT"]),
+                total_timeout=float(os.environ["PAGE_FETCH_BUDGET"]),
+                max_bytes=int(os.environ["PAGE_FETCH_MAX_BYTES"]),
+                passage_tokens=int(os.environ["PAGE_FETCH_PASSAGE_TOKENS"]),
+            )
+        else:
+            self.page_fetcher = None
+        self.page_fetch_sources_first = to_bool(os.environ["PAGE_FETCH_SOURCES_FIRST"])
+        # The prefetch of the search results of the related questions.
+        prefetch_workers = int(os.environ["PREFETCH_WORKERS"])
+        if prefetch_workers > 0 and self.backend != "LEPTON":
+            self.prefetcher = Prefetcher(
+                self.search_function,
+                ttl=float(os.environ["PREFETCH_TTL"]),
+                max_entries=int(os.environ["PREFETCH_MAX_ENTRIES"]),
+                workers=prefetch_workers,
+                rate=float(os.environ["PREFETCH_RATE"]),
+                is_cached=self._search_cached,
+                fetch_pages=(
+                    self._fetch_pages
+                    if self.page_fetcher is not None
+                    and to_bool(os.environ["PREFETCH_PAGES"])
+                    else None
+                ),
+            )
+        else:
+            self.prefetcher = None
+        # whether we should cancel the generations whose client went away.
+        self.cancel_on_disconnect = to_bool(os.environ["CANCEL_ON_DISCONNECT"])
+        # whether we should serve the queries with asyncio.
+        self.async_mode = to_bool(os.environ["ASYNC_MODE"])
+        # The bounds of the batch queries. The semaphores are created lazily, as
+        # they need to be created inside the event loop.
+        self.batch_search_concurrency = int(os.environ["BATCH_SEARCH_CONCURRENCY"])
+        self.batch_llm_concurrency = int(os.environ["BATCH_LLM_CONCURRENCY"])
+        self.batch_max_queries = int(os.environ["BATCH_MAX_QUERIES"])
+        self._batch_search_limiter = None
+        self._batch_llm_limiter = None
+        # The coalescing and the compression of the framed streams.
+        self.stream_coalesce_seconds = float(os.environ["STREAM_COALESCE_SECONDS"])
+        self.stream_coalesce_bytes = int(os.environ["STREAM_COALESCE_BYTES"])
+        self.stream_compression = to_bool(os.environ["STREAM_COMPRESSION"])
+        # In the async mode, the search engine calls share one keep-alive client.
+        self.async_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+        # The pool of LLM clients, so that connections to the LLM endpoint are
+        # reused across requests.
+        login.result()
+        self.llm_client_pool = LLMClientPool(
+            api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
+            or WorkspaceInfoLocalRecord.get_current_workspace_token(),
         )
-        # Create the KV to store the search results.
+        # The routing of the LLM calls across models.
+        answer_models = os.environ["LLM_MODELS"] or self.model
+        self.answer_router = self._model_router("answer", answer_models)
+        self.related_questions_router = self._model_router(
+            "related_questions", os.environ["RELATED_QUESTIONS_MODELS"] or answer_models
+        )
+        # The event loop of the server, for the handler threads. It is set by the
+        # first query.
+        self._event_loop = None
+        # The warm-up of the replica, which starts with the first readiness probe.
+        # Until it is done, /readyz reports that the replica is not ready.
+        self.warm_up_timeout = float(os.environ["WARM_UP_TIMEOUT"])
+        self.ready = not to_bool(os.environ["WARM_UP"])
+        self._warm_up_task = None
+        self.ui_cache_max_bytes = int(os.environ["UI_CACHE_MAX_BYTES"])
+        logger.info(f"Initialized in {time.perf_counter() - start:.2f}s.")
+
+    def _create_kv(self, login: concurrent.futures.Future) -> KV:
+        login.result()
         logger.info("Creating KV. May take a while for the first time.")
-        self.kv = KV(
+        return KV(
             os.environ["KV_NAME"], create_if_not_exists=True, error_if_exists=False
         )
-        # whether we should generate related questions.
-        self.should_do_related_questions = to_bool(os.environ["RELATED_QUESTIONS"])
 
-    def get_related_questions(self, query, contexts):
+    def _warm_up_search(self, backend: SearchBackend):
+        if self.async_mode:
+            return backend.async_warm_up(self.async_http_client)
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, backend.warm_up, self.search_session
+        )
+
+    def _warm_up_kv(self):
+        try:
+            self.kv.get(_WARM_UP_KEY)
+        except Exception:
+            # Missing, as expected.
+            pass
+
+    async def warm_up(self):
+        """
+        Opens the connections to the search engine, the LLM endpoints and the KV,
+        and loads what the first query would otherwise load, so that the first
+        queries of a new replica are not slower than the next ones. Each step is
+        best effort: a replica whose upstreams are down still becomes ready after
+        at most WARM_UP_TIMEOUT seconds, and fails its queries as usual.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(asyncio.wrap_future(f) for f in self._imports), return_exceptions=True
+        )
+        steps = {"kv": loop.run_in_executor(self.kv_executor, self._warm_up_kv)}
+        if self.backend == "MULTI":
+            backends = list(self.multi_search.backends.values())
+        elif self.backend != "LEPTON":
+            backends = [self.search_backend]
+        else:
+            backends = []
+            steps["search api"] = self.delegate.warm_up()
+        if self.search_fallback is not None:
+            backends.append(self.search_fallback)
+        for backend in backends:
+            steps[f"search {backend.name}"] = self._warm_up_search(backend)
+        routes = self.answer_router.routes + self.related_questions_router.routes
+        for base_url in {route.base_url for route in routes}:
+            # The related questions are always generated with the async clients.
+            steps[f"llm {base_url}"] = self.llm_client_pool.async_warm_up(base_url)
+        if not self.async_mode:
+            for base_url in {route.base_url for route in self.answer_router.routes}:
+                steps[f"llm {base_url} (threaded)"] = loop.run_in_executor(
+                    self.executor, self.llm_client_pool.warm_up, base_url
+                )
+        tasks = {name: asyncio.ensure_future(step) for name, step in steps.items()}
+        done, pending = await asyncio.wait(tasks.values(), timeout=self.warm_up_timeout)
+        for name, task in tasks.items():
+            if task in pending:
+                task.cancel()
+                logger.warning(f"Warm-up of the {name} timed out.")
+            elif task.exception() is not None:
+                logger.warning(f"Warm-up of the {name} failed: {task.exception()}")
+        self.ready = True
+        logger.info(f"Warmed up in {time.perf_counter() - start:.2f}s.")
+
+    @Photon.handler(method="GET", path="/readyz", include_in_schema=False)
+    async def readyz(self) -> Response:
+        """
+        The readiness of the replica: 503 until it has warmed up. The first call
+        starts the warm-up. The liveness of the replica, /healthz, is left to the
+        photon, so that a replica whose upstreams are slow is not restarted.
+        """
+        if not self.ready:
+            if self._warm_up_task is None:
+                self._warm_up_task = asyncio.create_task(self.warm_up())
+            return JSONResponse({"status": "warming up"}, status_code=503)
+        return JSONResponse({"status": "ok"})
+
+    def search_function(self, query: str):
+        """
+        Searches the query with the configured search backend, or with the
+        fallback backend if it fails.
+        """
+        try:
+            if self.backend == "MULTI":
+                return self.multi_search.search(query, self.search_session)
+            return self.search_backend.search(query, self.search_session)
+        except Exception as e:
+            if self.search_fallback is None:
+                raise
+            logger.warning(f"Search failed, falling back to {self.search_fallback.name}: {e}")
+            search_fallbacks.labels(self.search_fallback.name).inc()
+            return self.search_fallback.search(query, self.search_session)
+
+    async def async_search_function(self, query: str):
+        """
+        The async version of search_function.
+        """
+        try:
+            if self.backend == "MULTI":
+                return await self.multi_search.async_search(query, self.async_http_client)
+            return await self.search_backend.async_search(query, self.async_http_client)
+        except Exception as e:
+            if self.search_fallback is None:
+                raise
+            logger.warning(f"Search failed, falling back to {self.search_fallback.name}: {e}")
+            search_fallbacks.labels(self.search_fallback.name).inc()
+            return await self.search_fallback.async_search(query, self.async_http_client)
+
+    def search(self, query: str):
+        """
+        Searches the query, going through the prefetched results and the search
+        cache if they are enabled.
+        """
+        contexts = self.prefetcher.take(query) if self.prefetcher else None
+        if self.search_cache is None:
+            return contexts or self.search_function(query)
+        key = self.search_cache.key(self.backend, query)
+        if contexts is None:
+            contexts = self.search_cache.get(key)
+            if contexts is None:
+                contexts = self.search_cache.get_remote(key)
+            if contexts is not None:
+                return contexts
+            contexts = self.search_function(query)
+        # Empty results are usually due to search engine errors, so we don't
+        # cache them.
+        if contexts:
+            self.search_cache.put(key, contexts)
+            _ = self.kv_executor.submit(self.search_cache.put_remote, key, contexts)
+        return contexts
+
+    async def async_search(self, query: str):
+        """
+        The async version of search.
+        """
+        contexts = self.prefetcher.take(query) if self.prefetcher else None
+        if self.search_cache is None:
+            return contexts or await self.async_search_function(query)
+        key = self.search_cache.key(self.backend, query)
+        if contexts is None:
+            contexts = self.search_cache.get(key)
+            if contexts is None and self.search_cache.kv is not None:
+                contexts = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.search_cache.get_remote, key
+                )
+            if contexts is not None:
+                return contexts
+            contexts = await self.async_search_function(query)
+        if contexts:
+            self.search_cache.put(key, contexts)
+            _ = self.kv_executor.submit(self.search_cache.put_remote, key, contexts)
+        return contexts
+
+    def _search_cached(self, query: str) -> bool:
+        """
+        Whether the search results of the query are in the in-process search
+        cache, so that prefetching them would be wasted.
+        """
+        return (
+            self.search_cache is not None
+            and self.search_cache.key(self.backend, query) in self.search_cache
+        )
+
+    def _fetch_pages(self, query: str, contexts: list):
         """
-        Gets related questions based on the query and context.
+        Fetches the pages of the top contexts into the page cache, on the event
+        loop. It blocks until they are fetched or given up.
+        """
+        asyncio.run_coroutine_threadsafe(
+            self.page_fetcher.enrich(query, contexts), self._event_loop
+        ).result()
+
+    def _prefetch_related_questions(self, related_questions: List[str]):
+        """
+        Starts the prefetch of the search results of the related questions, unless
+        queries are waiting for admission.
+        """
+        if self.prefetcher is None or not related_questions:
+            return
+        if self.admission.waiting > 0:
+            prefetches.labels("overloaded").inc(len(related_questions))
+            return
+        # The LLM returns the questions as {"question": ...} objects.
+        self.prefetcher.prefetch([
+            q["question"] if isinstance(q, dict) else str(q) for q in related_questions
+        ])
+
+    def _related_questions_wanted(self, generate_related_questions: bool) -> bool:
+        """
+        Whether to generate the related questions of a query. They are the first
+        thing to go under overload.
+        """
+        if not (self.should_do_related_questions and generate_related_questions):
+            return False
+        if self.admission.waiting > 0:
+            rejections.labels("related_questions").inc()
+            return False
+        return True
+
+    def _related_questions_request(self, query, context_text: str) -> dict:
+        """
+        Builds the chat completion request that asks for related questions.
         """
 
         def ask_related_questions(
@@ -451,32 +949,47 @@ class RAG(Photon):
             """
             pass
 
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": _more_questions_prompt.format(context=context_text),
+                },
+                {
+                    "role": "user",
+                    "content": query,
+                },
+            ],
+            "tools": [{
+                "type": "function",
+                "function": tool.get_tools_spec(ask_related_questions),
+            }],
+            "max_tokens": 512,
+        }
+
+    @staticmethod
+    def _parse_related_questions(response) -> List[str]:
+        """
+        Extracts the related questions from the tool call in the response.
+        """
+        related = response.choices[0].message.tool_calls[0].function.arguments
+        if isinstance(related, str):
+            related = json.loads(related)
+        logger.trace(f"Related questions: {related}")
+        return related["questions"][:5]
+
+    async def async_get_related_questions(self, query, context_text: str):
+        """
+        Gets related questions based on the query and context. It is cancellable,
+        and cancelling it also cancels the request to the LLM.
+        """
         try:
-            response = self.local_client().chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": _more_questions_prompt.format(
-                            context="\n\n".join([c["snippet"] for c in contexts])
-                        ),
-                    },
-                    {
-                        "role": "user",
-                        "content": query,
-                    },
-                ],
-                tools=[{
-                    "type": "function",
-                    "function": tool.get_tools_spec(ask_related_questions),
-                }],
-                max_tokens=512,
-            )
-            related = response.choices[0].message.tool_calls[0].function.arguments
-            if isinstance(related, str):
-                related = json.loads(related)
-            logger.trace(f"Related questions: {related}")
-            return related["questions"][:5]
+            with stage_seconds.labels("related_questions").time():
+                response = await self.related_questions_router.async_complete(
+                    self._related_questions_request(query, context_text)
+                )
+            return self._parse_related_questions(response)
         except Exception as e:
             # For any exceptions, we will just return an empty list.
             logger.error(
@@ -485,55 +998,600 @@ class RAG(Photon):
             )
             return []
 
-    def _raw_stream_response(
-        self, contexts, llm_response, related_questions_future
-    ) -> Generator[str, None, None]:
+    def _rag_request(self, query, context_text: str) -> dict:
         """
-        A generator that yields the raw stream response. You do not need to call
-        this directly. Instead, use the stream_and_upload_to_kv which will also
-        upload the response to KV.
+        Builds the streaming chat completion request that answers the query.
         """
-        # First, yield the contexts.
-        yield json.dumps(contexts)
-        yield "\n\n__LLM_RESPONSE__\n\n"
-        # Second, yield the llm response.
+        system_prompt = _rag_query_text.format(context=context_text)
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query},
+            ],
+            "max_tokens": 1024,
+            "stop": stop_words,
+            "stream": True,
+            "temperature": 0.9,
+        }
+
+    def _answer_request(self, query, context_text: str):
+        """
+        Returns the LLM stream of the answer request, routed to the models of the
+        answer router. The request is sent when the stream is opened, once the
+        sources are on their way to the client.
+        """
+        return self.answer_router.stream(self._rag_request(query, context_text))
+
+    def _async_answer_request(self, query, context_text: str):
+        """
+        The async version of _answer_request.
+        """
+        return self.answer_router.async_stream(self._rag_request(query, context_text))
+
+    def _enriched_answer_request(self, query, contexts, trace: RequestTrace):
+        """
+        Fetches the pages of the contexts within the enrichment deadline, and
+        returns the stream of the answer request with their best passages. Pages are fetched on
+        the event loop, on the pooled client of the page fetcher.
+        """
+        with trace.stage("enrich"):
+            passages = asyncio.run_coroutine_threadsafe(
+                self.page_fetcher.enrich(query, contexts), self._event_loop
+            ).result()
+        _, context_text = build_context_text(
+            contexts, self.context_token_budget, passages
+        )
+        return self._answer_request(query, context_text)
+
+    async def _async_enriched_answer_request(
+        self, query, contexts, trace: RequestTrace
+    ):
+        """
+        The async version of _enriched_answer_request.
+        """
+        with trace.stage("enrich"):
+            passages = await self.page_fetcher.enrich(query, contexts)
+        _, context_text = build_context_text(
+            contexts, self.context_token_budget, passages
+        )
+        return self._async_answer_request(query, context_text)
+
+    @staticmethod
+    def _stream_header(contexts) -> List[str]:
+        """
+        The first part of the stream response: the contexts, followed by the
+        marker of the llm response.
+        """
+        header = [json.dumps(contexts), LLM_RESPONSE_MARKER]
         if not contexts:
             # Prepend a warning to the user
-            yield (
+            header.append(
                 "(The search engine returned nothing for this query. Please take the"
                 " answer with a grain of salt.)\n\n"
             )
-        for chunk in llm_response:
-            if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
-        # Third, yield the related questions. If any error happens, we will just
-        # return an empty list.
+        return header
+
+    @staticmethod
+    def _stream_footer(related_questions) -> List[str]:
+        """
+        The last part of the stream response: the related questions. If any error
+        happens, we will just return an empty list.
+        """
+        try:
+            result = json.dumps(related_questions)
+        except Exception as e:
+            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            result = "[]"
+        return [RELATED_QUESTIONS_MARKER, result]
+
+    def _raw_stream_response(
+        self, contexts, llm_response, related_questions_future, trace: RequestTrace
+    ) -> Generator[str, None, None]:
+        """
+        A generator that yields the raw stream response. You do not need to call
+        this directly. Instead, use the stream_and_upload_to_kv which will also
+        upload the response to KV.
+        """
+        try:
+            # First, yield the contexts.
+            yield from self._stream_header(contexts)
+            # Second, yield the llm response, which may still be requested in
+            # the background.
+            if isinstance(llm_response, concurrent.futures.Future):
+                llm_response = llm_response.result()
+            trace.start_llm()
+            with trace.stage("llm_request"):
+                llm_response.open(0)
+            num_tokens = 0
+            for chunk in llm_response:
+                if chunk.choices:
+                    if num_tokens == 0:
+                        trace.first_token()
+                    num_tokens += 1
+                    yield chunk.choices[0].delta.content or ""
+            trace.end_llm(num_tokens)
+        finally:
+            trace.release()
+        # Third, yield the related questions.
         if related_questions_future is not None:
-            related_questions = related_questions_future.result()
+            with trace.stage("related_questions_wait"):
+                try:
+                    related_questions = related_questions_future.result(
+                        timeout=self.related_questions_deadline
+                    )
+                except concurrent.futures.TimeoutError:
+                    related_questions_future.cancel()
+                    related_questions_timeouts.inc()
+                    related_questions = []
+            self._prefetch_related_questions(related_questions)
+            yield from self._stream_footer(related_questions)
+        self._finish_trace(trace)
+
+    async def _async_raw_stream_response(
+        self, contexts, llm_response, related_questions_task, trace: RequestTrace
+    ) -> AsyncGenerator[str, None]:
+        """
+        The async version of _raw_stream_response.
+        """
+        try:
+            for header in self._stream_header(contexts):
+                yield header
+            if isinstance(llm_response, asyncio.Future):
+                llm_response = await llm_response
+            trace.start_llm()
+            with trace.stage("llm_request"):
+                await llm_response.open(0)
+            num_tokens = 0
+            async for chunk in llm_response:
+                if chunk.choices:
+                    if num_tokens == 0:
+                        trace.first_token()
+                    num_tokens += 1
+                    yield chunk.choices[0].delta.content or ""
+            trace.end_llm(num_tokens)
+        finally:
+            trace.release()
+        if related_questions_task is not None:
+            with trace.stage("related_questions_wait"):
+                try:
+                    # Cancels the related questions on timeout.
+                    related_questions = await asyncio.wait_for(
+                        related_questions_task, self.related_questions_deadline
+                    )
+                except asyncio.TimeoutError:
+                    related_questions_timeouts.inc()
+                    related_questions = []
+            self._prefetch_related_questions(related_questions)
+            for footer in self._stream_footer(related_questions):
+                yield footer
+        self._finish_trace(trace)
+
+    def _finish_trace(self, trace: RequestTrace):
+        """
+        Exports the total duration of a query, and logs its breakdown if it is
+        slow, together with the hottest stacks if the sampling profiler is on.
+        """
+        elapsed = trace.elapsed()
+        query_seconds.observe(elapsed)
+        if 0 < self.slow_query_seconds < elapsed:
+            message = f"Slow query {trace.search_uuid}: {elapsed:.3f}s, {trace.summary()}"
+            if self.stack_sampler is not None:
+                message += "\n" + self.stack_sampler.report(trace.start, time.time())
+            logger.warning(message)
+
+    def _cache_answer(self, query, contexts, result: str):
+        """
+        Puts a complete answer in the answer cache, if it is enabled.
+        """
+        # Answers generated without search results are not worth replaying.
+        if self.answer_cache is not None and query and contexts:
+            self.answer_cache.put(query, result)
+
+    def _result_metadata(self, query=None, trace: Optional[RequestTrace] = None) -> dict:
+        """
+        The metadata stored with a result. The timings are the stages of the trace,
+        which are filled in until the result is uploaded.
+        """
+        metadata = {"model": self.model, "backend": self.backend, "created": time.time()}
+        if query:
+            metadata["query"] = query
+        if trace is not None:
+            metadata["timings"] = trace.stages
+        return metadata
+
+    def _put_result(self, search_uuid: str, result: str, metadata: dict):
+        self.results.put(search_uuid, encode_result(result, metadata, self.kv_compression))
+
+    def _incremental_result(
+        self, search_uuid: str, query=None, trace: Optional[RequestTrace] = None
+    ) -> IncrementalResult:
+        return IncrementalResult(
+            self.kv,
+            search_uuid,
+            self.kv_executor,
+            flush_bytes=self.kv_flush_bytes,
+            flush_interval=self.kv_flush_interval,
+            max_flushes=self.kv_max_flushes,
+            codec=self.kv_compression,
+            metadata=self._result_metadata(query, trace),
+            store=self.results,
+        )
+
+    def _finalize_result(
+        self, result: IncrementalResult, query, contexts, broadcast=None
+    ):
+        self._cache_answer(query, contexts, result.finalize())
+        if broadcast is not None:
+            broadcast.finish()
+
+    def _drain(
+        self, stream, result: IncrementalResult, query, contexts, broadcast=None
+    ):
+        """
+        Consumes the rest of a stream whose client has gone away, so that the
+        answer, whose tokens are being paid for anyway, is still stored and its
+        followers, if any, still get it.
+        """
+        try:
+            for chunk in stream:
+                result.append(chunk)
+                if broadcast is not None:
+                    broadcast.append(chunk)
+        except Exception as e:
+            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            if broadcast is not None:
+                broadcast.finish(e)
+            return
+        self._finalize_result(result, query, contexts, broadcast)
+
+    def _should_cancel(self, broadcast: Optional[StreamBroadcast]) -> bool:
+        """
+        Whether to cancel a generation whose client went away, rather than drain
+        it: only if nobody else is following it.
+        """
+        return self.cancel_on_disconnect and (
+            broadcast is None or broadcast.followers == 0
+        )
+
+    @staticmethod
+    def _abandon(result: IncrementalResult, broadcast: Optional[StreamBroadcast]):
+        result.abandon()
+        if broadcast is not None:
+            broadcast.finish(ConnectionAbortedError("The client went away."))
+        cancelled_generations.inc()
+
+    def stream_and_upload_to_kv(
+        self,
+        contexts,
+        llm_response,
+        related_questions_future,
+        search_uuid,
+        query=None,
+        broadcast: Optional[StreamBroadcast] = None,
+        trace: Optional[RequestTrace] = None,
+    ) -> Generator[str, None, None]:
+        """
+        Streams the result and uploads to KV incrementally. If the client goes away
+        before the end of the stream, the LLM stream and the related questions are
+        cancelled, or if cancel_on_disconnect is off or the stream has followers,
+        the rest of the stream is consumed in the background and uploaded as well.
+        If the query is given, the result is also put in the answer cache. If the
+        broadcast is given, the result is also fed to the followers of the query.
+        """
+        trace = trace or RequestTrace(search_uuid)
+        result = self._incremental_result(search_uuid, query, trace)
+        stream = self._raw_stream_response(
+            contexts, llm_response, related_questions_future, trace
+        )
+        try:
+            for chunk in stream:
+                result.append(chunk)
+                if broadcast is not None:
+                    broadcast.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            if self._should_cancel(broadcast):
+                # Closing the raw stream releases its admission permit, and
+                # closing the LLM response closes its connection.
+                stream.close()
+                close_llm_response(llm_response)
+                if related_questions_future is not None:
+                    related_questions_future.cancel()
+                self._abandon(result, broadcast)
+            else:
+                _ = self.executor.submit(
+                    self._drain, stream, result, query, contexts, broadcast
+                )
+            raise
+        except Exception as e:
+            if broadcast is not None:
+                broadcast.finish(e)
+            raise
+        self._finalize_result(result, query, contexts, broadcast)
+
+    def async_stream_and_upload_to_kv(
+        self,
+        contexts,
+        llm_response,
+        related_questions_task,
+        search_uuid,
+        query=None,
+        broadcast: Optional[StreamBroadcast] = None,
+        trace: Optional[RequestTrace] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        The async version of stream_and_upload_to_kv.
+        """
+        trace = trace or RequestTrace(search_uuid)
+
+        async def cancel():
+            await async_close_llm_response(llm_response)
+            if related_questions_task is not None:
+                related_questions_task.cancel()
+
+        return self._async_upload_stream(
+            self._async_raw_stream_response(
+                contexts, llm_response, related_questions_task, trace
+            ),
+            cancel,
+            search_uuid,
+            query,
+            contexts,
+            broadcast,
+            trace,
+        )
+
+    async def _async_upload_stream(
+        self,
+        stream: AsyncGenerator[str, None],
+        cancel: Callable,
+        search_uuid: str,
+        query,
+        contexts,
+        broadcast: Optional[StreamBroadcast],
+        trace: RequestTrace,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Streams the chunks of stream and uploads them to KV incrementally. The
+        stream is consumed by a separate task, so that it is only cancelled with
+        the request when the client goes away if _should_cancel says so, in which
+        case cancel() is awaited to cancel its upstream calls.
+        """
+        result = self._incremental_result(search_uuid, query, trace)
+        queue = asyncio.Queue()
+
+        async def produce():
             try:
-                result = json.dumps(related_questions)
+                async for chunk in stream:
+                    result.append(chunk)
+                    if broadcast is not None:
+                        broadcast.append(chunk)
+                    queue.put_nowait(chunk)
+                self._finalize_result(result, query, contexts, broadcast)
+                queue.put_nowait(None)
+            except asyncio.CancelledError:
+                await cancel()
+                self._abandon(result, broadcast)
+                raise
             except Exception as e:
                 logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-                result = "[]"
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
-            yield result
+                if broadcast is not None:
+                    broadcast.finish(e)
+                queue.put_nowait(e)
 
-    def stream_and_upload_to_kv(
-        self, contexts, llm_response, related_questions_future, search_uuid
-    ) -> Generator[str, None, None]:
+        producer = asyncio.create_task(produce())
+        self._background_tasks.add(producer)
+        producer.add_done_callback(self._background_tasks.discard)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            if not producer.done() and self._should_cancel(broadcast):
+                producer.cancel()
+            raise
+
+    async def _async_delegate(
+        self,
+        query: str,
+        search_uuid: str,
+        generate_related_questions: bool,
+        broadcast: Optional[StreamBroadcast],
+        trace: RequestTrace,
+    ) -> Response:
         """
-        Streams the result and uploads to KV.
+        Delegates the query to the hosted search api, and streams its response
+        back while storing it like the answers generated here, so that its
+        replays are served locally.
         """
-        # First, stream and yield the results.
-        all_yielded_results = []
-        for result in self._raw_stream_response(
-            contexts, llm_response, related_questions_future
-        ):
-            all_yielded_results.append(result)
-            yield result
-        # Second, upload to KV. Note that if uploading to KV fails, we will silently
-        # ignore it, because we don't want to affect the user experience.
-        _ = self.executor.submit(self.kv.put, search_uuid, "".join(all_yielded_results))
+        try:
+            with trace.stage("delegate"):
+                response = await self.delegate.query(
+                    query, search_uuid, generate_related_questions
+                )
+        except Exception as e:
+            if broadcast is not None:
+                broadcast.finish(e)
+            raise
+        return StreamingResponse(
+            self._async_upload_stream(
+                DelegateProxy.iter_text(response),
+                response.aclose,
+                search_uuid,
+                query,
+                None,
+                broadcast,
+                trace,
+            ),
+            media_type="text/html",
+        )
+
+    def _fresh_partial(self, search_uuid: str) -> Optional[bytes]:
+        """
+        Returns the partial result of search_uuid if it is being generated, or None.
+        """
+        if self.kv_flush_bytes <= 0:
+            return None
+        try:
+            timestamp, content = decode_partial(self.kv.get(partial_key(search_uuid)))
+        except KeyError:
+            return None
+        except Exception as e:
+            logger.error(f"KV error: {e}")
+            return None
+        if time.time() - timestamp > PARTIAL_STALE_SECONDS:
+            return None
+        return content
+
+    def _tail_poll(self, search_uuid: str, sent: int):
+        """
+        Polls the KV once for the progress of search_uuid. Returns the new content
+        and whether the result is complete.
+        """
+        try:
+            # The result is expected to appear, so a known miss is not trusted.
+            result = self.results.get(search_uuid, negative=False)
+            result = decode_result(result).encode("utf-8")
+            return result[sent:], True
+        except KeyError:
+            pass
+        try:
+            _, content = decode_partial(self.kv.get(partial_key(search_uuid)))
+            return content[sent:], False
+        except KeyError:
+            # The partial result has just been deleted: the next poll will see the
+            # final one.
+            return b"", False
+
+    def tail_partial(self, search_uuid: str, partial: bytes) -> Generator[bytes, None, None]:
+        """
+        Streams the result of search_uuid while it is being generated elsewhere.
+        """
+        yield partial
+        sent = len(partial)
+        deadline = time.time() + TAIL_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(TAIL_POLL_INTERVAL)
+            content, done = self._tail_poll(search_uuid, sent)
+            sent += len(content)
+            if content:
+                yield content
+            if done:
+                return
+        logger.error(f"Timed out while tailing {search_uuid}.")
+
+    async def async_tail_partial(
+        self, search_uuid: str, partial: bytes
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        The async version of tail_partial.
+        """
+        yield partial
+        sent = len(partial)
+        deadline = time.time() + TAIL_TIMEOUT
+        while time.time() < deadline:
+            await asyncio.sleep(TAIL_POLL_INTERVAL)
+            content, done = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._tail_poll, search_uuid, sent
+            )
+            sent += len(content)
+            if content:
+                yield content
+            if done:
+                return
+        logger.error(f"Timed out while tailing {search_uuid}.")
+
+    def _cached_answer(self, query: str, search_uuid: str) -> Optional[StreamingResponse]:
+        """
+        If a near-identical query has been answered recently, returns its answer
+        and stores it under search_uuid, so that the link can be shared as usual.
+        Otherwise, returns None.
+        """
+        if self.answer_cache is None:
+            return None
+        result = self.answer_cache.get(query)
+        if result is None:
+            return None
+        _ = self.kv_executor.submit(
+            self._put_result, search_uuid, result, self._result_metadata(query)
+        )
+        return StreamingResponse(iter([result]), media_type="text/html")
+
+    def _flight_keys(
+        self, query: str, search_uuid: str, generate_related_questions: bool
+    ) -> List[str]:
+        # The answers with and without the related questions differ, so they are
+        # not shared.
+        related = self.should_do_related_questions and generate_related_questions
+        return [
+            search_uuid,
+            f"query/{self.backend}/{int(bool(related))}/{normalize_query(query)}",
+        ]
+
+    def _store_followed(self, broadcast: StreamBroadcast, search_uuid: str):
+        """
+        Stores the answer followed by search_uuid under it, if it was generated
+        for another search uuid, so that the link can be shared as usual.
+        """
+        if broadcast.error is None and search_uuid not in broadcast.keys:
+            _ = self.kv_executor.submit(
+                self._put_result, search_uuid, broadcast.value(), self._result_metadata()
+            )
+
+    async def _follow_stream(
+        self,
+        broadcast: StreamBroadcast,
+        search_uuid: str,
+        fallback: Callable[[], Awaitable[Response]],
+    ) -> AsyncGenerator[str, None]:
+        try:
+            started = (
+                await broadcast.async_wait(0, TAIL_TIMEOUT) and len(broadcast.chunks) > 0
+            )
+            if started:
+                async for chunk in broadcast.async_follow():
+                    yield chunk
+        finally:
+            broadcast.remove_follower()
+        if started:
+            self._store_followed(broadcast, search_uuid)
+            return
+        # The producer failed before sending anything: generate the answer by
+        # ourselves. The status can't be changed any more, so the errors
+        # interrupt the stream, as they do for the producer.
+        logger.info(f"The generation followed by {search_uuid} failed, will retry.")
+        response = await fallback()
+        if not isinstance(response, StreamingResponse):
+            raise RuntimeError(
+                f"The generation of {search_uuid} failed with {response.status_code}."
+            )
+        async for chunk in response.body_iterator:
+            yield chunk
+
+    def _follow(
+        self,
+        broadcast: StreamBroadcast,
+        search_uuid: str,
+        fallback: Callable[[], Awaitable[Response]],
+    ) -> StreamingResponse:
+        """
+        Follows a generation in progress on this replica. The follower waits for
+        the chunks on the event loop in both modes, so that it holds no thread:
+        the response is returned right away, and if the generation fails before
+        producing anything, the stream falls back to generating the answer by
+        itself with fallback.
+        """
+        broadcast.add_follower()
+        single_flight_requests.labels("follower").inc()
+        return StreamingResponse(
+            self._follow_stream(broadcast, search_uuid, fallback),
+            media_type="text/html",
+        )
 
     @Photon.handler(method="POST", path="/query")
     def query_function(
@@ -541,7 +1599,8 @@ class RAG(Photon):
         query: str,
         search_uuid: str,
         generate_related_questions: Optional[bool] = True,
-    ) -> StreamingResponse:
+        stream_protocol: Optional[str] = None,
+    ) -> Response:
         """
         Query the search engine and returns the response.
 
@@ -554,19 +1613,109 @@ class RAG(Photon):
             - generate_related_questions: if set to false, will not generate related
                 questions. Otherwise, will depend on the environment variable
                 RELATED_QUESTIONS. Default: true.
+            - stream_protocol: if set to "ndjson" or "sse" (optionally with the
+                version, such as "sse/1"), the response is streamed as typed
+                events: "sources", "delta" (coalesced pieces of the answer),
+                "related", then "done" or "error", each one a json object with
+                a type and a data field. Otherwise, the response is the plain
+                text stream with its sections separated by markers.
+
+        If the replica is overloaded, returns 429 or 503 with a Retry-After header.
         """
+        if "/" in search_uuid:
+            # The KV keys of the other namespaces, such as the partial results,
+            # have a "/".
+            raise HTTPException(
+                status_code=400, detail="search_uuid must not contain a '/'."
+            )
+        if stream_protocol:
+            try:
+                stream_protocol = parse_stream_protocol(stream_protocol)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        trace = RequestTrace(search_uuid)
+        if self._event_loop is None:
+            # The handler threads run the related questions and the page fetches
+            # on the event loop.
+            self._event_loop = anyio.from_thread.run_sync(asyncio.get_running_loop)
+        try:
+            # The delegated queries are proxied with asyncio in both modes. The
+            # handler thread is only held until the response starts: the stream
+            # itself runs on the event loop.
+            if self.async_mode or self.backend == "LEPTON":
+                response = anyio.from_thread.run(
+                    self._async_query,
+                    query,
+                    search_uuid,
+                    generate_related_questions,
+                    trace,
+                )
+            else:
+                response = self._query(
+                    query, search_uuid, generate_related_questions, trace
+                )
+        except Overloaded as e:
+            return HTMLResponse(
+                "Server overloaded, please retry later.",
+                e.status_code,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        # The errors are sent as they are, with their status code.
+        if stream_protocol and isinstance(response, StreamingResponse):
+            return framed_response(
+                response,
+                stream_protocol,
+                self.stream_coalesce_seconds,
+                self.stream_coalesce_bytes,
+                self.stream_compression,
+            )
+        return response
+
+    def _query(
+        self,
+        query: str,
+        search_uuid: str,
+        generate_related_questions: bool,
+        trace: RequestTrace,
+        single_flight: bool = True,
+    ) -> Response:
+        """
+        The threaded implementation of query_function. If single_flight is False,
+        the query never follows another generation.
+        """
+        single_flight = single_flight and self.single_flight is not None
+
+        def fallback():
+            return anyio.to_thread.run_sync(
+                self._query,
+                query,
+                search_uuid,
+                generate_related_questions,
+                trace,
+                False,
+            )
+
         # Note that, if uuid exists, we don't check if the stored query is the same
         # as the current query, and simply return the stored result. This is to enable
         # the user to share a searched link to others and have others see the same result.
         if search_uuid:
+            # If the result is being generated on this replica, follow it.
+            broadcast = single_flight and self.single_flight.get(search_uuid)
+            if broadcast:
+                return self._follow(broadcast, search_uuid, fallback)
             try:
-                result = self.kv.get(search_uuid)
-
-                def str_to_generator(result: str) -> Generator[str, None, None]:
-                    yield result
-
-                return StreamingResponse(str_to_generator(result))
+                with trace.stage("kv_lookup"):
+                    result = self.results.get(search_uuid)
+                return StreamingResponse(iter_result(result))
             except KeyError:
+                # If the result is being generated, tail it instead of generating
+                # it again.
+                partial = self._fresh_partial(search_uuid)
+                if partial is not None:
+                    logger.info(f"Key {search_uuid} is being generated, will tail it.")
+                    return StreamingResponse(
+                        self.tail_partial(search_uuid, partial), media_type="text/html"
+                    )
                 logger.info(f"Key {search_uuid} not found, will generate again.")
             except Exception as e:
                 logger.error(
@@ -575,61 +1724,459 @@ class RAG(Photon):
         else:
             raise HTTPException(status_code=400, detail="search_uuid must be provided.")
 
-        if self.backend == "LEPTON":
-            # delegate to the lepton search api.
-            result = self.leptonsearch_client.query(
-                query=query,
-                search_uuid=search_uuid,
-                generate_related_questions=generate_related_questions,
-            )
-            return StreamingResponse(content=result, media_type="text/html")
-
         # First, do a search query.
         query = query or _default_query
         # Basic attack protection: remove "[INST]" or "[/INST]" from the query
         query = re.sub(r"\[/?INST\]", "", query)
-        contexts = self.search_function(query)
+        cached = self._cached_answer(query, search_uuid)
+        if cached is not None:
+            return cached
+        broadcast = None
+        if single_flight:
+            keys = self._flight_keys(query, search_uuid, generate_related_questions)
+            broadcast, is_producer = self.single_flight.join(keys)
+            if not is_producer:
+                return self._follow(broadcast, search_uuid, fallback)
+        try:
+            trace.permit = self.admission.acquire()
+            with trace.stage("search"):
+                contexts = self.search(query)
+        except Exception as e:
+            trace.release()
+            if broadcast is not None:
+                broadcast.finish(e)
+            raise
 
-        system_prompt = _rag_query_text.format(
-            context="\n\n".join(
-                [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
-            )
-        )
         try:
-            client = self.local_client()
-            llm_response = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query},
-                ],
-                max_tokens=1024,
-                stop=stop_words,
-                stream=True,
-                temperature=0.9,
-            )
-            if self.should_do_related_questions and generate_related_questions:
+            with trace.stage("prompt"):
+                contexts = select_contexts(query, contexts, self.context_rerank)
+                packed, context_text = build_context_text(
+                    contexts, self.context_token_budget
+                )
+            if self.page_fetcher is None:
+                # The packed contexts replace the search results, so that the
+                # citations match the contexts sent to the client.
+                contexts = packed
+                llm_response = self._answer_request(query, context_text)
+            elif self.page_fetch_sources_first:
+                # The sources are streamed right away, while the pages are
+                # fetched and the answer is requested in the background.
+                llm_response = self.executor.submit(
+                    self._enriched_answer_request, query, contexts, trace
+                )
+            else:
+                llm_response = self._enriched_answer_request(query, contexts, trace)
+            if self._related_questions_wanted(generate_related_questions):
                 # While the answer is being generated, we can start generating
-                # related questions as a future.
-                related_questions_future = self.executor.submit(
-                    self.get_related_questions, query, contexts
+                # related questions as a future. They are generated on the event
+                # loop, so that they hold no thread and can be cancelled.
+                related_questions_future = asyncio.run_coroutine_threadsafe(
+                    self.async_get_related_questions(query, context_text),
+                    self._event_loop,
                 )
             else:
                 related_questions_future = None
         except Exception as e:
+            trace.release()
+            if broadcast is not None:
+                broadcast.finish(e)
+            if isinstance(e, Overloaded):
+                # The LLM is rate limited or unhealthy: tell the client when to
+                # retry.
+                logger.warning(f"LLM unavailable: {e}")
+                raise
+            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            return HTMLResponse("Internal server error.", 503)
+
+        return StreamingResponse(
+            iterate_in_threadpool(
+                self.stream_and_upload_to_kv(
+                    contexts,
+                    llm_response,
+                    related_questions_future,
+                    search_uuid,
+                    query,
+                    broadcast,
+                    trace,
+                )
+            ),
+            media_type="text/html",
+        )
+
+    async def _async_query(
+        self,
+        query: str,
+        search_uuid: str,
+        generate_related_questions: bool,
+        trace: RequestTrace,
+        single_flight: bool = True,
+    ) -> Response:
+        """
+        The async implementation of query_function. It follows the same steps as
+        _query, but never blocks the event loop: the KV lookup runs in the
+        executor unless the result is in the local tiers, and everything else runs
+        on the shared async clients.
+        """
+        single_flight = single_flight and self.single_flight is not None
+
+        def fallback():
+            return self._async_query(
+                query, search_uuid, generate_related_questions, trace, False
+            )
+
+        if search_uuid:
+            broadcast = single_flight and self.single_flight.get(search_uuid)
+            if broadcast:
+                return self._follow(broadcast, search_uuid, fallback)
+            try:
+                with trace.stage("kv_lookup"):
+                    result = self.results.get_local(search_uuid)
+                    if result is None:
+                        result = await asyncio.get_running_loop().run_in_executor(
+                            self.executor, self.results.get, search_uuid
+                        )
+                return StreamingResponse(async_iter_result(result))
+            except KeyError:
+                partial = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._fresh_partial, search_uuid
+                )
+                if partial is not None:
+                    logger.info(f"Key {search_uuid} is being generated, will tail it.")
+                    return StreamingResponse(
+                        self.async_tail_partial(search_uuid, partial),
+                        media_type="text/html",
+                    )
+                logger.info(f"Key {search_uuid} not found, will generate again.")
+            except Exception as e:
+                logger.error(
+                    f"KV error: {e}\n{traceback.format_exc()}, will generate again."
+                )
+        else:
+            raise HTTPException(status_code=400, detail="search_uuid must be provided.")
+
+        query = query or _default_query
+        query = re.sub(r"\[/?INST\]", "", query)
+        cached = self._cached_answer(query, search_uuid)
+        if cached is not None:
+            return cached
+        broadcast = None
+        if single_flight:
+            keys = self._flight_keys(query, search_uuid, generate_related_questions)
+            broadcast, is_producer = self.single_flight.join(keys)
+            if not is_producer:
+                return self._follow(broadcast, search_uuid, fallback)
+        if self.backend == "LEPTON":
+            return await self._async_delegate(
+                query, search_uuid, generate_related_questions, broadcast, trace
+            )
+        try:
+            trace.permit = await self.admission.async_acquire()
+            with trace.stage("search"):
+                contexts = await self.async_search(query)
+        except Exception as e:
+            trace.release()
+            if broadcast is not None:
+                broadcast.finish(e)
+            raise
+
+        try:
+            with trace.stage("prompt"):
+                contexts = select_contexts(query, contexts, self.context_rerank)
+                packed, context_text = build_context_text(
+                    contexts, self.context_token_budget
+                )
+            if self.page_fetcher is None:
+                contexts = packed
+                llm_response = self._async_answer_request(query, context_text)
+            elif self.page_fetch_sources_first:
+                llm_response = asyncio.create_task(
+                    self._async_enriched_answer_request(query, contexts, trace)
+                )
+            else:
+                llm_response = await self._async_enriched_answer_request(
+                    query, contexts, trace
+                )
+            if self._related_questions_wanted(generate_related_questions):
+                related_questions_task = asyncio.create_task(
+                    self.async_get_related_questions(query, context_text)
+                )
+            else:
+                related_questions_task = None
+        except Exception as e:
+            trace.release()
+            if broadcast is not None:
+                broadcast.finish(e)
+            if isinstance(e, Overloaded):
+                # The LLM is rate limited or unhealthy: tell the client when to
+                # retry.
+                logger.warning(f"LLM unavailable: {e}")
+                raise
             logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
             return HTMLResponse("Internal server error.", 503)
 
         return StreamingResponse(
-            self.stream_and_upload_to_kv(
-                contexts, llm_response, related_questions_future, search_uuid
+            self.async_stream_and_upload_to_kv(
+                contexts,
+                llm_response,
+                related_questions_task,
+                search_uuid,
+                query,
+                broadcast,
+                trace,
             ),
             media_type="text/html",
         )
 
+    @Photon.handler(method="POST", path="/batch_query")
+    async def batch_query_function(
+        self,
+        queries: List[str],
+        search_uuids: Optional[List[str]] = None,
+        generate_related_questions: Optional[bool] = True,
+        store: Optional[bool] = True,
+    ) -> Response:
+        """
+        Answers a batch of queries, for offline evaluations and cache warming.
+
+        The request can have the following fields:
+            - queries: the user queries.
+            - search_uuids: the uuids to store the results under, one per query. If
+                not given, new uuids are made up. The queries whose uuid already
+                has a stored result return it.
+            - generate_related_questions: same as in /query. Default: true.
+            - store: if set to false, the results are not written to the kv.
+                Default: true.
+
+        Returns NDJSON: one line per query as soon as it is answered, in the order
+        of completion and with the index of the query, then a summary line.
+        """
+        if self.backend == "LEPTON":
+            raise HTTPException(
+                status_code=400, detail="Batch queries are not supported by LEPTON."
+            )
+        if len(queries) > self.batch_max_queries:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {self.batch_max_queries} queries per batch.",
+            )
+        if search_uuids is not None and len(search_uuids) != len(queries):
+            raise HTTPException(
+                status_code=400, detail="search_uuids must match the queries."
+            )
+        if search_uuids is not None and any("/" in u for u in search_uuids):
+            raise HTTPException(
+                status_code=400, detail="search_uuids must not contain a '/'."
+            )
+
+        async def lines():
+            async for record in self.batch_query(
+                queries, search_uuids, generate_related_questions, store
+            ):
+                yield json.dumps(record) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def batch_query(
+        self,
+        queries: List[str],
+        search_uuids: Optional[List[str]] = None,
+        generate_related_questions: bool = True,
+        store: bool = True,
+        output: Optional[str] = None,
+    ) -> AsyncGenerator[dict, None]:
+        """
+        Answers a batch of queries, and yields their records as they complete,
+        followed by a summary record. The records are also written to the JSONL
+        file output, if given.
+
+        The batch runs on the event loop with the async clients, in either mode, so
+        it holds no handler thread. Its searches and LLM calls are bounded by
+        BATCH_SEARCH_CONCURRENCY and BATCH_LLM_CONCURRENCY, shared by all the
+        batches of the replica, and bypass the admission control of the
+        interactive queries. Identical queries within the batch, up to
+        normalization, are answered once.
+        """
+        if self._batch_search_limiter is None:
+            self._batch_search_limiter = asyncio.Semaphore(self.batch_search_concurrency)
+            self._batch_llm_limiter = asyncio.Semaphore(self.batch_llm_concurrency)
+        start = time.time()
+        # normalized query -> the task that answers it.
+        answers = {}
+
+        async def run(index: int, query: str, search_uuid: Optional[str]) -> dict:
+            record = {"index": index, "query": query, "search_uuid": search_uuid}
+            item_start = time.time()
+            try:
+                result, status = None, "generated"
+                if search_uuid:
+                    try:
+                        result = self.results.get_local(search_uuid)
+                        if result is None:
+                            result = await asyncio.get_running_loop().run_in_executor(
+                                self.executor, self.results.get, search_uuid
+                            )
+                        result, status = decode_result(result), "stored"
+                    except KeyError:
+                        pass
+                if result is None:
+                    key = normalize_query(query)
+                    task = answers.get(key)
+                    if task is None:
+                        task = answers[key] = asyncio.create_task(
+                            self._batch_answer(query, generate_related_questions)
+                        )
+                    else:
+                        status = "duplicate"
+                    result, cached = await asyncio.shield(task)
+                    if cached:
+                        status = "cached"
+                    if store and search_uuid:
+                        await asyncio.get_running_loop().run_in_executor(
+                            self.kv_executor,
+                            self._put_result,
+                            search_uuid,
+                            result,
+                            self._result_metadata(query),
+                        )
+                record.update(status=status, **self._batch_sections(result))
+            except Exception as e:
+                logger.error(f"Batch query {index} failed: {e}")
+                record.update(status="error", error=str(e))
+            record["seconds"] = time.time() - item_start
+            return record
+
+        tasks = []
+        for index, query in enumerate(queries):
+            query = re.sub(r"\[/?INST\]", "", query or _default_query)
+            if search_uuids is not None:
+                search_uuid = search_uuids[index]
+            else:
+                search_uuid = str(uuid.uuid4()) if store else None
+            tasks.append(asyncio.create_task(run(index, query, search_uuid)))
+        counts = collections.Counter()
+        f = open(output, "w") if output else None
+        try:
+            for next_record in asyncio.as_completed(tasks):
+                record = await next_record
+                counts[record["status"]] += 1
+                batch_queries.labels(record["status"]).inc()
+                if f is not None:
+                    f.write(json.dumps(record) + "\n")
+                yield record
+            elapsed = time.time() - start
+            summary = {
+                "summary": {
+                    "queries": len(queries),
+                    **counts,
+                    "seconds": elapsed,
+                    "queries_per_minute": len(queries) / elapsed * 60 if elapsed else 0,
+                }
+            }
+            if f is not None:
+                f.write(json.dumps(summary) + "\n")
+        finally:
+            # The client went away, or the caller stopped iterating.
+            for task in tasks + list(answers.values()):
+                task.cancel()
+            if f is not None:
+                f.close()
+        yield summary
+
+    async def _batch_answer(self, query: str, generate_related_questions: bool):
+        """
+        Answers one query of a batch. Returns the stream response, and whether it
+        came from the answer cache.
+        """
+        if self.answer_cache is not None:
+            result = self.answer_cache.get(query)
+            if result is not None:
+                return result, True
+        trace = RequestTrace(None)
+        async with self._batch_search_limiter:
+            with trace.stage("search"):
+                contexts = await self._batch_call(self.async_search, query)
+        with trace.stage("prompt"):
+            contexts = select_contexts(query, contexts, self.context_rerank)
+            packed, context_text = build_context_text(contexts, self.context_token_budget)
+        if self.page_fetcher is None:
+            contexts = packed
+        answer = asyncio.create_task(
+            self._batch_llm_answer(query, contexts, context_text, trace)
+        )
+        try:
+            if self.should_do_related_questions and generate_related_questions:
+                async with self._batch_llm_limiter:
+                    related_questions = await self.async_get_related_questions(
+                        query, context_text
+                    )
+                footer = self._stream_footer(related_questions)
+            else:
+                footer = []
+            header = self._stream_header(contexts)
+            result = "".join(header + [await answer] + footer)
+        finally:
+            answer.cancel()
+        self._cache_answer(query, contexts, result)
+        return result, False
+
+    async def _batch_llm_answer(
+        self, query: str, contexts, context_text: str, trace: RequestTrace
+    ) -> str:
+        """
+        Generates the answer of one query of a batch, and returns it whole.
+        """
+        async with self._batch_llm_limiter:
+            if self.page_fetcher is None:
+                llm_response = await self._batch_call(
+                    self._async_answer_request, query, context_text, trace
+                )
+            else:
+                llm_response = await self._batch_call(
+                    self._async_enriched_answer_request, query, contexts, trace
+                )
+            chunks = []
+            async for chunk in llm_response:
+                if chunk.choices:
+                    if not chunks:
+                        trace.first_token()
+                    chunks.append(chunk.choices[0].delta.content or "")
+            trace.end_llm(len(chunks))
+        return "".join(chunks)
+
+    @staticmethod
+    async def _batch_call(function, *args):
+        """
+        Calls the async function, and waits out the rate limits and the open
+        circuits of the upstreams for up to _BATCH_UPSTREAM_WAIT seconds, instead
+        of failing right away like the interactive queries.
+        """
+        deadline = time.monotonic() + _BATCH_UPSTREAM_WAIT
+        while True:
+            try:
+                return await function(*args)
+            except UpstreamUnavailable as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    @staticmethod
+    def _batch_sections(result: str) -> dict:
+        """
+        The fields of a batch record: the sections of the stream response.
+        """
+        fields = {"contexts": [], "answer": "", "related_questions": []}
+        for name, text in split_result(result):
+            if name == "sources":
+                fields["contexts"] = json.loads(text)
+            elif name == "answer":
+                fields["answer"] = text
+            else:
+                fields["related_questions"] = json.loads(text)
+        return fields
+
     @Photon.handler(mount=True)
     def ui(self):
-        return StaticFiles(directory="ui")
+        return StaticAssets(directory="ui", max_bytes=self.ui_cache_max_bytes)
 
     @Photon.handler(method="GET", path="/")
     def index(self) -> RedirectResponse:
@@ -640,5 +2187,10 @@ class RAG(Photon):
 
 
 if __name__ == "__main__":
-    rag = RAG()
-    rag.launch()
+    if sys.argv[1:2] == ["index"]:
+        local_index_main(sys.argv[2:])
+    elif sys.argv[1:2] == ["ui"]:
+        ui_main(sys.argv[2:])
+    else:
+        rag = RAG()
+        rag.launch()
@@ -2,8 +2,15 @@ import { Relate } from "@/app/interfaces/relate";
 import { Source } from "@/app/interfaces/source";
 import { fetchStream } from "@/app/utils/fetch-stream";
 
-const LLM_SPLIT = "__LLM_RESPONSE__";
-const RELATED_SPLIT = "__RELATED_QUESTIONS__";
+// The events of the framed protocol, one json object per line.
+type StreamEvent =
+  | { type: "sources"; data: Source[] }
+  | { type: "delta"; data: string }
+  | { type: "related"; data: Relate[] }
+  | { type: "done" }
+  | { type: "error"; data: string };
+
+const STREAM_PROTOCOL = "ndjson/1";
 
 export const parseStreaming = async (
   controller: AbortController,
@@ -15,9 +22,11 @@ export const parseStreaming = async (
   onError?: (status: number) => void,
 ) => {
   const decoder = new TextDecoder();
-  let uint8Array = new Uint8Array();
-  let chunks = "";
-  let sourcesEmitted = false;
+  // Only the last, incomplete line of the stream is kept, so that each chunk is
+  // decoded and parsed once.
+  let line = "";
+  let markdown = "";
+  let relatesEmitted = false;
   const response = await fetch(`/query`, {
     method: "POST",
     headers: {
@@ -28,6 +37,7 @@ export const parseStreaming = async (
     body: JSON.stringify({
       query,
       search_uuid,
+      stream_protocol: STREAM_PROTOCOL,
     }),
   });
   if (response.status !== 200) {
@@ -43,34 +53,39 @@ export const parseStreaming = async (
         .replace(/\[[cC]itation:(\d+)]/g, "[citation]($1)"),
     );
   };
+  const onEvent = (event: StreamEvent) => {
+    switch (event.type) {
+      case "sources":
+        onSources(event.data);
+        break;
+      case "delta":
+        markdown += event.data;
+        markdownParse(markdown);
+        break;
+      case "related":
+        relatesEmitted = true;
+        onRelates(event.data);
+        break;
+      case "error":
+        onError?.(500);
+        break;
+    }
+  };
+  const onText = (text: string) => {
+    const lines = (line + text).split("\n");
+    line = lines.pop() ?? "";
+    for (const l of lines) {
+      if (l) {
+        onEvent(JSON.parse(l));
+      }
+    }
+  };
   fetchStream(
     response,
-    (chunk) => {
-      uint8Array = new Uint8Array([...uint8Array, ...chunk]);
-      chunks = decoder.decode(uint8Array, { stream: true });
-      if (chunks.includes(LLM_SPLIT)) {
-        const [sources, rest] = chunks.split(LLM_SPLIT);
-        if (!sourcesEmitted) {
-          try {
-            onSources(JSON.parse(sources));
-          } catch (e) {
-            onSources([]);
-          }
-        }
-        sourcesEmitted = true;
-        if (rest.includes(RELATED_SPLIT)) {
-          const [md] = rest.split(RELATED_SPLIT);
-          markdownParse(md);
-        } else {
-          markdownParse(rest);
-        }
-      }
-    },
+    (chunk) => onText(decoder.decode(chunk, { stream: true })),
     () => {
-      const [_, relates] = chunks.split(RELATED_SPLIT);
-      try {
-        onRelates(JSON.parse(relates));
-      } catch (e) {
+      onText(decoder.decode() + "\n");
+      if (!relatesEmitted) {
         onRelates([]);
       }
     },